@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, update as sql_update
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from models import engine as default_engine, User
+
+logger = logging.getLogger(__name__)
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+
+# Usernames can pass from one Telegram user to another, so before a user is saved with a username,
+# whoever had it before loses it (users.username is unique)
+def release_username(db, username: str, telegram_id: int) -> None:
+    if username:
+        db.execute(sql_update(User).where(User.username == username, User.telegram_id != telegram_id)
+                   .values(username=None).execution_options(synchronize_session=False))
+
+
+# Remembers when each user was last seen (UTC, like CURRENT_TIMESTAMP) and their latest username
+# and name, and writes them to users in one batch every few seconds, so handling an update never
+# waits for this write. Users that can't be messaged are recorded the same way.
+class ActivityTracker:
+    def __init__(self, flush_interval: float, bind=None):
+        self.flush_interval = flush_interval
+        self.bind = bind or default_engine
+        self._seen = {}  # telegram_id -> (datetime, username, first_name, last_name)
+        self._unreachable = {}  # telegram_id -> datetime of the failed send
+        self._recent = deque()  # monotonic times of the updates of the last minute
+        self._task = None
+
+    # Handler for a TypeHandler(Update, ...) in an early group
+    async def touch(self, update: Update, context: CallbackContext) -> None:
+        user = update.effective_user
+        if user:
+            self._seen[user.id] = (_now(), user.username, user.first_name, user.last_name)
+            self._unreachable.pop(user.id, None)
+        self._recent.append(time.monotonic())
+        self._trim()
+
+    # A send to the user failed because they blocked the bot or deleted their account
+    def unreachable(self, telegram_id: int) -> None:
+        self._unreachable[telegram_id] = _now()
+
+    def _trim(self) -> None:
+        cutoff = time.monotonic() - 60
+        while self._recent and self._recent[0] < cutoff:
+            self._recent.popleft()
+
+    # Updates received in the last minute
+    def recent_rate(self) -> int:
+        self._trim()
+        return len(self._recent)
+
+    # Must be called from the event loop
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error writing activity")
+
+    async def flush(self) -> None:
+        if not self._seen and not self._unreachable:
+            return
+        seen, self._seen = self._seen, {}
+        unreachable, self._unreachable = self._unreachable, {}
+        try:
+            await asyncio.to_thread(self._write, seen, unreachable)
+        except Exception:
+            # Kept for the next flush, unless the user has been seen again since
+            for telegram_id, activity in seen.items():
+                self._seen.setdefault(telegram_id, activity)
+            for telegram_id, failed_at in unreachable.items():
+                if telegram_id not in self._seen:
+                    self._unreachable.setdefault(telegram_id, failed_at)
+            raise
+
+    # Seen users are reachable again; failed sends recorded after a user was seen win
+    def _write(self, seen: dict, unreachable: dict = None) -> None:
+        rows = [{"b_telegram_id": telegram_id, "b_seen": seen_at, "b_username": username,
+                 "b_first_name": first_name, "b_last_name": last_name}
+                for telegram_id, (seen_at, username, first_name, last_name) in seen.items()]
+        # If two users in the batch have the same username, the one seen last has it now
+        holders = {}
+        for row in sorted(rows, key=lambda row: row["b_seen"]):
+            if row["b_username"]:
+                holders[row["b_username"]] = row["b_telegram_id"]
+        for row in rows:
+            if row["b_username"] and holders[row["b_username"]] != row["b_telegram_id"]:
+                row["b_username"] = None
+
+        release = (
+            sql_update(User)
+            .where(User.username == bindparam("b_username"), User.telegram_id != bindparam("b_telegram_id"))
+            .values(username=None)
+        )
+        statement = (
+            sql_update(User)
+            .where(User.telegram_id == bindparam("b_telegram_id"))
+            .values(last_seen_at=bindparam("b_seen"), username=bindparam("b_username"),
+                    first_name=bindparam("b_first_name"), last_name=bindparam("b_last_name"),
+                    unreachable_at=None)
+        )
+        failed = (
+            sql_update(User)
+            .where(User.telegram_id == bindparam("b_telegram_id"))
+            .values(unreachable_at=bindparam("b_failed"))
+        )
+        with self.bind.begin() as conn:
+            claimed = [row for row in rows if row["b_username"]]
+            if claimed:
+                conn.execute(release, claimed)
+            if rows:
+                conn.execute(statement, rows)
+            if unreachable:
+                conn.execute(failed, [{"b_telegram_id": telegram_id, "b_failed": failed_at}
+                                      for telegram_id, failed_at in unreachable.items()])
@@ -2,17 +2,47 @@ import logging
 import string
 import random
 from sqlalchemy.orm import Session
-from telegram import Update, Bot, ForceReply, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, ConversationHandler, CallbackContext, CallbackQueryHandler
-import uuid
+from telegram import Update, ForceReply, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, KeyboardButton
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, ConversationHandler, CallbackContext, CallbackQueryHandler, TypeHandler
+from telegram.error import BadRequest, Forbidden
 from sqlalchemy.types import TypeDecorator, TEXT
 from config import BOT_TOKEN, ADMIN_ID
-from models import SessionLocal, User, Admin, Command, Settings
-import pandas as pd
+from models import SessionLocal, User, Admin, Command, Settings, Referral, init_db
 import os
 import json
-from models import engine
+from models import current_engine
 import asyncio
+import contextvars
+import time
+from datetime import datetime, timedelta, timezone
+from metrics import track_handler, record_broadcast, render_summary, InstrumentedRequest, start_metrics_server
+from config import METRICS_HOST, METRICS_PORT, BROADCAST_DELAY, BOT_API_URL, CAPTURE_FILE, SECRET_KEY
+from capture import TrafficRecorder
+from config import PROFILE_MAX_SECONDS, SLOW_CALLBACK_THRESHOLD
+import profiler
+import media
+import segments
+from config import BROADCAST_BUSY_RATE, BROADCAST_BUSY_DELAY
+import schedules
+import menu
+import activity
+import ledger
+import outbox
+import payouts
+import usage
+import search
+import growth
+import conversations
+from config import LEDGER_SNAPSHOT_SECONDS
+from models import ScheduledBroadcast
+from persistence import SQLitePersistence
+from config import PERSISTENCE_INTERVAL, TENANTS_FILE
+from config import CONVERSATION_TIMEOUT, CONVERSATION_SWEEP_SECONDS
+from config import LOG_FILE, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUPS, LOG_DEBUG_SAMPLE_RATE
+import tenants
+import logs
+
+logger = logging.getLogger(__name__)
 
 # Conversation states
 (
@@ -33,16 +63,42 @@ import asyncio
     DELETE_ADMIN_CONFIRMATION
 ) = range(15)
 
-bot = Bot(BOT_TOKEN)
+# Opt-in recording of incoming traffic for replay.py
+traffic_recorder = TrafficRecorder(CAPTURE_FILE, SECRET_KEY) if CAPTURE_FILE else None
+
+# Sessions handed out while an update is being processed
+_update_sessions = contextvars.ContextVar('update_sessions', default=None)
 
 # Database session dependency
 def get_db():
     db = SessionLocal()
+    # Handlers keep using the session after this generator is dropped, so it is
+    # closed by BotApplication once the update has been processed
+    sessions = _update_sessions.get()
+    if sessions is not None:
+        sessions.append(db)
     try:
         yield db
     finally:
         db.close()
 
+
+# Application that releases the DB sessions of each update as soon as it is handled,
+# instead of leaving their connections checked out until garbage collection
+class BotApplication(Application):
+    async def process_update(self, update: object) -> None:
+        token = _update_sessions.set([])
+        try:
+            await super().process_update(update)
+        finally:
+            for db in _update_sessions.get():
+                db.close()
+            _update_sessions.reset(token)
+
+# Images held by unfinished /addcommand and /broadcast conversations, which media GC must keep
+def conversation_images(application: Application) -> set:
+    return {data[key] for data in application.user_data.values() for key in ('image_url', 'photo_path') if data.get(key)}
+
 # Helper function to generate referral ID
 def generate_referral_id():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=5))
@@ -91,7 +147,9 @@ async def check_membership(user_id: int, bot) -> bool:
         for chat in required_chats:
             try:
                 member = await bot.get_chat_member(chat['id'], user_id)
-                if member.status not in ['member', 'administrator', 'creator']:
+                is_member = member.status in ['member', 'administrator', 'creator']
+                segments.record_membership(chat['id'], user_id, is_member)
+                if not is_member:
                     return False
             except:
                 return False
@@ -214,6 +272,7 @@ async def check_membership_button(update: Update, context: CallbackContext) -> b
             try:
                 member = await context.bot.get_chat_member(chat['id'], user.id)
                 status = "✅" if member.status in ['member', 'administrator', 'creator'] else "❌"
+                segments.record_membership(chat['id'], user.id, status == "✅")
                 if status == "❌":
                     all_joined = False
             except:
@@ -238,12 +297,13 @@ async def check_membership_button(update: Update, context: CallbackContext) -> b
                 try:
                     await query.edit_message_text("Please join the chats to use bot.:", reply_markup=keyboard)
                 except:
-                    await bot.send_message(text ="Please join the chats to use bot:", chat_id=chat_id, reply_markup=keyboard)
+                    await context.bot.send_message(text ="Please join the chats to use bot:", chat_id=chat_id, reply_markup=keyboard)
 
             return False
     return True  # If strict_join is not enabled or no settings found
 
 
+@track_handler
 async def button_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
@@ -259,9 +319,11 @@ async def restricted_handler(update: Update, context: CallbackContext) -> None:
         await check_membership_button(update, context)
         return False
 
+@track_handler
 async def start(update: Update, context: CallbackContext) -> None:
     if not await restricted_handler(update=update, context=context):
         return
+    tenants.current().usage.count("start")
     db: Session = SessionLocal()
     if len(context.args) > 0:
         referral_id = context.args[0]
@@ -275,7 +337,9 @@ async def start(update: Update, context: CallbackContext) -> None:
     
 
     user = db.query(User).filter_by(telegram_id=update.message.from_user.id).first()
+    credited = None
     if not user:
+        activity.release_username(db, update.message.from_user.username, update.message.from_user.id)
         # Create a new user
         new_user = User(
             telegram_id=update.message.from_user.id,
@@ -286,19 +350,25 @@ async def start(update: Update, context: CallbackContext) -> None:
             referer_id=referer_id
         )
         db.add(new_user)
+        if referrer:
+            # Record the referral and credit the referrer in the same transaction as the signup
+            db.flush()
+            settings = db.query(Settings).first()
+            db.add(Referral(referrer_id=referrer.id, referee_id=new_user.id,
+                            credited=settings.referral_earning if settings else None))
+            if settings and settings.referral_earning is not None:
+                credited = ledger.to_minor(settings.referral_earning)
+            if credited:
+                ledger.post(db, referrer.id, credited, ledger.REFERRAL_BONUS, f"referee:{new_user.id}")
+                referrer.total_earnings += settings.referral_earning  # Optionally update total earnings as well
+            if credited is not None:
+                # Sent by the outbox worker in the referrer's next digest, only if this commit succeeds
+                outbox.referral_bonus(db, referrer.telegram_id, credited, f"referral:{new_user.id}")
+        growth.record_signup(db, referrer.id if referrer else None)
         db.commit()
 
     try:
-        if referral_id:            
-            if referrer:
-                # Optionally, update earnings based on settings
-                settings = db.query(Settings).first()
-                if settings:
-                    referrer.earnings += settings.referral_earning
-                    referrer.total_earnings += settings.referral_earning  # Optionally update total earnings as well
-                    await context.bot.send_message(referrer.telegram_id, f"You have received a referral bonus!")
-                    db.commit()
-        
+
         # Fetch and send response for the start command
         command_text = "start"
         command = db.query(Command).filter_by(command=command_text).first()
@@ -323,7 +393,7 @@ async def start(update: Update, context: CallbackContext) -> None:
 
             # Send the main response
             if command.image_url:
-                await update.message.reply_photo(photo=command.image_url, caption=response_text, reply_markup=inline_reply_markup)
+                await media.send_photo(update.message.reply_photo, command.image_url, caption=response_text, reply_markup=inline_reply_markup)
             else:
                 await update.message.reply_text(text=response_text, reply_markup=inline_reply_markup, disable_web_page_preview=True)
             
@@ -333,12 +403,13 @@ async def start(update: Update, context: CallbackContext) -> None:
         else:
             await update.message.reply_text(f"Welcome {update.effective_user.first_name}!\n\n Use the /help command to see available commands")
 
-    except Exception as e:
-        print(f"Error: {e}")
+    except Exception:
+        logger.exception("Error sending the start message")
         db.rollback()
     finally:
         db.close()
 
+@track_handler
 async def forward_channel_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message:
         db: Session = next(get_db())
@@ -365,9 +436,10 @@ async def forward_channel_message(update: Update, context: ContextTypes.DEFAULT_
                     try:
                         await context.bot.forward_message(chat_id=user.telegram_id, from_chat_id=chat_id, message_id=update.message.message_id)
                     except Exception as e:
-                        print(f"Failed to forward message to user {user.telegram_id}: {e}")
+                        logger.warning("Failed to forward message to user %s: %s", user.telegram_id, e)
 
 
+@track_handler
 async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # if not await restricted_handler(update=update, context=context):
     #     check_membership_button(update, context)
@@ -375,6 +447,7 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     db: Session = next(get_db())
     command_text = update.message.text.lower().replace("/", "")
     command = db.query(Command).filter_by(command=command_text).first()
+    tenants.current().usage.count(command.command if command else usage.UNKNOWN)
     if command:
         response_text = command.response
 
@@ -394,7 +467,7 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         # Send the main response
         if command.image_url:
-            await update.message.reply_photo(photo=command.image_url, caption=response_text, reply_markup=inline_reply_markup)
+            await media.send_photo(update.message.reply_photo, command.image_url, caption=response_text, reply_markup=inline_reply_markup)
         else:
             await update.message.reply_text(text=response_text, reply_markup=inline_reply_markup, disable_web_page_preview=True)
 
@@ -412,14 +485,15 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 
+@track_handler
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # if not await restricted_handler(update=update, context=context):
     #     check_membership_button(update, context)
     #     return
-    print("dfghdfghdfg")
     db: Session = next(get_db())
     message_text = update.message.text.lower()
     command = db.query(Command).filter_by(command=message_text).first()
+    tenants.current().usage.count(command.command if command else usage.UNKNOWN)
     if command:
         response_text = command.response
 
@@ -439,7 +513,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         # Send the main response
         if command.image_url:
-            await update.message.reply_photo(photo=command.image_url, caption=response_text, reply_markup=inline_reply_markup)
+            await media.send_photo(update.message.reply_photo, command.image_url, caption=response_text, reply_markup=inline_reply_markup)
         else:
             await update.message.reply_text(text=response_text, reply_markup=inline_reply_markup, disable_web_page_preview=True)
 
@@ -456,9 +530,11 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             f"reload the Menu by pressing /start")
 
 
+@track_handler
 async def affiliate(update: Update, context: CallbackContext) -> None:
     if not await restricted_handler(update=update, context=context):
         return
+    tenants.current().usage.count("affiliate")
     user = update.effective_user
     db: Session = next(get_db())
 
@@ -469,7 +545,7 @@ async def affiliate(update: Update, context: CallbackContext) -> None:
         ref_link = f"https://t.me/{context.bot.username}?start={user_data.referral_id}"
         
         # Count the number of direct referrals
-        referrals_count = db.query(User).filter(User.referer_id == user_data.id).count()
+        referrals_count = db.query(Referral).filter(Referral.referrer_id == user_data.id).count()
         # Fetch and send response for the start command
         command_text = "affiliate"
         command = db.query(Command).filter_by(command=command_text).first()
@@ -478,7 +554,7 @@ async def affiliate(update: Update, context: CallbackContext) -> None:
             f"👤 Your Affiliate Information\n\n"
             f"🆔 User ID: {update.effective_user.id}\n"
             f"👥 Referrals: {referrals_count}\n"
-            f"💰 Earnings: {user_data.earnings}\n"
+            f"💰 Earnings: {ledger.format_amount(user_data.balance)}\n"
             # f"💸 Downline Earnings: {user_data.downline_earnings}\n"
             f"🔗 Referral Link: {ref_link}"  # Escape the '.' in ref_link
         )
@@ -503,7 +579,7 @@ async def affiliate(update: Update, context: CallbackContext) -> None:
 
             # Send the main response
             if command.image_url:
-                await update.message.reply_photo(photo=command.image_url, caption=message, reply_markup=inline_reply_markup)
+                await media.send_photo(update.message.reply_photo, command.image_url, caption=message, reply_markup=inline_reply_markup)
             else:
                 await update.message.reply_text(text=message, reply_markup=inline_reply_markup, disable_web_page_preview=True)
             
@@ -579,13 +655,42 @@ async def set_downline_earning(update: Update, context: ContextTypes.DEFAULT_TYP
     db.commit()
     await update.message.reply_text(f"Downline earning set to {amount}")
 
+@track_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = next(get_db())
-    commands = db.query(Command).filter_by(is_command=True).all()
-    help_text = "Available commands:\n\n"
-    for cmd in commands:
-        help_text += f"/{cmd.command}: {cmd.description}\n\n"
-    await update.message.reply_text(help_text)
+    pages = menu.help_pages("help")
+    await update.message.reply_text(pages[0], reply_markup=help_keyboard("help", 0, len(pages)))
+
+# Previous / page number / next buttons under a page of /help or /admin_help
+def help_keyboard(kind: str, page: int, count: int):
+    if count <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Previous", callback_data=f"help:{kind}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{count}", callback_data=f"help:{kind}:{page}"))
+    if page < count - 1:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"help:{kind}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+# Show another page of a help message, from the pages rendered in memory
+async def help_page_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    _, kind, page = query.data.split(":")
+    if kind == "admin_help":
+        db: Session = next(get_db())
+        if not db.query(Admin).filter(Admin.telegram_id == update.effective_user.id).first():
+            await query.answer("You do not have permission to use this command.")
+            return
+    pages = menu.help_pages(kind)
+    # Pages may have been removed since the message was sent
+    page = min(int(page), len(pages) - 1)
+    await query.answer()
+    try:
+        await query.edit_message_text(pages[page], reply_markup=help_keyboard(kind, page, len(pages)))
+    except BadRequest as e:
+        # The page shown already, e.g. the page number was pressed
+        if "not modified" not in str(e):
+            raise
 
 
 async def deduct_ref_points(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -605,10 +710,13 @@ async def deduct_ref_points(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     try:
         user_id = int(context.args[0])
-        points = float(context.args[1])
-    except ValueError:
+        points = ledger.to_minor(context.args[1])
+    except (ValueError, ArithmeticError):
         await update.message.reply_text("Invalid user ID or points. Please enter a valid number.")
         return
+    if points <= 0:
+        await update.message.reply_text("Points must be more than 0.")
+        return
     
     # Fetch the user to deduct points from
     target_user = db.query(User).filter(User.telegram_id == user_id).first()
@@ -616,11 +724,227 @@ async def deduct_ref_points(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("User not found.")
         return
     
-    # Deduct points ensuring earnings do not go below 0.0
-    target_user.earnings = max(target_user.earnings - points, 0.0)
+    # Deduct points ensuring earnings do not go below 0, recording the deduction in the ledger
+    deducted = min(points, max(ledger.balance_for_update(db, target_user.id), 0))
+    if deducted:
+        ledger.post(db, target_user.id, -deducted, ledger.DEDUCTION, f"admin:{user.id}")
     db.commit()
     
-    await update.message.reply_text(f"Successfully deducted {points} points from user {user_id}. New earnings: {target_user.earnings}")
+    await update.message.reply_text(f"Successfully deducted {ledger.format_amount(deducted)} points from user {user_id}. "
+                                    f"New earnings: {ledger.format_amount(target_user.balance)}")
+
+# Show a user's balance, an optional historic balance and latest ledger entries, and check the
+# cached balance against the ledger
+async def ledger_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    try:
+        if len(context.args) not in (1, 2):
+            raise ValueError
+        telegram_id = int(context.args[0])
+        # Balance at the end of the given day (UTC)
+        day_end = datetime.strptime(context.args[1], "%Y-%m-%d") + timedelta(days=1, seconds=-1) if len(context.args) == 2 else None
+    except ValueError:
+        await update.message.reply_text("Usage: /ledger <user id> [YYYY-MM-DD]")
+        return
+    target_user = db.query(User).filter(User.telegram_id == telegram_id).first()
+    if not target_user:
+        await update.message.reply_text("User not found.")
+        return
+
+    from_ledger = ledger.balance_at(db, target_user.id)
+    text = (f"📒 Ledger of {telegram_id}\n\n"
+            f"💰 Balance: {ledger.format_amount(target_user.balance)}"
+            f"{' ✅' if from_ledger == target_user.balance else f' ⚠️ ledger says {ledger.format_amount(from_ledger)}'}\n")
+    if day_end:
+        text += f"📅 Balance on {context.args[1]}: {ledger.format_amount(ledger.balance_at(db, target_user.id, day_end))}\n"
+    entries = ledger.recent_entries(db, target_user.id)
+    text += "\nLatest entries:\n" if entries else "\nNo entries yet."
+    for entry in entries:
+        text += f"{entry.created_at:%Y-%m-%d %H:%M} {'+' if entry.amount > 0 else ''}{ledger.format_amount(entry.amount)} {entry.reason}" \
+                f"{f' ({entry.reference})' if entry.reference else ''}\n"
+    await update.message.reply_text(text)
+
+# Most and least used prompts from the hourly usage rollups
+@track_handler
+async def command_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    try:
+        days = int(context.args[0]) if context.args else 7
+        if len(context.args) > 1 or not 0 < days <= usage.MAX_DAYS:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(f"Usage: /command_stats [days], at most {usage.MAX_DAYS} days")
+        return
+    # Include what was counted since the last flush
+    await tenants.current().usage.flush()
+    used, unused = await asyncio.to_thread(usage.command_stats, days)
+    lines = [f"📊 Prompt usage, last {days} days\n"]
+    lines += [f"{prompt}: {uses} (last {last:%Y-%m-%d %H}:00 UTC)" for prompt, uses, last in used[:usage.TOP_PROMPTS]]
+    if len(used) > usage.TOP_PROMPTS:
+        lines.append(f"… and {len(used) - usage.TOP_PROMPTS} more")
+    if not used:
+        lines.append("No prompts were used.")
+    if unused:
+        lines.append(f"\nNot used ({len(unused)}): {', '.join(unused)}")
+    await update.message.reply_text("\n".join(lines)[:4096])
+
+# Search users by username, name, referral code or Telegram ID
+@track_handler
+async def find_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    if not context.args:
+        await update.message.reply_text("Usage: /find_user <username, name, referral code or user id>")
+        return
+    # The page buttons page through the admin's latest search
+    context.user_data['find_user'] = " ".join(context.args)
+    try:
+        text, reply_markup = await find_user_page(context.user_data['find_user'], 0)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+# Text and buttons of one page of search results
+async def find_user_page(query: str, page: int):
+    rows, more = await asyncio.to_thread(search.find_users, query, page)
+    if not rows:
+        return f"🔍 No users match \"{query}\".", None
+    lines = [f"🔍 Users matching \"{query}\" (page {page + 1})\n"]
+    buttons = []
+    for number, row in enumerate(rows, start=page * search.PAGE_SIZE + 1):
+        name = " ".join(part for part in (row.first_name, row.last_name) if part)
+        handle = f"@{row.username}" if row.username else name
+        lines.append(f"{number}. {row.telegram_id} {handle}" + (f" ({name})" if row.username and name else ""))
+        buttons.append([InlineKeyboardButton(
+            f"{handle} · 💰 {ledger.format_amount(row.balance)} · 👥 {row.referrals}",
+            callback_data=f"find_user:user:{row.telegram_id}")])
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Previous", callback_data=f"find_user:page:{page - 1}"))
+    if more:
+        navigation.append(InlineKeyboardButton("Next ▶️", callback_data=f"find_user:page:{page + 1}"))
+    if navigation:
+        buttons.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+# Buttons of /find_user results: another page, or the details of one user
+async def find_user_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    db: Session = next(get_db())
+    if not db.query(Admin).filter(Admin.telegram_id == update.effective_user.id).first():
+        await query.answer("You do not have permission to use this command.")
+        return
+    _, action, value = query.data.split(":")
+    if action == "page":
+        if not context.user_data.get('find_user'):
+            await query.answer("This search has expired, use /find_user again.")
+            return
+        await query.answer()
+        text, reply_markup = await find_user_page(context.user_data['find_user'], int(value))
+        await query.edit_message_text(text, reply_markup=reply_markup)
+        return
+    details = await asyncio.to_thread(search.user_details, int(value))
+    await query.answer()
+    if details is None:
+        await query.message.reply_text("User not found.")
+        return
+    name = " ".join(part for part in (details.first_name, details.last_name) if part)
+    await query.message.reply_text(
+        f"👤 {name}" + (f" (@{details.username})" if details.username else "") + "\n"
+        f"🆔 User ID: {details.telegram_id}\n"
+        f"🔗 Referral code: {details.referral_id}\n"
+        f"💰 Balance: {ledger.format_amount(details.balance)}\n"
+        f"👥 Referrals: {details.referrals}\n"
+        f"↩️ Referred by: {details.referrer or '-'}\n"
+        f"📅 Joined: {f'{details.created_at} UTC' if details.created_at else '-'}\n"
+        f"👀 Last seen: {f'{details.last_seen_at} UTC' if details.last_seen_at else '-'}"
+    )
+
+# Growth figures from the daily rollups, without scanning users
+@track_handler
+async def dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    figures = await asyncio.to_thread(growth.dashboard)
+    if figures["closed"] is None:
+        # First use: close the days since the first user
+        await asyncio.to_thread(growth.rollup)
+        figures = await asyncio.to_thread(growth.dashboard)
+
+    def percent(part: int, whole: int) -> str:
+        return f"{part * 100 / whole:.1f}%" if whole else "-"
+
+    referred_7, signups_7 = figures["conversion_7"]
+    referred_30, signups_30 = figures["conversion_30"]
+    lines = [
+        "📈 Growth dashboard\n",
+        f"👥 Users: {figures.get('users', '-')}",
+        f"🆕 Signups today: {figures['today']}, yesterday: {figures['yesterday']}",
+        f"📅 Signups per week: {' / '.join(str(week) for week in figures['weeks'])} (this week first)",
+        f"🔗 Referred signups: {percent(referred_7, signups_7)} last 7 days, {percent(referred_30, signups_30)} last 30 days",
+    ]
+    if "unreachable" in figures:
+        unreachable, users_total = figures["unreachable"]
+        lines.append(f"🚫 Unreachable: {unreachable} ({percent(unreachable, users_total)}) as of {figures['closed']}")
+    if "liabilities" in figures:
+        lines.append(f"💰 Earnings owed: {ledger.format_amount(figures['liabilities'])}")
+    if figures["top_referrers"]:
+        lines.append("\n🏆 Top referrers, last 30 days:")
+        lines += [f"{telegram_id}{f' @{username}' if username else ''}: {signups}"
+                  for telegram_id, username, signups in figures["top_referrers"]]
+    await update.message.reply_text("\n".join(lines))
+
+# Log errors of handlers with the update they happened in
+async def log_error(update: object, context: CallbackContext) -> None:
+    fields = {}
+    if isinstance(update, Update):
+        fields = {"update_id": update.update_id,
+                  "user_id": update.effective_user.id if update.effective_user else None}
+    logger.error("Error handling an update", exc_info=context.error, extra=fields)
+
+# Job that snapshots balances for fast historic queries and reports any that drifted from the ledger
+async def snapshot_balances(context: CallbackContext) -> None:
+    snapshotted, mismatches = await asyncio.to_thread(ledger.take_snapshots)
+    for telegram_id, cached, from_ledger in mismatches:
+        logger.error("Balance of %s is %s but the ledger says %s", telegram_id,
+                     ledger.format_amount(cached), ledger.format_amount(from_ledger))
+
+# Nightly job that closes the previous day of the growth rollups
+async def growth_rollup(context: CallbackContext) -> None:
+    await asyncio.to_thread(growth.rollup)
+
+# Job that drops idle conversation state and the images only it still used
+async def sweep_conversations(context: CallbackContext) -> None:
+    application = context.application
+    cleared, ended, freed, dropped = conversations.sweep(application, CONVERSATION_TIMEOUT)
+    if (ended or dropped) and application.persistence:
+        # Delete the ended states and dropped entries now; PTB would skip the entries of users who
+        # write before the next run
+        await application.update_persistence()
+    removed, disk = await asyncio.to_thread(media.collect_garbage, keep=conversation_images(application))
+    if cleared or ended or dropped or removed:
+        logger.info("Conversation sweep: ended %s idle conversations, cleared the state of %s users (~%s KB), "
+                    "dropped %s empty user_data entries, deleted %s images (%s KB)",
+                    ended, cleared, freed // 1024, dropped, removed, disk // 1024)
 
 # Conversation handlers for adding a command
 async def add_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -634,6 +958,7 @@ async def add_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
                                     f"Examples: ' start ' , ' 🏠 Menu ' ...\n\n"
                                     f"Enter the Prompt without ' / ' or ' ! '. \n⚠️ Avoid using existing prompts!:\n\n"
                                     f"Use /cancel to cancel")
+    conversations.begin(context.user_data)
     return ADD_COMMAND
 
 async def add_command_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -684,20 +1009,9 @@ async def add_command_inline_links(update: Update, context: ContextTypes.DEFAULT
 async def add_command_save_image(update: Update, context: CallbackContext) -> int:
   # Check if the message contains a photo
   if update.message.photo:
-    # Get the largest available photo (last in the list)
-    photo = update.message.photo[-1]
-    file_id = photo.file_id
-  
     try:
-      # Get the file object for the photo using file_id
-      photo_obj = await context.bot.get_file(file_id)
-  
-      # Generate a unique filename for the image
-      image_id = str(uuid.uuid4())
-      file_path = f'images/{image_id}.jpg'
-  
-      # Download the photo to the specified file path using download_to_drive method
-      await photo_obj.download_to_drive(custom_path=file_path)  
+      # Save the photo to the media store (the same picture is only ever stored once)
+      file_path = await media.save_photo(context.bot, update.message.photo)
   
       # Store the image path in user_data for later use
       context.user_data['image_url'] = file_path
@@ -765,6 +1079,7 @@ async def add_command_finish(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
     db.add(new_command)
     db.commit()
+    await commands_changed(context.application)
     if is_command == True:
         await update.message.reply_text(f"✅ Command /{new_command.command} created successfully.", reply_markup=ReplyKeyboardRemove())
     else:
@@ -772,7 +1087,163 @@ async def add_command_finish(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return ConversationHandler.END
 
 # Define constants for the new states
-ADD_MARKUP_BUTTONS = range(9, 10)
+ADD_MARKUP_BUTTONS = 15  # A plain int so the state can be persisted
+IMPORT_COMMANDS_FILE = 16
+
+# Conversation handlers for importing commands from a file
+async def import_commands_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    admin_id = update.effective_user.id
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter_by(telegram_id=admin_id).first()
+    if not admin:
+        await update.message.reply_text("You are not authorized to perform this action.")
+        return ConversationHandler.END
+    await update.message.reply_text("Send the prompts as a JSON or CSV file, in the format of /export_commands.\n\n"
+                                    f"Columns: {', '.join(menu.FIELDS)}. Existing prompts are updated, new ones added.\n\n"
+                                    f"Use /cancel to cancel")
+    conversations.begin(context.user_data)
+    return IMPORT_COMMANDS_FILE
+
+async def import_commands_receive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    try:
+        telegram_file = await context.bot.get_file(document.file_id)
+        data = bytes(await telegram_file.download_as_bytearray())
+        rows = menu.read_document(data, document.file_name or "")
+        commands, errors = await asyncio.to_thread(menu.validate, rows)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\nSend a corrected file or use /cancel to cancel")
+        return IMPORT_COMMANDS_FILE
+    except Exception as e:
+        await update.message.reply_text(f"Failed to download the file: {str(e)}")
+        return IMPORT_COMMANDS_FILE
+    if errors:
+        await update.message.reply_text(f"❌ Nothing was imported, {len(errors)} rows need fixing:\n\n"
+                                        f"{menu.describe_errors(errors)}\n\n"
+                                        f"Send a corrected file or use /cancel to cancel")
+        return IMPORT_COMMANDS_FILE
+    if not commands:
+        await update.message.reply_text("The file has no prompts. Send another file or use /cancel to cancel")
+        return IMPORT_COMMANDS_FILE
+
+    added, updated = await asyncio.to_thread(menu.upsert_commands, commands)
+    await commands_changed(context.application)
+    await update.message.reply_text(f"✅ Imported {len(commands)} prompts: {added} added, {updated} updated.")
+    return ConversationHandler.END
+
+@track_handler
+async def export_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    export_format = context.args[0].lower() if context.args else "json"
+    if len(context.args) > 1 or export_format not in ("json", "csv"):
+        await update.message.reply_text("Usage: /export_commands [json|csv]")
+        return
+    data = await asyncio.to_thread(menu.export_commands, export_format)
+    await context.bot.send_document(chat_id=user.id, document=data, filename=f"commands.{export_format}")
+
+PAYOUT_FILE = 17
+PAYOUT_CONFIRM = 18
+
+# Conversation handlers for applying a payout file
+async def bulk_payout_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    admin_id = update.effective_user.id
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter_by(telegram_id=admin_id).first()
+    if not admin:
+        await update.message.reply_text("You are not authorized to perform this action.")
+        return ConversationHandler.END
+    await update.message.reply_text("Send the payouts as a CSV or XLSX file with the columns "
+                                    f"{', '.join(payouts.FIELDS)}.\n\n"
+                                    "Negative amounts are paid out of a balance, positive amounts are credited. "
+                                    "Nothing is changed until you /confirm.\n\n"
+                                    "Use /cancel to cancel")
+    conversations.begin(context.user_data)
+    return PAYOUT_FILE
+
+# Download and parse the payout file; it is downloaded again on /confirm, so user_data stays small
+async def read_payout_file(context: ContextTypes.DEFAULT_TYPE, file_id: str, file_name: str):
+    telegram_file = await context.bot.get_file(file_id)
+    data = bytes(await telegram_file.download_as_bytearray())
+    rows = await asyncio.to_thread(payouts.read_document, data, file_name)
+    return data, rows
+
+async def bulk_payout_receive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    try:
+        data, rows = await read_payout_file(context, document.file_id, document.file_name or "")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\nSend a corrected file or use /cancel to cancel")
+        return PAYOUT_FILE
+    except Exception as e:
+        await update.message.reply_text(f"Failed to download the file: {str(e)}")
+        return PAYOUT_FILE
+    if not rows:
+        await update.message.reply_text("The file has no payouts. Send another file or use /cancel to cancel")
+        return PAYOUT_FILE
+    items, errors = payouts.parse(rows)
+    reference = payouts.file_reference(data)
+    if items:
+        errors.update(await asyncio.to_thread(payouts.validate, items, reference))
+    if 0 in errors:
+        await update.message.reply_text(f"❌ {errors[0].capitalize()}.\n\nSend another file or use /cancel to cancel")
+        return PAYOUT_FILE
+    if errors:
+        await context.bot.send_document(chat_id=update.effective_user.id,
+                                        document=payouts.result_file(rows, items, errors, {}),
+                                        filename="payout_errors.csv",
+                                        caption=f"❌ {len(errors)} of {len(rows)} rows need fixing; see the status column.\n\n"
+                                                f"Send a corrected file or use /cancel to cancel")
+        return PAYOUT_FILE
+
+    totals = payouts.summarize(items)
+    context.user_data['payout_file'] = [document.file_id, document.file_name or ""]
+    await update.message.reply_text(f"Payout file checked: {totals['rows']} users.\n\n"
+                                    f"Credited: {ledger.format_amount(totals['credits'])}\n"
+                                    f"Paid out: {ledger.format_amount(totals['debits'])}\n"
+                                    f"Net change: {ledger.format_amount(totals['net'])}\n\n"
+                                    f"Send /confirm to apply it, or /cancel to cancel")
+    return PAYOUT_CONFIRM
+
+async def bulk_payout_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    file_id, file_name = context.user_data.pop('payout_file', [None, ""])
+    if not file_id:
+        await update.message.reply_text("No payout file found. Use /bulk_payout to start again.")
+        return ConversationHandler.END
+    started = time.perf_counter()
+    try:
+        data, rows = await read_payout_file(context, file_id, file_name)
+    except Exception as e:
+        await update.message.reply_text(f"Failed to download the file again: {str(e)}")
+        return ConversationHandler.END
+    items, errors = payouts.parse(rows)
+    balances = {}
+    if not errors:
+        # Checked again in the same transaction, as balances may have changed since the preview
+        errors, balances = await asyncio.to_thread(payouts.apply, items, payouts.file_reference(data))
+    if 0 in errors:
+        await update.message.reply_text(f"❌ Nothing was changed: {errors[0]}.")
+        return ConversationHandler.END
+    if errors:
+        caption = f"❌ Nothing was changed, {len(errors)} rows failed the final check; see the status column."
+    else:
+        totals = payouts.summarize(items)
+        caption = (f"✅ Applied {totals['rows']} payouts in {time.perf_counter() - started:.1f}s. "
+                   f"Net change: {ledger.format_amount(totals['net'])}")
+    await context.bot.send_document(chat_id=update.effective_user.id,
+                                    document=payouts.result_file(rows, items, errors, balances),
+                                    filename="payout_results.csv", caption=caption)
+    return ConversationHandler.END
+
+# Refresh what is derived from the commands table after prompts were added, changed or deleted
+async def commands_changed(application: Application) -> None:
+    await asyncio.to_thread(menu.rebuild_help)
+    # Images no prompt uses any more
+    await asyncio.to_thread(media.collect_garbage, keep=conversation_images(application))
 
 # Conversation handlers for deleting a command
 async def delete_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -783,6 +1254,7 @@ async def delete_command_start(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("You are not authorized to perform this action.")
         return ConversationHandler.END
     await update.message.reply_text("Enter the command you want to delete:\n\nUse /cancel to cancel")
+    conversations.begin(context.user_data)
     return DELETE_COMMAND
 
 async def delete_command_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -802,6 +1274,7 @@ async def delete_command_finish(update: Update, context: ContextTypes.DEFAULT_TY
         db.delete(command)
         db.commit()
         await update.message.reply_text("Command deleted successfully.")
+        await commands_changed(context.application)
     else:
         await update.message.reply_text("Deletion cancelled.")
     return ConversationHandler.END
@@ -815,6 +1288,7 @@ async def add_admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("You are not authorized to perform this action.")
         return ConversationHandler.END
     await update.message.reply_text("Enter the Telegram ID of the new admin:\n\nUse /cancel to cancel")
+    conversations.begin(context.user_data)
     return ADD_ADMIN
 
 async def add_admin_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -834,6 +1308,7 @@ async def delete_admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("You are not authorized to perform this action.")
         return ConversationHandler.END
     await update.message.reply_text("Enter the Telegram ID of the admin to delete:\n\nUse /cancel to cancel")
+    conversations.begin(context.user_data)
     return DELETE_ADMIN_CONFIRMATION
 
 async def delete_admin_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -852,7 +1327,16 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text('Action Successfully cancelled')
     return ConversationHandler.END
 
+# Ends a conversation that got no reply for CONVERSATION_TIMEOUT seconds; images it uploaded are
+# deleted by the next sweep
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    conversations.clear(context.user_data)
+    if update.effective_chat:
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text=f"No reply for {CONVERSATION_TIMEOUT // 60} minutes, the action was cancelled.")
 
+
+@track_handler
 async def export_database(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     db: Session = next(get_db())
@@ -876,19 +1360,26 @@ async def export_database(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             sqlite_file = 'path/to/your/database.sqlite'
             await context.bot.send_document(chat_id=user.id, document=open(sqlite_file, 'rb'))
         else:
+            # pandas (and numpy/openpyxl through it) is only loaded when an export runs
+            import pandas as pd
+
             # Export database tables to CSV files
-            users_df = pd.read_sql_table('users', engine)
-            commands_df = pd.read_sql_table('commands', engine)
-            admins_df = pd.read_sql_table('admins', engine)
-            settings_df = pd.read_sql_table('settings', engine)
+            users_df = pd.read_sql_table('users', current_engine())
+            commands_df = pd.read_sql_table('commands', current_engine())
+            admins_df = pd.read_sql_table('admins', current_engine())
+            settings_df = pd.read_sql_table('settings', current_engine())
+            referrals_df = pd.read_sql_table('referrals', current_engine())
+            ledger_df = pd.read_sql_table('ledger_entries', current_engine())
 
             users_df.to_csv('users.csv', index=False)
             commands_df.to_csv('commands.csv', index=False)
             admins_df.to_csv('admins.csv', index=False)
             settings_df.to_csv('settings.csv', index=False)
+            referrals_df.to_csv('referrals.csv', index=False)
+            ledger_df.to_csv('ledger_entries.csv', index=False)
             
             if export_format == 'csv':
-                for file in ['users.csv', 'commands.csv', 'admins.csv', 'settings.csv']:
+                for file in ['users.csv', 'commands.csv', 'admins.csv', 'settings.csv', 'referrals.csv', 'ledger_entries.csv']:
                     await context.bot.send_document(chat_id=user.id, document=open(file, 'rb'))
                     os.remove(file)
                     
@@ -898,79 +1389,91 @@ async def export_database(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     commands_df.to_excel(writer, sheet_name='Commands', index=False)
                     admins_df.to_excel(writer, sheet_name='Admins', index=False)
                     settings_df.to_excel(writer, sheet_name='Settings', index=False)
+                    referrals_df.to_excel(writer, sheet_name='Referrals', index=False)
+                    ledger_df.to_excel(writer, sheet_name='Ledger', index=False)
 
                 await context.bot.send_document(chat_id=user.id, document=open('database.xlsx', 'rb'))
                 os.remove('database.xlsx')
                 
                 # Remove CSV files after creating the Excel file
-                for file in ['users.csv', 'commands.csv', 'admins.csv', 'settings.csv']:
+                for file in ['users.csv', 'commands.csv', 'admins.csv', 'settings.csv', 'referrals.csv', 'ledger_entries.csv']:
                     os.remove(file)
                     
     except Exception as e:
         await update.message.reply_text(f"Failed to export database: {e}")
 
-async def send_broadcast_message(context: CallbackContext, update: Update, message: str, photo_path: str = None, links: list = None) -> None:
-    db: Session = SessionLocal()
-    users = db.query(User).all()
-    total_users = len(users)
+# Send a broadcast, reporting progress to the admin who started it. Scheduled broadcasts run
+# from a job without an update and pass the admin's ID and yield_to_traffic=True instead.
+async def send_broadcast_message(context: CallbackContext, update: Update, message: str, photo_path: str = None, links: list = None, segment: dict = None, admin_id: int = None, yield_to_traffic: bool = False) -> None:
+    admin_id = admin_id or update.effective_user.id
+    media.hold(photo_path)
+    segment = segment or {}
+    # The audience is streamed in batches; the total shown in progress messages is the estimate
+    total_users, _ = await asyncio.to_thread(segments.estimate_audience, segment)
     success_count = 0
     failure_count = 0
+    started = time.perf_counter()
 
-    for index, user in enumerate(users, start=1):
+    for index, (telegram_id, first_name) in enumerate(segments.stream_audience(segment), start=1):
         try:
             if photo_path and links:
                 buttons = [InlineKeyboardButton(text=text, url=url) for text, url in links]
                 reply_markup = InlineKeyboardMarkup([[button] for button in buttons])
 
-                with open(photo_path, 'rb') as photo:
-                    await context.bot.send_photo(chat_id=user.telegram_id, photo=photo, caption=message, reply_markup=reply_markup)
+                await media.send_photo(context.bot.send_photo, photo_path, chat_id=telegram_id, caption=message, reply_markup=reply_markup)
             elif photo_path and not links:
-                with open(photo_path, 'rb') as photo:
-                    await context.bot.send_photo(chat_id=user.telegram_id, photo=photo, caption=message)
+                await media.send_photo(context.bot.send_photo, photo_path, chat_id=telegram_id, caption=message)
             elif links and not photo_path:
                 buttons = [InlineKeyboardButton(text=text, url=url) for text, url in links]
                 reply_markup = InlineKeyboardMarkup([[button] for button in buttons])
-                await context.bot.send_message(chat_id=user.telegram_id, text=message, reply_markup=reply_markup)
+                await context.bot.send_message(chat_id=telegram_id, text=message, reply_markup=reply_markup)
             else: 
-                await context.bot.send_message(chat_id=user.telegram_id, text=message)
+                await context.bot.send_message(chat_id=telegram_id, text=message)
 
             success_count += 1
         except Exception as e:
             failure_count += 1
+            logger.debug("Broadcast message to %s failed: %s", telegram_id, e)
+            if isinstance(e, Forbidden):
+                tenants.current().activity.unreachable(telegram_id)
         
         # Update admin with progress
         try:
             await context.bot.edit_message_text(
-                chat_id=update.effective_user.id,
+                chat_id=admin_id,
                 message_id=context.user_data['edit_message_id'],
-                text=f"Broadcast Progress: {index}/{total_users}\nCurrent User: {user.first_name}\nSuccess: {success_count}, Failure: {failure_count}"
+                text=f"Broadcast Progress: {index}/{max(total_users, index)}\nCurrent User: {first_name}\nSuccess: {success_count}, Failure: {failure_count}"
             )
         except Exception as e:
             try:
-                text=f"Broadcast Progress: {index}/{total_users}\nCurrent User: {user.first_name}\nSuccess: {success_count}, Failure: {failure_count}"
+                text=f"Broadcast Progress: {index}/{max(total_users, index)}\nCurrent User: {first_name}\nSuccess: {success_count}, Failure: {failure_count}"
                 broadcast_message = await context.bot.send_message(
-                    chat_id=update.effective_user.id, text=text
+                    chat_id=admin_id, text=text
                 )
                 context.user_data['edit_message_id'] = broadcast_message.message_id
             except Exception as e:
-                print(f"Error updating admin: {e}")
+                logger.warning("Error updating admin: %s", e)
         
-        await asyncio.sleep(1)  # Adjust sleep time as needed to manage API rate limits
+        # Scheduled broadcasts slow down while users are active so their replies keep the rate budget
+        if yield_to_traffic and tenants.current().activity.recent_rate() > BROADCAST_BUSY_RATE:
+            await asyncio.sleep(BROADCAST_BUSY_DELAY)
+        else:
+            await asyncio.sleep(BROADCAST_DELAY)  # Adjust BROADCAST_DELAY in config.py to manage API rate limits
 
-    db.close()
+    record_broadcast(success_count, failure_count, time.perf_counter() - started)
 
-    # Delete the image after broadcast if exists
-    if photo_path and os.path.exists(photo_path):
-        os.remove(photo_path)
+    # The image stays in the media store while a command uses it, otherwise GC removes it
+    media.release(photo_path)
+    await asyncio.to_thread(media.collect_garbage, keep=conversation_images(context.application))
 
     # Final message to admin after completion
     await context.bot.send_message(
-        chat_id=update.effective_user.id,
-        text=f"Broadcast completed. Total users: {total_users}\nSuccess: {success_count}, Failure: {failure_count}"
+        chat_id=admin_id,
+        text=f"Broadcast completed. Total users: {success_count + failure_count}\nSuccess: {success_count}, Failure: {failure_count}"
     )
 
 # Conversation states
-BROADCAST_MESSAGE, BROADCAST_IMAGE, BROADCAST_LINKS, BROADCAST_CONFIRM = range(4)
+BROADCAST_MESSAGE, BROADCAST_IMAGE, BROADCAST_LINKS, BROADCAST_CONFIRM, BROADCAST_SEGMENT = range(5)
 
 async def broadcast_start(update: Update, context: CallbackContext) -> int:
     user = update.effective_user
@@ -983,6 +1486,7 @@ async def broadcast_start(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     await update.message.reply_text("Please enter the message you want to broadcast.")
+    conversations.begin(context.user_data)
     return BROADCAST_MESSAGE
 
 async def broadcast_receive_message(update: Update, context: CallbackContext) -> int:
@@ -991,20 +1495,9 @@ async def broadcast_receive_message(update: Update, context: CallbackContext) ->
     return BROADCAST_IMAGE
 
 async def broadcast_receive_image(update: Update, context: CallbackContext) -> int:
-    # Get the largest available photo (last in the list)
-    photo = update.message.photo[-1]
-    file_id = photo.file_id
-
     try:
-        # Get the file object for the photo using file_id
-        photo_obj = await context.bot.get_file(file_id)
-
-        # Generate a unique filename for the image
-        image_id = str(uuid.uuid4())
-        file_path = f'/tmp/{image_id}.jpg'
-
-        # Download the photo to the specified file path using download_to_drive method
-        await photo_obj.download_to_drive(custom_path=file_path)  
+        # Save the photo to the media store; it is sent by file_id, so never uploaded again
+        file_path = await media.save_photo(context.bot, update.message.photo)
 
         # Store the image path in user_data for later use
         context.user_data['photo_path'] = file_path
@@ -1025,21 +1518,53 @@ async def broadcast_skip_image(update: Update, context: CallbackContext) -> int:
 async def broadcast_receive_links(update: Update, context: CallbackContext) -> int:
     links = update.message.text.split(';')
     context.user_data['links'] = [(text.strip(), url.strip()) for text, url in (link.split(',') for link in links)]
-    await update.message.reply_text(f"You are about to broadcast the following message:\n\n{context.user_data['message']}\n\nSend /confirm to proceed")
-    return BROADCAST_CONFIRM
+    return await broadcast_ask_segment(update, context)
 
 async def broadcast_skip_links(update: Update, context: CallbackContext) -> int:
-    await update.message.reply_text(f"You are about to broadcast the following message:\n\n{context.user_data['message']}\n\nSend /confirm to proceed")
+    return await broadcast_ask_segment(update, context)
+
+async def broadcast_ask_segment(update: Update, context: CallbackContext) -> int:
+    await update.message.reply_text("To send to part of the users only, send one or more filters, one per line:\n\n"
+                                    f"{segments.SEGMENT_HELP}\n\nor send /skip to send to all users.")
+    return BROADCAST_SEGMENT
+
+# Show the message and the estimated audience before /confirm
+async def broadcast_show_confirmation(update: Update, context: CallbackContext) -> int:
+    segment = context.user_data.get('segment', {})
+    try:
+        count, exact = await asyncio.to_thread(segments.estimate_audience, segment)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\nSend the filters again or /skip to send to all users.")
+        return BROADCAST_SEGMENT
+    audience = f"{count}" if exact else f"about {count}"
+    context.user_data['audience'] = count
+    await update.message.reply_text(f"You are about to broadcast the following message:\n\n{context.user_data['message']}\n\n"
+                                    f"Audience: {segments.describe_segment(segment)} ({audience} users)\n\n"
+                                    f"Send /confirm to proceed, or schedule it with {schedules.SCHEDULE_HELP} "
+                                    f"({schedules.SCHEDULE_TIMEZONE} time)")
     return BROADCAST_CONFIRM
 
+async def broadcast_receive_segment(update: Update, context: CallbackContext) -> int:
+    try:
+        context.user_data['segment'] = segments.parse_segment(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\nSend the filters again or /skip to send to all users.")
+        return BROADCAST_SEGMENT
+    return await broadcast_show_confirmation(update, context)
+
+async def broadcast_skip_segment(update: Update, context: CallbackContext) -> int:
+    context.user_data['segment'] = {}
+    return await broadcast_show_confirmation(update, context)
+
 async def broadcast_confirm(update: Update, context: CallbackContext) -> int:
     message = context.user_data.get('message')
     photo_path = context.user_data.get('photo_path')
     links = context.user_data.get('links')
+    segment = context.user_data.get('segment')
 
     if message:
         await context.bot.send_message(text="Broadcast started. You will be updated with the progress.", chat_id=update.effective_user.id)
-        task = asyncio.create_task(send_broadcast_message(context, update, message, photo_path, links))
+        task = asyncio.create_task(send_broadcast_message(context, update, message, photo_path, links, segment))
     else:
         await update.message.reply_text("No message found to broadcast.")
 
@@ -1048,6 +1573,139 @@ async def broadcast_confirm(update: Update, context: CallbackContext) -> int:
 
     return ConversationHandler.END
 
+# Save the broadcast for later instead of sending it now
+async def broadcast_schedule(update: Update, context: CallbackContext) -> int:
+    try:
+        send_at, recurrence, local_start = schedules.parse_schedule(context.args)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return BROADCAST_CONFIRM
+    if not context.user_data.get('message'):
+        await update.message.reply_text("No message found to broadcast.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    if context.job_queue is None:
+        await update.message.reply_text("Scheduling needs the job queue: pip install \"python-telegram-bot[job-queue]\"")
+        return BROADCAST_CONFIRM
+
+    db: Session = next(get_db())
+    seconds = schedules.estimate_seconds(context.user_data.get('audience', 0))
+    slot = schedules.find_slot(db, send_at, seconds)
+    item = ScheduledBroadcast(
+        created_by=update.effective_user.id,
+        message=context.user_data['message'],
+        photo_path=context.user_data.get('photo_path'),
+        links=context.user_data.get('links'),
+        segment=context.user_data.get('segment'),
+        send_at=slot,
+        recurrence=recurrence,
+        local_start=local_start if recurrence else None,
+        estimated_seconds=seconds,
+    )
+    db.add(item)
+    db.commit()
+    schedule_broadcast_job(context.job_queue, item)
+
+    note = "" if slot == send_at else f"\n\nMoved from {schedules.to_local(send_at)} so it doesn't overlap another scheduled broadcast."
+    await update.message.reply_text(f"🗓 Scheduled broadcast {schedules.describe(item)}{note}\n\nUse /scheduled to list and /unschedule <id> to cancel.")
+    context.user_data.clear()
+    return ConversationHandler.END
+
+def schedule_broadcast_job(job_queue, item: ScheduledBroadcast) -> None:
+    for job in job_queue.get_jobs_by_name(f"broadcast-{item.id}"):
+        job.schedule_removal()
+    # One-off broadcasts missed while the bot was down are sent now. APScheduler would drop a job
+    # whose run time passed more than misfire_grace_time ago, e.g. while the event loop stalled.
+    when = max(item.send_at, schedules.utc_now()).replace(tzinfo=timezone.utc)
+    job_queue.run_once(run_scheduled_broadcast, when=when, data=item.id,
+                       name=f"broadcast-{item.id}", chat_id=item.created_by, user_id=item.created_by,
+                       job_kwargs={"misfire_grace_time": None})
+
+# Job callback that sends a scheduled broadcast and queues its next run if it repeats
+async def run_scheduled_broadcast(context: CallbackContext) -> None:
+    db: Session = SessionLocal()
+    try:
+        item = db.get(ScheduledBroadcast, context.job.data)
+        if not item or item.status != "pending":
+            return
+        # Scheduled broadcasts of a bot run one at a time
+        async with tenants.current().broadcast_lock:
+            item.status = "running"
+            item.last_run_at = schedules.utc_now()
+            db.commit()
+            try:
+                await send_broadcast_message(context, None, item.message, item.photo_path, item.links, item.segment,
+                                             admin_id=item.created_by, yield_to_traffic=True)
+            finally:
+                db.refresh(item)
+                if item.status == "running" and item.recurrence:
+                    item.send_at = schedules.find_slot(db, schedules.next_run(item, schedules.utc_now()),
+                                                       item.estimated_seconds, exclude_id=item.id)
+                    item.status = "pending"
+                elif item.status == "running":
+                    item.status = "done"
+                db.commit()
+        if item.status == "pending":
+            schedule_broadcast_job(context.job_queue, item)
+    finally:
+        db.close()
+
+# Queue the jobs of pending scheduled broadcasts at startup. One-off broadcasts missed while
+# the bot was down are sent now; recurring ones continue at their next time.
+def restore_scheduled_broadcasts(job_queue) -> None:
+    db: Session = SessionLocal()
+    try:
+        now = schedules.utc_now()
+        # Broadcasts interrupted by a restart are not resent, to avoid messaging users twice
+        for item in db.query(ScheduledBroadcast).filter(ScheduledBroadcast.status == "running"):
+            item.status = "pending" if item.recurrence else "done"
+            if item.recurrence:
+                item.send_at = schedules.next_run(item, now)
+        db.commit()
+        for item in db.query(ScheduledBroadcast).filter(ScheduledBroadcast.status == "pending"):
+            if item.recurrence and item.send_at <= now:
+                item.send_at = schedules.next_run(item, now)
+            schedule_broadcast_job(job_queue, item)
+        db.commit()
+    finally:
+        db.close()
+
+async def scheduled_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    items = schedules.pending_broadcasts()
+    if not items:
+        await update.message.reply_text("No scheduled broadcasts.")
+        return
+    lines = "\n".join(schedules.describe(item) for item in items)
+    await update.message.reply_text(f"🗓 Scheduled broadcasts ({schedules.SCHEDULE_TIMEZONE}):\n\n{lines}\n\nUse /unschedule <id> to cancel.")
+
+async def unschedule_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    if len(context.args) != 1 or not context.args[0].lstrip('#').isdigit():
+        await update.message.reply_text("Usage: /unschedule <id>")
+        return
+    item = db.get(ScheduledBroadcast, int(context.args[0].lstrip('#')))
+    if not item or item.status not in ("pending", "running"):
+        await update.message.reply_text("No scheduled broadcast with that ID.")
+        return
+    # A running broadcast finishes its current run but is not repeated
+    item.status = "cancelled"
+    db.commit()
+    if context.job_queue:
+        for job in context.job_queue.get_jobs_by_name(f"broadcast-{item.id}"):
+            job.schedule_removal()
+    await update.message.reply_text(f"Scheduled broadcast #{item.id} cancelled.")
+
 async def broadcast_cancel(update: Update, context: CallbackContext) -> int:
     await update.message.reply_text("Broadcast canceled.")
     context.user_data.clear()
@@ -1058,6 +1716,7 @@ async def broadcast_error(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text("An error occurred during the broadcast process.")
 
 
+@track_handler
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     db: Session = next(get_db())
@@ -1067,19 +1726,122 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if not admin:
         await update.message.reply_text("You do not have permission to use this command.")
         return
-    with open('admin_help.json','r') as admin_cmds:
-        data = json.load(admin_cmds)
-    admin_commands = data
+    pages = menu.help_pages("admin_help")
+    await update.message.reply_text(pages[0], reply_markup=help_keyboard("admin_help", 0, len(pages)))
 
-    help_text = "👤 Admin Commands:\n\n"
-    for cmd in admin_commands:
-        help_text += f"{cmd['command']}: {cmd['description']}\nUsage: {cmd['usage']}\n\n"
-    
-    await update.message.reply_text(help_text)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+
+    # Check if the user is an admin
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+
+    await update.message.reply_text(render_summary())
+
+
+async def send_profile(context: CallbackContext, chat_id: int, seconds: float) -> None:
+    summary, report, collapsed = await profiler.profile_loop(seconds)
+    await context.bot.send_message(chat_id=chat_id, text=summary[:4096])
+    await context.bot.send_document(chat_id=chat_id, document=report.encode(), filename="profile.txt")
+    await context.bot.send_document(chat_id=chat_id, document=collapsed.encode(), filename="stacks.collapsed",
+                                    caption="Collapsed stacks for flamegraph.pl or speedscope")
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    db: Session = next(get_db())
+
+    # Check if the user is an admin
+    admin = db.query(Admin).filter(Admin.telegram_id == user.id).first()
+    if not admin:
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+
+    try:
+        seconds = float(context.args[0]) if context.args else 10.0
+    except ValueError:
+        await update.message.reply_text("Usage: /profile <seconds>")
+        return
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"Please choose between 1 and {PROFILE_MAX_SECONDS} seconds.")
+        return
+    if profiler.is_running():
+        await update.message.reply_text("A profile is already running, please wait for it to finish.")
+        return
+
+    await update.message.reply_text(f"🔬 Profiling the bot for {seconds:g} seconds...")
+    # Run in the background so updates keep flowing (and get profiled) meanwhile
+    asyncio.create_task(send_profile(context, user.id, seconds))
+
+
+# Start the services shared by every bot of the process: the local Prometheus endpoint and
+# the loop watchdog. Returns them for stop_services.
+async def start_services() -> dict:
+    services = {}
+    if METRICS_PORT:
+        services['metrics_server'] = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if SLOW_CALLBACK_THRESHOLD:
+        watchdog = profiler.LoopWatchdog(SLOW_CALLBACK_THRESHOLD)
+        watchdog.start()
+        services['loop_watchdog'] = watchdog
+    return services
+
+
+async def stop_services(services: dict) -> None:
+    server = services.get('metrics_server')
+    if server:
+        server.close()
+        await server.wait_closed()
+    if traffic_recorder:
+        await traffic_recorder.flush()
+    watchdog = services.get('loop_watchdog')
+    if watchdog:
+        watchdog.stop()
+
+
+# Start image GC, activity tracking and scheduled broadcasts once the application is
+# initialized, and the shared services when this is the only bot of the process
+async def post_init(application: Application) -> None:
+    await asyncio.to_thread(menu.rebuild_help)
+    # Clear out images left behind while the bot was down
+    asyncio.create_task(asyncio.to_thread(media.collect_garbage, keep=conversation_images(application)))
+    if tenants.current() is tenants.DEFAULT:
+        application.bot_data.update(await start_services())
+    tenants.current().activity.start()
+    tenants.current().outbox.start(application.bot)
+    tenants.current().usage.start()
+    if application.job_queue:
+        restore_scheduled_broadcasts(application.job_queue)
+        application.job_queue.run_repeating(snapshot_balances, interval=LEDGER_SNAPSHOT_SECONDS, first=60,
+                                            name="balance-snapshots")
+        application.job_queue.run_daily(growth_rollup, time=growth.ROLLUP_TIME, name="growth-rollup")
+        # Catch up on days that ended while the bot was down
+        application.job_queue.run_once(growth_rollup, when=60, name="growth-rollup-catch-up")
+        application.job_queue.run_repeating(sweep_conversations, interval=CONVERSATION_SWEEP_SECONDS,
+                                            first=CONVERSATION_SWEEP_SECONDS, name="conversation-sweep")
+
+
+async def post_shutdown(application: Application) -> None:
+    await stop_services(application.bot_data)
+    await tenants.current().activity.stop()
+    await tenants.current().outbox.stop()
+    await tenants.current().usage.stop()
 
 # Main function to start the bot
-def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).build()
+# Register every handler of the bot on the given application
+def add_handlers(application: Application) -> None:
+    # Record traffic before any other handler sees the update
+    if traffic_recorder:
+        application.add_handler(TypeHandler(Update, traffic_recorder.capture), group=-2)
+    # Only one handler runs per group, so each early handler gets its own
+    application.add_handler(TypeHandler(Update, tenants.current().activity.touch), group=-1)
+    # After the conversations, note when users with conversation state were last heard from
+    application.add_handler(TypeHandler(Update, conversations.stamp), group=1)
+    application.add_error_handler(log_error)
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -1093,17 +1855,32 @@ def main() -> None:
     application.add_handler(CommandHandler("remove_chat_group", remove_chat_group))
     application.add_handler(CommandHandler("strict_join", toggle_strict_join))
     application.add_handler(CommandHandler('deduct_ref_points', deduct_ref_points))
+    application.add_handler(CommandHandler("command_stats", command_stats))
+    application.add_handler(CommandHandler("find_user", find_user))
+    application.add_handler(CommandHandler("dashboard", dashboard))
+    application.add_handler(CommandHandler('ledger', ledger_command))
     application.add_handler(CommandHandler('export', export_database))
     application.add_handler(CommandHandler("admin_help", admin_help))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("scheduled", scheduled_broadcasts))
+    application.add_handler(CommandHandler("unschedule", unschedule_broadcast))
+    application.add_handler(CommandHandler("export_commands", export_commands))
     
     
     
 
 
+    # Conversation states survive restarts when the application has a persistence
+    persistent = application.persistence is not None
+    # Conversations left without a reply end after CONVERSATION_TIMEOUT (needs the job queue)
+    timed_out = [TypeHandler(Update, conversation_timeout)]
+
     # Conversation handlers for adding commands
     broadcast_handler = ConversationHandler(
         entry_points=[CommandHandler('broadcast', broadcast_start)],
         states={
+            ConversationHandler.TIMEOUT: timed_out,
             BROADCAST_MESSAGE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_receive_message),
                 CommandHandler('skip', broadcast_skip_image),
@@ -1116,18 +1893,27 @@ def main() -> None:
                 MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_receive_links),
                 CommandHandler('skip', broadcast_skip_links),
             ],
+            BROADCAST_SEGMENT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_receive_segment),
+                CommandHandler('skip', broadcast_skip_segment),
+            ],
             BROADCAST_CONFIRM: [
                 CommandHandler('confirm', broadcast_confirm),
+                CommandHandler('schedule', broadcast_schedule),
                 CommandHandler('cancel', broadcast_cancel),
             ],
         },
         fallbacks=[CommandHandler('cancel', broadcast_cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="broadcast",
+        persistent=persistent,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     add_command_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("addcommand", add_command_start)],
         states={
+            ConversationHandler.TIMEOUT: timed_out,
             ADD_COMMAND: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_command_description)],
             ADD_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_command_response)],
             ADD_RESPONSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_command_is_command)],
@@ -1149,12 +1935,16 @@ def main() -> None:
             CommandHandler("cancel", cancel),
             CommandHandler("start", start)
         ],
+        name="add_command",
+        persistent=persistent,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     # Conversation handlers for deleting commands
     delete_command_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("deletecommand", delete_command_start)],
         states={
+            ConversationHandler.TIMEOUT: timed_out,
             DELETE_COMMAND: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_command_confirmation)],
             DELETE_CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_command_finish)],
         },
@@ -1162,48 +1952,167 @@ def main() -> None:
             CommandHandler("cancel", cancel),
             CommandHandler("start", start)
         ],
+        name="delete_command",
+        persistent=persistent,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+    )
+
+    import_commands_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("import_commands", import_commands_start)],
+        states={
+            ConversationHandler.TIMEOUT: timed_out,
+            IMPORT_COMMANDS_FILE: [MessageHandler(filters.Document.ALL, import_commands_receive)],
+        },
+        fallbacks=[
+            CommandHandler("cancel", cancel),
+            CommandHandler("start", start)
+        ],
+        name="import_commands",
+        persistent=persistent,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+    )
+
+    bulk_payout_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("bulk_payout", bulk_payout_start)],
+        states={
+            ConversationHandler.TIMEOUT: timed_out,
+            PAYOUT_FILE: [MessageHandler(filters.Document.ALL, bulk_payout_receive)],
+            PAYOUT_CONFIRM: [CommandHandler("confirm", bulk_payout_confirm)],
+        },
+        fallbacks=[
+            CommandHandler("cancel", cancel),
+            CommandHandler("start", start)
+        ],
+        name="bulk_payout",
+        persistent=persistent,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     # Conversation handlers for managing admins
     add_admin_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("addadmin", add_admin_start)],
         states={
+            ConversationHandler.TIMEOUT: timed_out,
             ADD_ADMIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_admin_finish)],
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
             CommandHandler("start", start)
         ],
+        name="add_admin",
+        persistent=persistent,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     delete_admin_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("deleteadmin", delete_admin_start)],
         states={
+            ConversationHandler.TIMEOUT: timed_out,
             DELETE_ADMIN_CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_admin_finish)],
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
             CommandHandler("start", start)
         ],
+        name="delete_admin",
+        persistent=persistent,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     # Add conversation handlers to the application
     application.add_handler(add_command_conv_handler)
     application.add_handler(delete_command_conv_handler)
+    application.add_handler(import_commands_conv_handler)
+    application.add_handler(bulk_payout_conv_handler)
     application.add_handler(add_admin_conv_handler)
     application.add_handler(delete_admin_conv_handler)
     application.add_handler(broadcast_handler)
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CallbackQueryHandler(button_callback, pattern="check_membership"))
+    application.add_handler(CallbackQueryHandler(help_page_callback, pattern=r"^help:(help|admin_help):\d+$"))
+    application.add_handler(CallbackQueryHandler(find_user_callback, pattern=r"^find_user:(page|user):\d+$"))
     application.add_handler(MessageHandler(filters.COMMAND, command_handler))
     application.add_handler(MessageHandler(filters.TEXT, text_handler))
     # application.add_handler(MessageHandler(filters.ChatType.GROUP | filters.ChatType.CHANNEL | filters.ChatType.SUPERGROUP | filters.ChatType.PRIVATE & ~filters.COMMAND & ~filters.TEXT, forward_channel_message))
-    
-    
-    
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+
+# Build the application of the bot being served (see tenants.current()); base_url points it at
+# another Bot API server (e.g. mock_api.py), request lets several bots share one connection pool
+def build_application(base_url: str = None, request: InstrumentedRequest = None) -> Application:
+    builder = (
+        Application.builder()
+        .application_class(BotApplication)
+        .token(tenants.current().token)
+        .request(request or InstrumentedRequest())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .persistence(SQLitePersistence(update_interval=PERSISTENCE_INTERVAL, conversation_timeout=CONVERSATION_TIMEOUT))
+    )
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
+    add_handlers(application)
+    return application
+
+
+# Start one hosted bot. Runs as a task of its own so everything the application starts
+# inherits the tenant's context.
+async def start_tenant(tenant: tenants.Tenant, request: InstrumentedRequest) -> Application:
+    tenants.activate(tenant)
+    await asyncio.to_thread(init_db)
+    application = build_application(BOT_API_URL, request)
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling()
+    await application.start()
+    return application
+
+
+async def stop_tenant(tenant: tenants.Tenant, application: Application) -> None:
+    tenants.activate(tenant)
+    if application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+
+# Host every bot of TENANTS_FILE in this process. Each has its own Application, database and
+# image store; the event loop, the Bot API connection pool and metrics are shared.
+async def run_tenants(hosted: list) -> None:
+    request = tenants.SharedRequest(len(hosted))
+    services = await start_services()
+    running = []
+    try:
+        for tenant in hosted:
+            try:
+                running.append((tenant, await asyncio.create_task(start_tenant(tenant, request))))
+            except Exception:
+                logger.exception("Could not start bot '%s'", tenant.name)
+        logger.info("Serving %s of %s bots: %s", len(running), len(hosted), ", ".join(tenant.name for tenant, _ in running))
+        # Run until Ctrl-C cancels this task
+        await asyncio.Event().wait()
+    finally:
+        for tenant, application in running:
+            await asyncio.create_task(stop_tenant(tenant, application))
+        await stop_services(services)
+
+
+def main() -> None:
+    # Log records are formatted and written by a thread of their own
+    listener = logs.setup(LOG_FILE, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUPS, LOG_DEBUG_SAMPLE_RATE)
+    try:
+        if TENANTS_FILE:
+            asyncio.run(run_tenants(tenants.load_tenants(TENANTS_FILE)))
+            return
+        init_db()
+        application = build_application(BOT_API_URL)
+
+        # Run the bot until the user presses Ctrl-C
+        application.run_polling()
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,254 @@
+"""Offline benchmark of the bot handlers.
+
+Drives the real handlers through a real Application against the in-process
+FakeBotAPI, using a temporary SQLite database seeded with synthetic data.
+
+    python bench.py --users 100000 --updates 2000 --latency 0.05 --concurrency 8
+"""
+import argparse
+import asyncio
+from datetime import datetime
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+
+import config
+
+SCENARIOS = ["start", "start_new", "start_referral", "command", "text", "affiliate", "membership_gate", "broadcast"]
+BASE_TELEGRAM_ID = 10_000_000
+NEW_TELEGRAM_ID = 900_000_000
+ALPHABET = string.digits + string.ascii_letters
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the bot handlers against a fake Bot API.")
+    parser.add_argument("--users", type=int, default=10_000, help="Synthetic users to seed (e.g. 10000, 100000, 1000000)")
+    parser.add_argument("--commands", type=int, default=50, help="Synthetic command and text prompts to seed")
+    parser.add_argument("--updates", type=int, default=1000, help="Updates to send per scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated Bot API latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=1, help="Updates processed concurrently, like Application.concurrent_updates")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the synthetic data")
+    parser.add_argument("--keep-db", action="store_true", help="Keep the temporary database after the run")
+    return parser.parse_args()
+
+
+# Synthetic referral codes are 6 characters so they never collide with the 5 character codes handed out by /start
+def synthetic_referral_id(index: int) -> str:
+    code = ""
+    for _ in range(6):
+        index, digit = divmod(index, len(ALPHABET))
+        code += ALPHABET[digit]
+    return code
+
+
+def seed_database(models, users: int, commands: int, rng: random.Random) -> None:
+    from sqlalchemy import text
+
+    with models.engine.begin() as conn:
+        conn.execute(models.Settings.__table__.insert(), [{
+            "referral_earning": 1.0,
+            "downline_earning": 0.5,
+            "strict_join": False,
+            "chats_to_join": '[{"name": "news", "id": "-1001", "link": "https://t.me/news"}, '
+                             '{"name": "chat", "id": "-1002", "link": "https://t.me/chat"}]',
+        }])
+        conn.execute(models.Admin.__table__.insert(), [{"telegram_id": BASE_TELEGRAM_ID}])
+
+        rows = [
+            {"command": "start", "description": "Start", "response": "Welcome to the bot", "is_command": True,
+             "inline_links": [{"text": "Channel", "url": "https://t.me/news"}], "markup_buttons": ["🏠 Menu", "Help"]},
+            {"command": "affiliate", "description": "Affiliate", "response": "Invite friends and earn", "is_command": True,
+             "inline_links": None, "markup_buttons": None},
+        ]
+        for i in range(commands):
+            links = [{"text": f"Link {j}", "url": f"https://example.com/{i}/{j}"} for j in range(i % 4)]
+            buttons = [f"Button {j}" for j in range(i % 6)]
+            rows.append({"command": f"cmd_{i}", "description": f"Command {i}", "response": f"Response {i}",
+                         "is_command": True, "inline_links": links or None, "markup_buttons": buttons or None})
+            rows.append({"command": f"prompt {i}", "description": f"Prompt {i}", "response": f"Answer {i}",
+                         "is_command": False, "inline_links": links or None, "markup_buttons": buttons or None})
+        conn.execute(models.Command.__table__.insert(), rows)
+
+        chunk = []
+        for i in range(users):
+            referer = rng.randint(1, i) if i and rng.random() < 0.3 else None
+            balance = round(rng.random() * 10000)
+            chunk.append({
+                "telegram_id": BASE_TELEGRAM_ID + i,
+                "username": f"user{i}",
+                "first_name": f"First{i}",
+                "last_name": f"Last{i}",
+                "referral_id": synthetic_referral_id(i),
+                "referer_id": referer,
+                "created_at": datetime(2024, 6, 1, 12, 0, 0),
+                "earnings": balance / 100,
+                "balance": balance,
+                "downline_earnings": 0.0,
+                "total_earnings": 0.0,
+            })
+            if len(chunk) == 50_000:
+                conn.execute(models.User.__table__.insert(), chunk)
+                chunk = []
+        if chunk:
+            conn.execute(models.User.__table__.insert(), chunk)
+        conn.execute(text(
+            "INSERT INTO referrals (referrer_id, referee_id, created_at, credited) "
+            "SELECT referer_id, id, created_at, 1.0 FROM users WHERE referer_id IS NOT NULL"
+        ))
+        conn.execute(text(
+            "INSERT INTO ledger_entries (user_id, amount, reason, created_at) "
+            "SELECT id, balance, 'opening_balance', created_at FROM users WHERE balance != 0"
+        ))
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"First{user_id}", "username": f"u{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+# Yield (telegram_id, text) pairs for one scenario
+def scenario_messages(name: str, count: int, users: int, commands: int, rng: random.Random):
+    new_id = NEW_TELEGRAM_ID + rng.randint(0, 10_000_000)
+    for i in range(count):
+        existing = BASE_TELEGRAM_ID + rng.randrange(users)
+        if name == "start":
+            yield existing, "/start"
+        elif name == "start_new":
+            yield new_id + i, "/start"
+        elif name == "start_referral":
+            yield new_id + i, f"/start {synthetic_referral_id(rng.randrange(users))}"
+        elif name == "command":
+            yield existing, f"/cmd_{rng.randrange(commands)}"
+        elif name == "text":
+            yield existing, f"prompt {rng.randrange(commands)}"
+        elif name in ("affiliate", "membership_gate"):
+            yield existing, "/affiliate"
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))] if ordered else 0.0
+
+
+async def run_scenario(name, application, api, app, models, metrics, args, rng):
+    from telegram import Update
+    from telegram.ext import CallbackContext
+
+    errors = []
+    api.reset()
+    queries_before = metrics.db_queries_total
+
+    # A broadcast is one long call; rates and latencies are reported per recipient
+    if name == "broadcast":
+        update = Update.de_json(make_update(1, BASE_TELEGRAM_ID, "/broadcast"), application.bot)
+        context = CallbackContext.from_update(update, application)
+        failures_before = metrics.broadcast_messages['failure']
+        started = time.perf_counter()
+        await app.send_broadcast_message(context, update, "Benchmark broadcast")
+        per_user = (time.perf_counter() - started) / args.users
+        return {"updates": args.users, "rate": 1 / per_user, "p50": per_user, "p99": per_user,
+                "queries": (metrics.db_queries_total - queries_before) / args.users,
+                "api": sum(api.counts.values()) / args.users,
+                "errors": metrics.broadcast_messages['failure'] - failures_before}
+
+    if name == "membership_gate":
+        with models.engine.begin() as conn:
+            conn.execute(models.Settings.__table__.update().values(strict_join=True))
+
+    async def on_error(update, context):
+        errors.append(context.error)
+    application.add_error_handler(on_error)
+
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(update_id, user_id, text):
+        async with semaphore:
+            update = Update.de_json(make_update(update_id, user_id, text), application.bot)
+            start = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        process(i, user_id, text)
+        for i, (user_id, text) in enumerate(scenario_messages(name, args.updates, args.users, args.commands, rng))
+    ))
+    elapsed = time.perf_counter() - started
+    application.remove_error_handler(on_error)
+
+    if name == "membership_gate":
+        with models.engine.begin() as conn:
+            conn.execute(models.Settings.__table__.update().values(strict_join=False))
+
+    return {"updates": args.updates, "rate": args.updates / elapsed, "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99), "queries": (metrics.db_queries_total - queries_before) / args.updates,
+            "api": sum(api.counts.values()) / args.updates, "errors": len(errors)}
+
+
+async def run(args, app, models, metrics, rng) -> None:
+    from telegram.ext import Application
+    from fake_telegram import FakeBotAPI, FakeRequest, FAKE_BOT_ID
+
+    api = FakeBotAPI(latency=args.latency)
+    application = (
+        Application.builder()
+        .application_class(app.BotApplication)
+        .token(f"{FAKE_BOT_ID}:bench")
+        .request(FakeRequest(api))
+        .get_updates_request(FakeRequest(api))
+        .updater(None)
+        .build()
+    )
+    app.add_handlers(application)
+    await application.initialize()
+
+    print(f"{'scenario':<16}{'updates':>9}{'updates/s':>11}{'p50 ms':>9}{'p99 ms':>9}{'queries/upd':>13}{'api/upd':>9}{'errors':>8}")
+    for name in args.scenarios:
+        result = await run_scenario(name, application, api, app, models, metrics, args, rng)
+        print(f"{name:<16}{result['updates']:>9}{result['rate']:>11.1f}{result['p50'] * 1000:>9.2f}"
+              f"{result['p99'] * 1000:>9.2f}{result['queries']:>13.2f}{result['api']:>9.2f}{result['errors']:>8}")
+    await application.shutdown()
+
+
+def main() -> None:
+    args = parse_args()
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bot_bench_")
+
+    # Point the bot at the temporary database before models/app are imported
+    config.DATABASE_URL = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    config.BROADCAST_DELAY = 0
+    import models
+    import metrics
+    import app
+
+    models.init_db()
+    started = time.perf_counter()
+    seed_database(models, args.users, args.commands, rng)
+    print(f"Seeded {args.users} users and {args.commands * 2 + 2} prompts in {time.perf_counter() - started:.1f}s "
+          f"(latency {args.latency * 1000:.0f}ms, concurrency {args.concurrency})\n")
+
+    try:
+        asyncio.run(run(args, app, models, metrics, rng))
+    finally:
+        if args.keep_db:
+            print(f"\nDatabase kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Cold start benchmark.
+
+Starts fresh interpreters that import app, bootstrap the schema, initialize
+the application against the fake Bot API and handle one /start update, and
+reports how long each phase took. Exits with status 1 when the time to the
+first handled update exceeds the budget or a heavy module gets imported at
+startup, so it can guard against regressions:
+
+    python bench_startup.py --runs 5 --budget 1.0
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules that must only be loaded on demand (e.g. by /export)
+LAZY_MODULES = ["pandas", "numpy", "openpyxl"]
+
+CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+import config
+config.DATABASE_URL = sys.argv[1]
+config.METRICS_PORT = None
+config.SLOW_CALLBACK_THRESHOLD = None
+import app
+imported = time.perf_counter()
+import models
+models.init_db()
+bootstrapped = time.perf_counter()
+
+import asyncio
+from telegram import Update
+from telegram.ext import Application
+from bench import make_update
+from fake_telegram import FakeBotAPI, FakeRequest, FAKE_BOT_ID
+
+async def first_update():
+    api = FakeBotAPI()
+    application = (Application.builder().application_class(app.BotApplication).token(f"{FAKE_BOT_ID}:startup")
+                   .request(FakeRequest(api)).get_updates_request(FakeRequest(api)).updater(None).build())
+    app.add_handlers(application)
+    await application.initialize()
+    initialized = time.perf_counter()
+    await application.process_update(Update.de_json(make_update(1, 42, "/start"), application.bot))
+    return initialized
+
+initialized = asyncio.run(first_update())
+handled = time.perf_counter()
+print(json.dumps({
+    "import": imported - started, "bootstrap": bootstrapped - imported,
+    "initialize": initialized - bootstrapped, "first_update": handled - initialized,
+    "lazy_loaded": [name for name in sys.argv[2:] if name in sys.modules],
+}))
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure the bot's cold start time.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.0, help="Max seconds from process start to first handled update")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    here = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="bot_startup_")
+    database = f"sqlite:///{os.path.join(workdir, 'startup.db')}"
+
+    results = []
+    try:
+        for run in range(args.runs):
+            started = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", CHILD, database, *LAZY_MODULES], cwd=here,
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result["total"] = time.perf_counter() - started
+            results.append(result)
+            # The first run creates the schema, later ones find it already at the current version
+            print(f"run {run + 1}: total {result['total']:.3f}s  import {result['import']:.3f}s  "
+                  f"bootstrap {result['bootstrap']:.3f}s  initialize {result['initialize']:.3f}s  "
+                  f"first update {result['first_update']:.3f}s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    best = min(result["total"] for result in results)
+    lazy_loaded = sorted({name for result in results for name in result["lazy_loaded"]})
+    print(f"\nBest time to first handled update: {best:.3f}s (budget {args.budget:.3f}s)")
+    if lazy_loaded:
+        print(f"Heavy modules imported at startup: {', '.join(lazy_loaded)}")
+    if best > args.budget or lazy_loaded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
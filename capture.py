@@ -0,0 +1,88 @@
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+# Buffered records are written as one gzip member once either limit is reached
+FLUSH_RECORDS = 200
+FLUSH_SECONDS = 5.0
+NAME_FIELDS = ("first_name", "last_name", "username")
+
+
+# Stable pseudonym for a Telegram user ID; the same secret always gives the same mapping,
+# so conversations stay linked and a database copy can be mapped the same way
+def pseudo_id(telegram_id: int, secret: str) -> int:
+    digest = hmac.new(secret.encode(), str(telegram_id).encode(), hashlib.sha256).hexdigest()
+    return 1_000_000_000 + int(digest[:12], 16) % 8_000_000_000
+
+
+def _pseudo_name(field: str, value: str, secret: str) -> str:
+    digest = hmac.new(secret.encode(), f"{field}:{value}".encode(), hashlib.sha256).hexdigest()[:8]
+    return f"{field}_{digest}"
+
+
+# Replace user IDs and names in a serialized update; group and channel IDs (negative) are kept
+def pseudonymize(data, secret: str):
+    if isinstance(data, list):
+        return [pseudonymize(item, secret) for item in data]
+    if not isinstance(data, dict):
+        return data
+    is_user_or_chat = "is_bot" in data or ("type" in data and "id" in data)
+    result = {}
+    for key, value in data.items():
+        if is_user_or_chat and key == "id" and isinstance(value, int) and value > 0:
+            result[key] = pseudo_id(value, secret)
+        elif is_user_or_chat and key in NAME_FIELDS and value:
+            result[key] = _pseudo_name(key, value, secret)
+        elif key in ("user_id", "chat_id") and isinstance(value, int) and value > 0:
+            result[key] = pseudo_id(value, secret)
+        else:
+            result[key] = pseudonymize(value, secret)
+    return result
+
+
+# Records incoming updates, pseudonymized, to an append-only gzip file of JSON lines
+class TrafficRecorder:
+    def __init__(self, path: str, secret: str):
+        self.path = path
+        self.secret = secret
+        self._buffer = []
+        self._oldest = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # Handler for a TypeHandler(Update, ...) in an early group; never blocks other handlers
+    async def capture(self, update: Update, context: CallbackContext) -> None:
+        record = {"t": time.time(), "update": pseudonymize(update.to_dict(), self.secret)}
+        self._buffer.append(json.dumps(record, ensure_ascii=False))
+        if self._oldest is None:
+            self._oldest = record["t"]
+        if len(self._buffer) >= FLUSH_RECORDS or record["t"] - self._oldest >= FLUSH_SECONDS:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        lines, self._buffer, self._oldest = self._buffer, [], None
+        await asyncio.to_thread(self._write, lines)
+
+    def _write(self, lines: list) -> None:
+        # Each flush appends a complete gzip member, so a crash never corrupts earlier data
+        with gzip.open(self.path, "at", encoding="utf-8") as capture_file:
+            capture_file.write("\n".join(lines) + "\n")
+
+
+# Yield (timestamp, update dict) from a capture file
+def read_capture(path: str):
+    with gzip.open(path, "rt", encoding="utf-8") as capture_file:
+        for line in capture_file:
+            if line.strip():
+                record = json.loads(line)
+                yield record["t"], record["update"]
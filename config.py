@@ -4,3 +4,34 @@ BOT_TOKEN = "xxxxxxxxxxxxxxxxxxxxxxxxx
 ADMIN_ID = 1233125771  # Replace with the actual admin Telegram ID
 DATABASE_URL = "sqlite:///my_bot.db"
 SECRET_KEY = "thehackitect"
+METRICS_HOST = "127.0.0.1"  # Prometheus /metrics endpoint, local only
+METRICS_PORT = 9108  # Set to None to disable the endpoint
+BROADCAST_DELAY = 1  # Seconds to wait between broadcast messages
+BOT_API_URL = None  # e.g. "http://127.0.0.1:8081" to run against mock_api.py or a local Bot API server
+CAPTURE_FILE = None  # e.g. "captures/traffic.jsonl.gz" to record pseudonymized updates for replay.py
+PROFILE_MAX_SECONDS = 300  # Longest window /profile may run for
+SLOW_CALLBACK_THRESHOLD = 0.25  # Log the stack when the event loop is blocked longer than this (seconds), None to disable
+MEDIA_DIR = "images"  # Content-addressed store for command and broadcast images
+PHOTO_MAX_SIDE = 1280  # Images are stored at most this many pixels wide or high, the size Telegram shows photos at
+MEDIA_GC_GRACE = 3600  # Unreferenced images younger than this (seconds) are kept for conversations still in progress
+ACTIVITY_FLUSH_SECONDS = 5  # How often buffered last-seen times and profile changes are written to the database
+SCHEDULE_TIMEZONE = "UTC"  # Time zone of the times given to /schedule, e.g. "Africa/Lagos"
+BROADCAST_BUSY_RATE = 60  # Updates per minute above which scheduled broadcasts slow down for interactive traffic
+BROADCAST_BUSY_DELAY = 3  # Seconds between scheduled broadcast messages while the bot is busy
+PERSISTENCE_INTERVAL = 10  # Seconds between writes of changed conversation states and user_data/chat_data
+TENANTS_FILE = None  # e.g. "tenants.json" to host several bots in this process, see the readme
+EARNINGS_MINOR_UNITS = 100  # Balances are stored as whole numbers of 1/100; don't change it once the ledger has entries
+LEDGER_SNAPSHOT_SECONDS = 86400  # How often balances are snapshotted and checked against the ledger
+REFERRAL_DIGEST_SECONDS = 60  # Referral bonuses are announced to each referrer at most once per this many seconds
+OUTBOX_POLL_SECONDS = 1  # How often the outbox is checked for messages to send
+OUTBOX_BATCH_SIZE = 100  # Outbox messages read per batch
+OUTBOX_MAX_ATTEMPTS = 8  # Failed sends are retried with growing delays, then marked failed
+OUTBOX_RETENTION_DAYS = 7  # Sent and failed outbox messages are deleted after this many days
+USAGE_FLUSH_SECONDS = 10  # How often buffered prompt usage counts are added to the command_usage rollups
+CONVERSATION_TIMEOUT = 1800  # Conversations without a reply for this many seconds are cancelled and their state dropped
+CONVERSATION_SWEEP_SECONDS = 600  # How often idle conversation state and the images only it used are cleaned up
+LOG_FILE = None  # e.g. "logs/bot.jsonl" for JSON log lines in a rotated file, None for stderr
+LOG_LEVEL = "INFO"  # "DEBUG" adds a record per handled update with its latency
+LOG_MAX_BYTES = 10_000_000  # The log file is rotated at this size
+LOG_BACKUPS = 5  # Rotated log files kept
+LOG_DEBUG_SAMPLE_RATE = 100  # Only 1 in this many DEBUG records of each message is written
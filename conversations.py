@@ -0,0 +1,79 @@
+import json
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext, ConversationHandler
+
+# Keys of user_data that only matter while a conversation (or a /find_user search) is in
+# progress. Anything else, such as the progress message of a running broadcast, is left alone.
+SCRATCH_KEYS = (
+    "command", "description", "response", "is_command", "image_url", "inline_links", "markup_buttons",
+    "message", "photo_path", "links", "segment", "audience", "payout_file", "find_user",
+)
+# time.time() of the latest update of a user in a conversation or with scratch state
+STEP_AT = "conversation_at"
+
+
+def _size(value) -> int:
+    return len(json.dumps(value, default=str))
+
+
+def has_scratch(data: dict) -> bool:
+    return any(key in data for key in SCRATCH_KEYS)
+
+
+# Called by the entry points, so a conversation is timestamped before it has any scratch state
+def begin(data: dict) -> None:
+    data[STEP_AT] = time.time()
+
+
+# Whether the user's conversation or scratch state has been left alone longer than `timeout` seconds
+def idle(data: dict, timeout: float) -> bool:
+    return (STEP_AT in data or has_scratch(data)) and data.get(STEP_AT, 0) < time.time() - timeout
+
+
+# Remove the scratch state from a user's user_data and return its approximate size in bytes
+def clear(data: dict) -> int:
+    freed = 0
+    for key in SCRATCH_KEYS + (STEP_AT,):
+        if key in data:
+            freed += _size(data.pop(key))
+    return freed
+
+
+# Handler for a TypeHandler(Update, ...) in a group after the conversations: remembers when a user
+# in a conversation or with scratch state was last heard from. Never creates user_data for users
+# that have none.
+async def stamp(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    data = context.application.user_data.get(user.id) if user else None
+    if data and (STEP_AT in data or has_scratch(data)):
+        data[STEP_AT] = time.time()
+
+
+# End the conversations of users idle longer than `timeout` seconds, drop their scratch state,
+# and drop the user_data entries left empty. Conversations normally end through their
+# conversation_timeout, but PTB arms no timeout job for conversations restored after a restart,
+# so those are ended here, as are flows that ended without clearing their state.
+# Returns (users cleared, conversations ended, approximate bytes freed, empty entries dropped).
+def sweep(application, timeout: float):
+    cutoff = time.time() - timeout
+    cleared = ended = freed = dropped = 0
+    for group in application.handlers.values():
+        for handler in group:
+            if not isinstance(handler, ConversationHandler):
+                continue
+            # Keys are (chat_id, user_id); conversations with a timeout job are left to PTB
+            for key in list(handler._conversations):
+                data = application.user_data.get(key[-1], {})
+                if key not in handler.timeout_jobs and data.get(STEP_AT, 0) < cutoff:
+                    handler._update_state(ConversationHandler.END, key)
+                    ended += 1
+    for user_id, data in list(application.user_data.items()):
+        if idle(data, timeout):
+            freed += clear(data)
+            cleared += 1
+        if not data:
+            application.drop_user_data(user_id)
+            dropped += 1
+    return cleared, ended, freed, dropped
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+FAKE_BOT_ID = 777000
+FAKE_BOT_USERNAME = "fake_test_bot"
+
+
+# In-process stand-in for the Telegram Bot API: answers every method with a
+# well-formed result, records the calls and simulates API latency
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, member_status: str = "member"):
+        self.latency = latency
+        self.member_status = member_status
+        self.calls = []  # (method, params) in call order
+        self.counts = Counter()
+        self._message_id = 0
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.counts.clear()
+
+    def _message(self, chat_id, **fields) -> dict:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Fake Bot", "username": FAKE_BOT_USERNAME},
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+    # Build the result payload of one API method call
+    def handle(self, method: str, params: dict):
+        self.calls.append((method, params))
+        self.counts[method] += 1
+        if method == "getMe":
+            return {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Fake Bot", "username": FAKE_BOT_USERNAME,
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params.get("chat_id", 0), text=params.get("text"))
+        if method == "sendPhoto":
+            photo = [{"file_id": "fake_photo", "file_unique_id": "fake_photo", "width": 1280, "height": 720}]
+            return self._message(params["chat_id"], photo=photo, caption=params.get("caption"))
+        if method == "sendDocument":
+            document = {"file_id": "fake_document", "file_unique_id": "fake_document"}
+            return self._message(params["chat_id"], document=document)
+        if method == "forwardMessage":
+            return self._message(params["chat_id"], text="forwarded")
+        if method == "getChatMember":
+            return {"status": self.member_status,
+                    "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "Member"}}
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_path": "photos/fake.jpg"}
+        if method == "getUpdates":
+            return []
+        return True
+
+
+# Request class that routes Bot API calls to a FakeBotAPI instead of the network
+class FakeRequest(BaseRequest):
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        if self.api.latency:
+            await asyncio.sleep(self.api.latency)
+        if "/file/bot" in url:
+            return 200, b"\xff\xd8\xff\xd9"  # Minimal JPEG for file downloads
+        params = request_data.parameters if request_data else {}
+        result = self.api.handle(url.rsplit('/', 1)[-1], params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
@@ -0,0 +1,136 @@
+from datetime import date, datetime, time as day_time, timedelta, timezone
+
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import current_engine, DailyGrowth, DailyReferrer
+
+# When the nightly rollup closes the previous day
+ROLLUP_TIME = day_time(0, 5, tzinfo=timezone.utc)
+# Referrers listed on /dashboard
+TOP_REFERRERS = 5
+
+
+def utc_today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _day(value: date) -> str:
+    return value.strftime("%Y-%m-%d")
+
+
+# Add to today's counters in the caller's transaction
+def _add(db, table, keys: dict, **counts) -> None:
+    statement = sqlite_insert(table).values(**keys, **counts)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: getattr(table, name) + statement.excluded[name] for name in counts},
+    ))
+
+
+# Count a new user, in the transaction that creates them
+def record_signup(db, referrer_id: int = None) -> None:
+    today = _day(utc_today())
+    _add(db, DailyGrowth, {"day": today}, signups=1, referred_signups=1 if referrer_id else 0)
+    if referrer_id:
+        _add(db, DailyReferrer, {"day": today, "referrer_id": referrer_id}, signups=1)
+
+
+# Count ledger amounts (minor units), in the transaction that posts them
+def record_ledger(db, amounts) -> None:
+    credited = sum(amount for amount in amounts if amount > 0)
+    debited = -sum(amount for amount in amounts if amount < 0)
+    if credited or debited:
+        _add(db, DailyGrowth, {"day": _day(utc_today())}, credited=credited, debited=debited)
+
+
+# Close every day up to yesterday that isn't closed yet: recount its signups and referral
+# sources from users (by the created_at index, one day at a time) and write its end-of-day
+# totals. On the first run this fills in every day since the first user. Returns the number of
+# days closed. Blocking.
+def rollup() -> int:
+    today = utc_today()
+    with current_engine().begin() as conn:
+        last_closed = conn.execute(text("SELECT MAX(day) FROM daily_growth WHERE users_total IS NOT NULL")).scalar()
+        if last_closed:
+            first = date.fromisoformat(last_closed) + timedelta(days=1)
+        else:
+            oldest = conn.execute(text("SELECT MIN(created_at) FROM users")).scalar()
+            first = date.fromisoformat(str(oldest)[:10]) if oldest else today - timedelta(days=1)
+        if first >= today:
+            return 0
+
+        # Totals at the end of yesterday: today's changes so far are taken off the current totals
+        today_start = f"{_day(today)} 00:00:00"
+        users_total = conn.execute(text("SELECT COUNT(*) FROM users")).scalar() - conn.execute(
+            text("SELECT COUNT(*) FROM users WHERE created_at >= :start"), {"start": today_start}).scalar()
+        today_net = conn.execute(text("SELECT credited - debited FROM daily_growth WHERE day = :day"),
+                                 {"day": _day(today)}).scalar() or 0
+        liabilities = conn.execute(text("SELECT COALESCE(SUM(balance), 0) FROM users")).scalar() - today_net
+        unreachable = conn.execute(text("SELECT COUNT(*) FROM users WHERE unreachable_at IS NOT NULL")).scalar()
+
+        # Newest day first, so each day's total is the next day's total minus that day's signups
+        day = today - timedelta(days=1)
+        while day >= first:
+            window = {"start": f"{_day(day)} 00:00:00", "end": f"{_day(day + timedelta(days=1))} 00:00:00",
+                      "day": _day(day)}
+            signups, referred = conn.execute(text(
+                "SELECT COUNT(*), COUNT(referer_id) FROM users WHERE created_at >= :start AND created_at < :end"
+            ), window).one()
+            conn.execute(text("DELETE FROM daily_referrers WHERE day = :day"), window)
+            conn.execute(text("""
+                INSERT INTO daily_referrers (day, referrer_id, signups)
+                SELECT :day, referer_id, COUNT(*) FROM users
+                WHERE created_at >= :start AND created_at < :end AND referer_id IS NOT NULL
+                GROUP BY referer_id
+            """), window)
+            newest = day == today - timedelta(days=1)
+            conn.execute(text("""
+                INSERT INTO daily_growth (day, signups, referred_signups, users_total, unreachable_total, liabilities)
+                VALUES (:day, :signups, :referred, :users_total, :unreachable, :liabilities)
+                ON CONFLICT (day) DO UPDATE SET signups = excluded.signups, referred_signups = excluded.referred_signups,
+                    users_total = excluded.users_total, unreachable_total = excluded.unreachable_total,
+                    liabilities = excluded.liabilities
+            """), dict(window, signups=signups, referred=referred, users_total=users_total,
+                       unreachable=unreachable if newest else None, liabilities=liabilities if newest else None))
+            users_total -= signups
+            day -= timedelta(days=1)
+    return (today - first).days
+
+
+# Figures for /dashboard from at most 35 rows of daily_growth and the referral sources of the
+# last 30 days, whatever the size of users. Blocking.
+def dashboard() -> dict:
+    today = utc_today()
+    since = _day(today - timedelta(days=34))
+    with current_engine().connect() as conn:
+        rows = {row.day: row for row in conn.execute(
+            text("SELECT * FROM daily_growth WHERE day >= :since ORDER BY day"), {"since": since})}
+        closed = conn.execute(text(
+            "SELECT * FROM daily_growth WHERE users_total IS NOT NULL ORDER BY day DESC LIMIT 1")).first()
+        top = conn.execute(text("""
+            SELECT u.telegram_id, u.username, SUM(r.signups) AS signups
+            FROM daily_referrers r JOIN users u ON u.id = r.referrer_id
+            WHERE r.day >= :since GROUP BY r.referrer_id ORDER BY signups DESC LIMIT :limit
+        """), {"since": _day(today - timedelta(days=29)), "limit": TOP_REFERRERS}).all()
+
+    def total(field: str, days: int, end: date = today) -> int:
+        return sum(getattr(rows[key], field) for key in (_day(end - timedelta(days=n)) for n in range(days))
+                   if key in rows)
+
+    figures = {
+        "today": total("signups", 1),
+        "yesterday": total("signups", 1, today - timedelta(days=1)),
+        "weeks": [total("signups", 7, today - timedelta(days=7 * week)) for week in range(4)],
+        "conversion_7": (total("referred_signups", 7), total("signups", 7)),
+        "conversion_30": (total("referred_signups", 30), total("signups", 30)),
+        "top_referrers": [tuple(row) for row in top],
+        "closed": closed.day if closed else None,
+    }
+    if closed:
+        after = [row for day, row in rows.items() if day > closed.day]
+        figures["users"] = closed.users_total + sum(row.signups for row in after)
+        figures["unreachable"] = (closed.unreachable_total, closed.users_total)
+        if closed.liabilities is not None:
+            figures["liabilities"] = closed.liabilities + sum(row.credited - row.debited for row in after)
+    return figures
@@ -0,0 +1,127 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import bindparam, func, insert, select, text, update as sql_update
+from sqlalchemy.orm.util import identity_key
+
+import growth
+from config import EARNINGS_MINOR_UNITS
+from models import current_engine, User, LedgerEntry, BalanceSnapshot
+
+# Reasons recorded with ledger entries
+OPENING_BALANCE = "opening_balance"  # Earnings from before the ledger, written by migration 0009
+REFERRAL_BONUS = "referral_bonus"
+DEDUCTION = "deduction"
+ADJUSTMENT = "adjustment"  # Credit from a bulk payout file
+PAYOUT = "payout"  # Debit from a bulk payout file
+
+CENT = Decimal(1) / EARNINGS_MINOR_UNITS
+
+
+# Amount in whole units (e.g. a setting like 0.5) -> integer minor units
+def to_minor(amount) -> int:
+    return int((Decimal(str(amount)) * EARNINGS_MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def format_amount(minor: int) -> str:
+    return str((Decimal(minor or 0) / EARNINGS_MINOR_UNITS).quantize(CENT))
+
+
+# Append a ledger entry and move the user's cached balance by the same amount, both in the
+# caller's transaction (the caller commits). The balance is changed with an SQL expression,
+# so concurrent postings never overwrite each other.
+def post(db, user_id: int, amount: int, reason: str, reference: str = None) -> LedgerEntry:
+    entry = LedgerEntry(user_id=user_id, amount=amount, reason=reason, reference=reference)
+    db.add(entry)
+    db.execute(
+        sql_update(User).where(User.id == user_id)
+        .values(balance=User.balance + amount, earnings=(User.balance + amount) * 1.0 / EARNINGS_MINOR_UNITS)
+        .execution_options(synchronize_session=False)
+    )
+    # A loaded User reads its new balance on next access; its other pending changes are kept
+    growth.record_ledger(db, [amount])
+    user = db.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        db.expire(user, ["balance", "earnings"])
+    return entry
+
+
+# post() for many entries at once: one multi-row INSERT of the entries and one batched UPDATE
+# of the balances, in the caller's transaction. `entries` are dicts of LedgerEntry fields.
+def post_many(db, entries: list) -> None:
+    if not entries:
+        return
+    totals = {}
+    for entry in entries:
+        totals[entry["user_id"]] = totals.get(entry["user_id"], 0) + entry["amount"]
+    conn = db.connection()
+    conn.execute(insert(LedgerEntry.__table__), entries)
+    users = User.__table__
+    new_balance = users.c.balance + bindparam("b_amount")
+    conn.execute(
+        sql_update(users).where(users.c.id == bindparam("b_user_id"))
+        .values(balance=new_balance, earnings=new_balance * 1.0 / EARNINGS_MINOR_UNITS),
+        [{"b_user_id": user_id, "b_amount": amount} for user_id, amount in totals.items()],
+    )
+    growth.record_ledger(conn, [entry["amount"] for entry in entries])
+    for user_id in totals:
+        user = db.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            db.expire(user, ["balance", "earnings"])
+
+
+# The user's current balance, with the row locked for the rest of the transaction (a no-op write
+# takes SQLite's write lock), for postings that depend on the balance such as capped deductions
+def balance_for_update(db, user_id: int) -> int:
+    db.execute(sql_update(User).where(User.id == user_id).values(balance=User.balance)
+               .execution_options(synchronize_session=False))
+    return db.execute(select(User.balance).where(User.id == user_id)).scalar() or 0
+
+
+# Balance from the ledger after the last entry at or before `when` (naive UTC), starting from
+# the latest snapshot before it rather than summing the user's whole history
+def balance_at(db, user_id: int, when=None) -> int:
+    last = select(func.max(LedgerEntry.id)).where(LedgerEntry.user_id == user_id)
+    if when is not None:
+        last = last.where(LedgerEntry.created_at <= when)
+    last_id = db.execute(last).scalar()
+    if last_id is None:
+        return 0
+    snapshot = db.execute(
+        select(BalanceSnapshot.entry_id, BalanceSnapshot.balance)
+        .where(BalanceSnapshot.user_id == user_id, BalanceSnapshot.entry_id <= last_id)
+        .order_by(BalanceSnapshot.entry_id.desc()).limit(1)
+    ).first()
+    since_id, balance = snapshot if snapshot else (0, 0)
+    return balance + db.execute(
+        select(func.coalesce(func.sum(LedgerEntry.amount), 0))
+        .where(LedgerEntry.user_id == user_id, LedgerEntry.id > since_id, LedgerEntry.id <= last_id)
+    ).scalar()
+
+
+def recent_entries(db, user_id: int, limit: int = 10) -> list:
+    return db.query(LedgerEntry).filter(LedgerEntry.user_id == user_id) \
+        .order_by(LedgerEntry.id.desc()).limit(limit).all()
+
+
+# Snapshot the balance of every user with ledger entries since the last run, then compare those
+# balances with the cached users.balance. Every run covers all entries up to then, so only
+# entries after the newest snapshot are read. Returns (users snapshotted, mismatches) where
+# mismatches are (telegram_id, cached balance, ledger balance). Blocking.
+def take_snapshots():
+    with current_engine().begin() as conn:
+        since = conn.execute(text("SELECT COALESCE(MAX(entry_id), 0) FROM balance_snapshots")).scalar()
+        snapshotted = conn.execute(text("""
+            INSERT INTO balance_snapshots (user_id, entry_id, balance, created_at)
+            SELECT e.user_id, MAX(e.id), COALESCE(s.balance, 0) + SUM(e.amount), CURRENT_TIMESTAMP
+            FROM ledger_entries e
+            LEFT JOIN balance_snapshots s ON s.user_id = e.user_id AND s.entry_id = (
+                SELECT MAX(entry_id) FROM balance_snapshots WHERE user_id = e.user_id)
+            WHERE e.id > :since
+            GROUP BY e.user_id
+        """), {"since": since}).rowcount
+        # Nothing else can write until this transaction ends, so cached balances must match
+        mismatches = conn.execute(text("""
+            SELECT u.telegram_id, u.balance, s.balance FROM balance_snapshots s JOIN users u ON u.id = s.user_id
+            WHERE s.entry_id > :since AND u.balance != s.balance
+        """), {"since": since}).all()
+    return snapshotted, [tuple(row) for row in mismatches]
@@ -0,0 +1,207 @@
+"""End to end load generator.
+
+Starts mock_api.MockBotAPIServer, feeds it a generated or scripted update
+stream and runs the full bot application against it (the same handlers,
+request class and lifecycle hooks as main()), then reports throughput,
+reply latency, flood control hits and API usage.
+
+    python loadgen.py --rate 50 --duration 120 --users 100000 --latency 0.05 --error-rate 0.01
+
+With --serve-only only the mock server and traffic run; start the bot
+separately with BOT_API_URL = "http://127.0.0.1:8081" in config.py.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import config
+from bench import make_update, seed_database, percentile, NEW_TELEGRAM_ID
+
+# Share of each kind of message in generated traffic
+TRAFFIC_MIX = [("start", 20), ("start_referral", 10), ("affiliate", 10), ("help", 5), ("command", 30), ("text", 25)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Soak test the bot against a local mock Bot API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rate", type=float, default=20, help="Updates per second")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of traffic to send")
+    parser.add_argument("--users", type=int, default=10_000, help="Users to seed into the temporary database")
+    parser.add_argument("--script", help="JSON lines file of updates or {\"user_id\", \"text\", \"delay\"} objects")
+    parser.add_argument("--loop", action="store_true", help="Repeat the script until --duration is over")
+    parser.add_argument("--database", help="Use this database URL instead of a temporary seeded one")
+    parser.add_argument("--latency", type=float, default=0.0, help="Bot API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of send calls that fail")
+    parser.add_argument("--no-flood-control", action="store_true", help="Never answer with 429")
+    parser.add_argument("--global-rate", type=float, default=30, help="Messages per second allowed per bot")
+    parser.add_argument("--chat-rate", type=float, default=1, help="Messages per second allowed per chat")
+    parser.add_argument("--chat-burst", type=float, default=3, help="Burst of messages allowed per chat")
+    parser.add_argument("--webhook-port", type=int, help="Receive updates by webhook on this port instead of polling")
+    parser.add_argument("--serve-only", action="store_true", help="Only run the mock server and the traffic")
+    return parser.parse_args()
+
+
+# Load what the generated traffic needs from the database: prompts, referral codes and user IDs
+def load_traffic_data(models) -> dict:
+    db = models.SessionLocal()
+    try:
+        commands = db.query(models.Command.command, models.Command.is_command).all()
+        users = db.query(models.User.telegram_id, models.User.referral_id).limit(10_000).all()
+    finally:
+        db.close()
+    return {
+        "commands": [command for command, is_command in commands if is_command] or ["help"],
+        "texts": [command for command, is_command in commands if not is_command] or ["hello"],
+        "user_ids": [telegram_id for telegram_id, _ in users] or [NEW_TELEGRAM_ID],
+        "referral_ids": [referral_id for _, referral_id in users if referral_id] or ["none"],
+    }
+
+
+def generated_messages(data: dict, rng: random.Random):
+    kinds = [kind for kind, _ in TRAFFIC_MIX]
+    weights = [weight for _, weight in TRAFFIC_MIX]
+    new_id = NEW_TELEGRAM_ID
+    while True:
+        kind = rng.choices(kinds, weights)[0]
+        user_id = rng.choice(data["user_ids"])
+        if kind == "start":
+            yield user_id, "/start", None
+        elif kind == "start_referral":
+            new_id += 1
+            yield new_id, f"/start {rng.choice(data['referral_ids'])}", None
+        elif kind == "affiliate":
+            yield user_id, "/affiliate", None
+        elif kind == "help":
+            yield user_id, "/help", None
+        elif kind == "command":
+            yield user_id, f"/{rng.choice(data['commands'])}", None
+        else:
+            yield user_id, rng.choice(data["texts"]), None
+
+
+def scripted_messages(path: str, loop: bool):
+    while True:
+        with open(path) as script:
+            for line in script:
+                if line.strip():
+                    entry = json.loads(line)
+                    if "message" in entry or "callback_query" in entry:
+                        yield entry, None, entry.get("delay")
+                    else:
+                        yield entry["user_id"], entry["text"], entry.get("delay")
+        if not loop:
+            return
+
+
+async def feed_updates(server, messages, rate: float, duration: float) -> None:
+    interval = 1 / rate
+    started = time.monotonic()
+    next_send = started
+    for index, (user_id, text, delay) in enumerate(messages):
+        if time.monotonic() - started >= duration:
+            break
+        next_send = next_send + delay if delay is not None else next_send + interval
+        await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        update = user_id if isinstance(user_id, dict) else make_update(index, user_id, text)
+        await server.push_update(update)
+
+
+def report(server, elapsed: float) -> None:
+    stats = server.stats
+    latencies = server.response_latencies
+    print(f"\nUpdates pushed: {stats['updates_pushed']}, delivered: {stats['updates_delivered']} "
+          f"({stats['updates_delivered'] / elapsed:.1f}/s)")
+    print(f"Reply latency: p50 {percentile(latencies, 0.5) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms "
+          f"over {len(latencies)} replies")
+    print(f"429 responses: {stats['429']}, injected errors: {stats['injected_errors']}, "
+          f"webhook errors: {stats['webhook_errors']}")
+    print("API calls:")
+    for key, count in sorted(stats.items()):
+        if key.startswith("calls."):
+            print(f"  {key[6:]}: {count}")
+
+
+async def run(args, models, app) -> None:
+    from mock_api import MockBotAPIServer
+
+    server = MockBotAPIServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        global_rate=args.global_rate, chat_rate=args.chat_rate, chat_burst=args.chat_burst,
+        flood_control=not args.no_flood_control,
+    )
+    await server.start()
+    print(f"Mock Bot API listening on {server.base_url}")
+
+    application = None
+    if app:
+        application = app.build_application(server.base_url)
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        if args.webhook_port:
+            await application.updater.start_webhook(
+                listen=args.host, port=args.webhook_port, url_path="webhook",
+                webhook_url=f"http://{args.host}:{args.webhook_port}/webhook",
+            )
+        else:
+            await application.updater.start_polling()
+        await application.start()
+
+    if args.script:
+        messages = scripted_messages(args.script, args.loop)
+    else:
+        messages = generated_messages(load_traffic_data(models), random.Random(0))
+
+    started = time.monotonic()
+    try:
+        await feed_updates(server, messages, args.rate, args.duration)
+        # Give the bot a moment to work through what is still queued
+        await asyncio.sleep(2)
+    finally:
+        elapsed = time.monotonic() - started
+        if application:
+            await application.updater.stop()
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+            await application.shutdown()
+        await server.stop()
+    report(server, elapsed)
+    if app:
+        print("\n" + app.render_summary())
+
+
+def main() -> None:
+    args = parse_args()
+    workdir = None
+    if args.database:
+        config.DATABASE_URL = args.database
+    elif not args.serve_only:
+        # Never write load test users into the real database
+        workdir = tempfile.mkdtemp(prefix="bot_loadgen_")
+        config.DATABASE_URL = f"sqlite:///{os.path.join(workdir, 'loadgen.db')}"
+    import models
+    models.init_db()
+
+    app = None
+    if not args.serve_only:
+        import app
+        if workdir:
+            seed_database(models, args.users, 50, random.Random(0))
+
+    try:
+        asyncio.run(run(args, models, app))
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from collections import defaultdict
+from datetime import datetime, timezone
+
+# Fields of the update being handled, added to every record logged while handling it
+_context = contextvars.ContextVar('log_context', default={})
+
+# LogRecord attributes that aren't extra fields
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+# Add fields (update_id, user_id, handler, ...) to the records logged by this task and the
+# tasks it starts; returns a token for reset()
+def bind(**fields):
+    return _context.set({**_context.get(), **fields})
+
+
+def reset(token) -> None:
+    _context.reset(token)
+
+
+# One JSON object per line: time, level, logger, message, the update's fields, extra fields
+# and the traceback
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _STANDARD)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+# Copies the update's fields onto the record. Runs in the logging task, before the record is
+# queued, since the listener thread can't see the task's context.
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+# Keeps 1 in `rate` DEBUG records of each message, so per-update debug events can stay on in
+# production. Kept records say how many they stand for.
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self._seen = defaultdict(int)  # (logger, message template) -> records
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate <= 1:
+            return True
+        key = (record.name, record.msg)
+        self._seen[key] += 1
+        if self._seen[key] % self.rate != 1:
+            return False
+        record.sampled = self.rate
+        return True
+
+
+# Only what can't wait is done before queueing: the message and traceback become text, since
+# the arguments may change before the listener formats the record
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Send every log record through a queue to a thread that formats it as JSON and writes it to
+# `path`, rotated at `max_bytes` with `backups` old files, or to stderr without a path. Returns
+# the started QueueListener; stop it on exit to write what is still queued.
+def setup(path: str = None, level: str = "INFO", max_bytes: int = 10_000_000, backups: int = 5,
+          debug_sample_rate: int = 100) -> logging.handlers.QueueListener:
+    if path:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        output = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                      encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(SamplingFilter(debug_sample_rate))
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import io
+import os
+import re
+import time
+from collections import Counter
+
+from telegram.error import BadRequest
+
+import tenants
+from config import PHOTO_MAX_SIDE, MEDIA_GC_GRACE
+from models import SessionLocal, Command, MediaFile, ScheduledBroadcast
+
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+# Images used by broadcasts that are still running, kept by collect_garbage
+_pending = Counter()
+
+
+# The image store of the bot being served (MEDIA_DIR unless several bots are hosted)
+def media_dir() -> str:
+    return tenants.current().media_dir
+
+
+# sha256 -> Telegram file_id (None when the image was never sent yet) of the bot being served
+def _file_ids() -> dict:
+    return tenants.current().file_ids
+
+
+def media_path(digest: str) -> str:
+    return os.path.join(media_dir(), f"{digest}.jpg")
+
+
+# The sha256 of a path inside the store, None for anything else (URLs, file_ids, old paths)
+def digest_of(image: str):
+    if not image or os.path.dirname(os.path.normpath(image)) != os.path.normpath(media_dir()):
+        return None
+    digest = os.path.splitext(os.path.basename(image))[0]
+    return digest if DIGEST.match(digest) else None
+
+
+# Pick the largest of Telegram's pre-sized versions of a photo that fits PHOTO_MAX_SIDE
+def pick_photo_size(photo_sizes):
+    fitting = [size for size in photo_sizes if max(size.width, size.height) <= PHOTO_MAX_SIDE]
+    return fitting[-1] if fitting else photo_sizes[0]
+
+
+# Downscale and recompress images larger than Telegram displays them. Pillow is optional;
+# without it (or for anything it can't read) the data is stored unchanged.
+def fit_for_telegram(data: bytes) -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= PHOTO_MAX_SIDE and image.format == "JPEG":
+                return data
+            image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+            output = io.BytesIO()
+            image.convert("RGB").save(output, "JPEG", quality=85, optimize=True)
+    except OSError:
+        return data
+    return output.getvalue() if output.tell() < len(data) else data
+
+
+# Store image bytes under their content hash and return the path. Uploading the same
+# image again returns the existing file. Blocking, run it with asyncio.to_thread.
+def store_bytes(data: bytes, file_id: str = None) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    path = media_path(digest)
+    if os.path.exists(path):
+        # Restart the GC grace period for images that are being reused
+        os.utime(path)
+    else:
+        os.makedirs(media_dir(), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as image_file:
+            image_file.write(fit_for_telegram(data))
+        os.replace(temp_path, path)
+
+    db = SessionLocal()
+    try:
+        media = db.query(MediaFile).filter_by(sha256=digest).first()
+        if not media:
+            media = MediaFile(sha256=digest)
+            db.add(media)
+        media.size = os.path.getsize(path)
+        if file_id and not media.file_id:
+            media.file_id = file_id
+        db.commit()
+        _file_ids()[digest] = media.file_id
+    finally:
+        db.close()
+    return path
+
+
+# Download the photo of a message into the store. The photo's file_id is remembered,
+# so sending it later never uploads the file.
+async def save_photo(bot, photo_sizes) -> str:
+    photo = pick_photo_size(photo_sizes)
+    telegram_file = await bot.get_file(photo.file_id)
+    data = bytes(await telegram_file.download_as_bytearray())
+    return await asyncio.to_thread(store_bytes, data, photo.file_id)
+
+
+def cached_file_id(digest: str):
+    file_ids = _file_ids()
+    if digest not in file_ids:
+        db = SessionLocal()
+        try:
+            file_ids[digest] = db.query(MediaFile.file_id).filter_by(sha256=digest).scalar()
+        finally:
+            db.close()
+    return file_ids[digest]
+
+
+def remember_file_id(image: str, message) -> None:
+    digest = digest_of(image)
+    if not digest or not message or not message.photo or cached_file_id(digest):
+        return
+    file_id = message.photo[-1].file_id
+    db = SessionLocal()
+    try:
+        db.query(MediaFile).filter_by(sha256=digest).update({MediaFile.file_id: file_id})
+        db.commit()
+    finally:
+        db.close()
+    _file_ids()[digest] = file_id
+
+
+def forget_file_id(image: str) -> None:
+    digest = digest_of(image)
+    if digest:
+        db = SessionLocal()
+        try:
+            db.query(MediaFile).filter_by(sha256=digest).update({MediaFile.file_id: None})
+            db.commit()
+        finally:
+            db.close()
+        _file_ids()[digest] = None
+
+
+# What to pass as `photo`: the file_id once Telegram has the image, otherwise the image itself
+def photo_input(image: str) -> str:
+    digest = digest_of(image)
+    return (digest and cached_file_id(digest)) or image
+
+
+# Send a stored image with `send` (e.g. message.reply_photo or a partial of bot.send_photo),
+# uploading it only the first time and falling back to an upload if the file_id is refused
+async def send_photo(send, image: str, **kwargs):
+    photo = photo_input(image)
+    try:
+        message = await send(photo=photo, **kwargs)
+    except BadRequest:
+        if photo == image:
+            raise
+        forget_file_id(image)
+        message = await send(photo=image, **kwargs)
+    remember_file_id(image, message)
+    return message
+
+
+def hold(image: str) -> None:
+    if image:
+        _pending[os.path.normpath(image)] += 1
+
+
+def release(image: str) -> None:
+    if image:
+        key = os.path.normpath(image)
+        _pending[key] -= 1
+        if _pending[key] <= 0:
+            del _pending[key]
+
+
+# Delete stored images that no command, scheduled or running broadcast uses, except `keep`.
+# Files younger than `grace` seconds are kept, since conversations hold images before they are saved.
+# Returns (files removed, bytes freed). Blocking, run it with asyncio.to_thread.
+def collect_garbage(grace: float = MEDIA_GC_GRACE, keep=()):
+    store = media_dir()
+    if not os.path.isdir(store):
+        return 0, 0
+    db = SessionLocal()
+    try:
+        referenced = {os.path.normpath(image_url) for (image_url,) in
+                      db.query(Command.image_url).filter(Command.image_url.isnot(None))}
+        referenced.update(os.path.normpath(photo_path) for (photo_path,) in
+                          db.query(ScheduledBroadcast.photo_path).filter(
+                              ScheduledBroadcast.photo_path.isnot(None),
+                              ScheduledBroadcast.status.in_(["pending", "running"])))
+        referenced.update(_pending)
+        referenced.update(os.path.normpath(image) for image in keep)
+
+        removed, freed, digests = 0, 0, []
+        now = time.time()
+        for name in os.listdir(store):
+            path = os.path.join(store, name)
+            if name.startswith(".") or os.path.normpath(path) in referenced or not os.path.isfile(path):
+                continue
+            if now - os.path.getmtime(path) < grace:
+                continue
+            freed += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+            if digest_of(path):
+                digests.append(digest_of(path))
+
+        if digests:
+            db.query(MediaFile).filter(MediaFile.sha256.in_(digests)).delete(synchronize_session=False)
+            db.commit()
+            for digest in digests:
+                _file_ids().pop(digest, None)
+    finally:
+        db.close()
+    return removed, freed
@@ -0,0 +1,258 @@
+import csv
+import io
+import json
+import os
+import re
+
+import media
+import tenants
+from models import SessionLocal, Command
+
+# Fields of an imported or exported prompt, in column order
+FIELDS = ["prompt", "description", "response", "is_command", "image", "inline_links", "markup_buttons"]
+TRUE_VALUES = {"1", "true", "yes", "command"}
+FALSE_VALUES = {"0", "false", "no", "text", ""}
+LINK = re.compile(r"^(https?|tg)://\S+$")
+# Errors listed when a document is refused; the rest are only counted
+MAX_REPORTED_ERRORS = 10
+ADMIN_HELP_FILE = "admin_help.json"
+# Where command images were saved before the media store
+LEGACY_IMAGE_DIR = "images"
+# /help and /admin_help pages are cut at this length, under Telegram's 4096 characters per message
+HELP_PAGE_LENGTH = 3500
+
+
+# Read the rows of a JSON (a list of objects) or CSV (a header row with FIELDS) document
+def read_document(data: bytes, filename: str = "") -> list:
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("The file must be UTF-8 encoded JSON or CSV.")
+    if filename.lower().endswith(".json") or text.lstrip().startswith(("[", "{")):
+        try:
+            rows = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"The file is not valid JSON: {e}")
+        if isinstance(rows, dict):
+            rows = rows.get("commands")
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("The JSON file must be a list of prompts, like the one /export_commands sends.")
+        return rows
+    reader = csv.DictReader(io.StringIO(text))
+    unknown = [name for name in reader.fieldnames or [] if name not in FIELDS]
+    if not reader.fieldnames or "prompt" not in reader.fieldnames or unknown:
+        raise ValueError(f"The CSV file needs a header row with the columns {', '.join(FIELDS)}"
+                         + (f" (unknown: {', '.join(unknown)})" if unknown else ""))
+    return list(reader)
+
+
+def _is_command(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = "" if value is None else str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"is_command must be true or false, not '{value}'")
+
+
+# A list of {"text", "url"}, as JSON or in /addcommand's "Text1,URL1;Text2,URL2" format
+def _inline_links(value) -> list:
+    if value in (None, ""):
+        return []
+    if isinstance(value, str):
+        if value.strip().startswith("["):
+            value = json.loads(value)
+        else:
+            pairs = [part.rsplit(",", 1) for part in value.split(";") if part.strip()]
+            if any(len(pair) != 2 for pair in pairs):
+                raise ValueError("inline_links must look like Text1,URL1;Text2,URL2")
+            value = [{"text": text, "url": url} for text, url in pairs]
+    if not isinstance(value, list) or not all(isinstance(link, dict) and link.get("text") and link.get("url")
+                                              for link in value):
+        raise ValueError('inline_links must be a list of {"text": ..., "url": ...}')
+    links = [{"text": str(link["text"]).strip(), "url": str(link["url"]).strip()} for link in value]
+    for link in links:
+        if not LINK.match(link["url"]):
+            raise ValueError(f"'{link['url']}' is not a link")
+    return links
+
+
+# A list of button labels, as JSON or in /addcommand's "Button1,Button2" format
+def _markup_buttons(value) -> list:
+    if value in (None, ""):
+        return []
+    if isinstance(value, str):
+        value = json.loads(value) if value.strip().startswith("[") else value.split(",")
+    if not isinstance(value, list) or not all(isinstance(button, str) and button.strip() for button in value):
+        raise ValueError("markup_buttons must be a list of button labels")
+    return [button.strip() for button in value]
+
+
+def _inside(path: str, directory: str) -> bool:
+    path, directory = os.path.realpath(path), os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+# An http(s) URL, or a file in the image store (or the legacy images directory) given by path or
+# sha256. Other paths are refused, so an imported file can't make the bot send any file it can read.
+def _image(value):
+    if value in (None, ""):
+        return None
+    image = str(value).strip()
+    if re.match(r"^https?://", image):
+        return image
+    if media.DIGEST.match(image):
+        image = media.media_path(image)
+    if not any(_inside(image, directory) for directory in (media.media_dir(), LEGACY_IMAGE_DIR)) \
+            or not os.path.isfile(image):
+        raise ValueError(f"image '{value}' was not found; use a URL or a file in {media.media_dir()}")
+    return image
+
+
+# Check every row and return (commands, errors). Nothing should be imported unless errors is
+# empty. Prompts are normalized the way /addcommand saves them. Blocking (it checks image files).
+def validate(rows: list):
+    commands, errors, seen = [], [], {}
+    for number, row in enumerate(rows, start=1):
+        try:
+            unknown = ["(cells past the header)" if name is None else str(name) for name in row if name not in FIELDS]
+            if unknown:
+                raise ValueError(f"unknown field {', '.join(unknown)}")
+            is_command = _is_command(row.get("is_command"))
+            prompt = str(row.get("prompt") or "").strip().lower()
+            if is_command:
+                prompt = prompt.lstrip("/").replace(" ", "_")
+            if not prompt:
+                raise ValueError("prompt is missing")
+            if prompt in seen:
+                raise ValueError(f"'{prompt}' is already on row {seen[prompt]}")
+            response = str(row.get("response") or "").strip()
+            if not response:
+                raise ValueError("response is missing")
+            commands.append({
+                "command": prompt,
+                "description": str(row.get("description") or "").strip(),
+                "response": response,
+                "is_command": is_command,
+                "image_url": _image(row.get("image")),
+                "inline_links": _inline_links(row.get("inline_links")),
+                "markup_buttons": _markup_buttons(row.get("markup_buttons")),
+            })
+            seen[prompt] = number
+        except ValueError as e:
+            errors.append(f"Row {number}: {e}")
+    return commands, errors
+
+
+def describe_errors(errors: list) -> str:
+    text = "\n".join(errors[:MAX_REPORTED_ERRORS])
+    if len(errors) > MAX_REPORTED_ERRORS:
+        text += f"\n… and {len(errors) - MAX_REPORTED_ERRORS} more"
+    return text
+
+
+# Insert new prompts and update existing ones in a single transaction, so a menu changes all at
+# once or not at all. Local images outside the store are copied into it first.
+# Returns (added, updated). Blocking, run it with asyncio.to_thread.
+def upsert_commands(commands: list):
+    for values in commands:
+        image = values["image_url"]
+        if image and not re.match(r"^https?://", image) and not media.digest_of(image):
+            with open(image, "rb") as image_file:
+                values["image_url"] = media.store_bytes(image_file.read())
+
+    db = SessionLocal()
+    try:
+        existing = {command.command: command for command in db.query(Command)}
+        added = updated = 0
+        for values in commands:
+            command = existing.get(values["command"])
+            if command is None:
+                db.add(Command(**values))
+                added += 1
+            else:
+                for field, value in values.items():
+                    setattr(command, field, value)
+                updated += 1
+        db.commit()
+        return added, updated
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+# All prompts in the format read_document accepts ("json" or "csv"). Blocking.
+def export_commands(export_format: str) -> bytes:
+    db = SessionLocal()
+    try:
+        rows = [{
+            "prompt": command.command,
+            "description": command.description or "",
+            "response": command.response or "",
+            "is_command": bool(command.is_command),
+            "image": command.image_url or "",
+            "inline_links": command.inline_links or [],
+            "markup_buttons": command.markup_buttons or [],
+        } for command in db.query(Command).order_by(Command.id)]
+    finally:
+        db.close()
+
+    if export_format == "json":
+        return json.dumps(rows, ensure_ascii=False, indent=2).encode()
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(dict(row, is_command=str(row["is_command"]).lower(),
+                             inline_links=json.dumps(row["inline_links"], ensure_ascii=False),
+                             markup_buttons=json.dumps(row["markup_buttons"], ensure_ascii=False)))
+    return output.getvalue().encode("utf-8-sig")
+
+
+# Split a help text into pages, keeping each entry on one page
+def paginate(title: str, entries: list) -> list:
+    pages, page = [], title
+    for entry in entries:
+        entry = entry[:HELP_PAGE_LENGTH - len(title)]
+        if len(page) + len(entry) > HELP_PAGE_LENGTH and page != title:
+            pages.append(page.rstrip())
+            page = title
+        page += entry
+    pages.append(page.rstrip())
+    return pages
+
+
+# Render the /help pages of the current bot from its commands. Run it again whenever prompts
+# change (see commands_changed in app.py). Blocking.
+def rebuild_help() -> list:
+    db = SessionLocal()
+    try:
+        entries = [f"/{command}: {description}\n\n" for command, description in
+                   db.query(Command.command, Command.description).filter_by(is_command=True).order_by(Command.id)]
+    finally:
+        db.close()
+    pages = paginate("Available commands:\n\n", entries)
+    tenants.current().help_pages["help"] = pages
+    return pages
+
+
+# Rendered pages of "help" or "admin_help". admin_help.json is only read again after it was
+# modified; /help is rendered on first use if rebuild_help hasn't run yet (blocking).
+def help_pages(kind: str) -> list:
+    cache = tenants.current().help_pages
+    if kind == "admin_help":
+        modified = os.path.getmtime(ADMIN_HELP_FILE)
+        if cache.get("admin_help_modified") != modified:
+            with open(ADMIN_HELP_FILE, "r") as admin_cmds:
+                admin_commands = json.load(admin_cmds)
+            cache["admin_help"] = paginate("👤 Admin Commands:\n\n", [
+                f"{cmd['command']}: {cmd['description']}\nUsage: {cmd['usage']}\n\n" for cmd in admin_commands])
+            cache["admin_help_modified"] = modified
+        return cache["admin_help"]
+    if "help" not in cache:
+        return rebuild_help()
+    return cache["help"]
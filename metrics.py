@@ -0,0 +1,225 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telegram.request import HTTPXRequest
+
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets (seconds) shared by every histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for the number of DB queries issued while handling one update
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q: float) -> float:
+        # Estimate a quantile from the bucket counts (upper bound of the bucket it falls in)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bound in enumerate(self.buckets):
+            seen += self.counts[i]
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+# Metric stores, keyed by label value
+handler_latency = defaultdict(Histogram)
+handler_errors = defaultdict(int)
+db_queries_per_update = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))
+db_time_per_update = defaultdict(Histogram)
+db_queries_total = 0
+db_seconds_total = 0.0
+api_latency = defaultdict(Histogram)
+api_errors = defaultdict(int)
+broadcast_messages = defaultdict(int)
+broadcast_seconds_total = 0.0
+broadcast_last_rate = 0.0
+started_at = time.time()
+
+# Per-update DB accounting: [query count, seconds] for the update being handled
+_current_update = contextvars.ContextVar('current_update', default=None)
+
+
+# Every engine, so the databases of all hosted bots are counted
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    global db_queries_total, db_seconds_total
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    db_queries_total += 1
+    db_seconds_total += elapsed
+    current = _current_update.get()
+    if current is not None:
+        current[0] += 1
+        current[1] += elapsed
+
+
+# Decorator that records latency, errors and DB usage for a handler. Records logged while it
+# runs carry the update id, user id and handler name.
+def track_handler(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        update = args[0] if args else None
+        user = getattr(update, "effective_user", None)
+        log_token = logs.bind(update_id=getattr(update, "update_id", None), user_id=user.id if user else None,
+                              handler=name)
+        db_usage = [0, 0.0]
+        token = _current_update.set(db_usage)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            handler_errors[name] += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            handler_latency[name].observe(latency)
+            db_queries_per_update[name].observe(db_usage[0])
+            db_time_per_update[name].observe(db_usage[1])
+            _current_update.reset(token)
+            logger.debug("Handled update", extra={"latency_ms": round(latency * 1000, 2), "db_queries": db_usage[0]})
+            logs.reset(log_token)
+
+    return wrapper
+
+
+def record_broadcast(success: int, failure: int, elapsed: float) -> None:
+    global broadcast_seconds_total, broadcast_last_rate
+    broadcast_messages['success'] += success
+    broadcast_messages['failure'] += failure
+    broadcast_seconds_total += elapsed
+    broadcast_last_rate = (success + failure) / elapsed if elapsed > 0 else 0.0
+
+
+# Request class that times every Bot API call by method
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = "file_download" if "/file/bot" in url else url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            api_errors[api_method] += 1
+            raise
+        finally:
+            api_latency[api_method].observe(time.perf_counter() - start)
+        if code >= 400:
+            api_errors[api_method] += 1
+        return code, payload
+
+
+def _histogram_lines(name: str, label: str, series: dict) -> list:
+    lines = [f"# TYPE {name} histogram"]
+    for value, hist in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(hist.buckets, hist.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {hist.count}')
+        lines.append(f'{name}_sum{{{label}="{value}"}} {hist.total}')
+        lines.append(f'{name}_count{{{label}="{value}"}} {hist.count}')
+    return lines
+
+
+def _counter_lines(name: str, label: str, series: dict) -> list:
+    lines = [f"# TYPE {name} counter"]
+    for value, count in sorted(series.items()):
+        lines.append(f'{name}{{{label}="{value}"}} {count}')
+    return lines
+
+
+# Render every metric in the Prometheus text exposition format
+def render_prometheus() -> str:
+    lines = []
+    lines += _histogram_lines("bot_handler_seconds", "handler", handler_latency)
+    lines += _counter_lines("bot_handler_errors_total", "handler", handler_errors)
+    lines += _histogram_lines("bot_db_queries_per_update", "handler", db_queries_per_update)
+    lines += _histogram_lines("bot_db_seconds_per_update", "handler", db_time_per_update)
+    lines += ["# TYPE bot_db_queries_total counter", f"bot_db_queries_total {db_queries_total}"]
+    lines += ["# TYPE bot_db_seconds_total counter", f"bot_db_seconds_total {db_seconds_total}"]
+    lines += _histogram_lines("bot_api_request_seconds", "method", api_latency)
+    lines += _counter_lines("bot_api_errors_total", "method", api_errors)
+    lines += _counter_lines("bot_broadcast_messages_total", "result", broadcast_messages)
+    lines += ["# TYPE bot_broadcast_seconds_total counter", f"bot_broadcast_seconds_total {broadcast_seconds_total}"]
+    lines += ["# TYPE bot_broadcast_last_rate gauge", f"bot_broadcast_last_rate {broadcast_last_rate}"]
+    lines += ["# TYPE bot_uptime_seconds gauge", f"bot_uptime_seconds {time.time() - started_at:.0f}"]
+    return "\n".join(lines) + "\n"
+
+
+# Short human readable summary for the /stats command
+def render_summary() -> str:
+    text = f"📊 Bot Stats (uptime {int(time.time() - started_at)}s)\n\n⏱ Handlers:\n"
+    for name, hist in sorted(handler_latency.items()):
+        queries = db_queries_per_update[name]
+        text += (f"{name}: {hist.count} calls, p50 {hist.quantile(0.5) * 1000:.0f}ms, "
+                 f"p99 {hist.quantile(0.99) * 1000:.0f}ms, {queries.mean():.1f} queries/update, "
+                 f"{handler_errors[name]} errors\n")
+    text += f"\n🗄 DB: {db_queries_total} queries, {db_seconds_total:.2f}s total\n\n🌐 Bot API:\n"
+    for api_method, hist in sorted(api_latency.items()):
+        error_rate = api_errors[api_method] / hist.count * 100 if hist.count else 0.0
+        text += f"{api_method}: {hist.count} calls, mean {hist.mean() * 1000:.0f}ms, {error_rate:.1f}% errors\n"
+    text += (f"\n📢 Broadcast: {broadcast_messages['success']} sent, {broadcast_messages['failure']} failed, "
+             f"last rate {broadcast_last_rate:.2f} msg/s")
+    return text
+
+
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        # Drain the request headers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        path = request_line.split()[1] if len(request_line.split()) > 1 else b'/'
+        if path == b'/metrics':
+            body = render_prometheus().encode()
+            status = "200 OK"
+        else:
+            body = b"Not Found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+# Serve /metrics on a local port; returns the asyncio server so it can be closed
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    return await asyncio.start_server(_handle_scrape, host, port)
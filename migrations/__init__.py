@@ -0,0 +1,98 @@
+"""Versioned schema migrations.
+
+Each module in this package named mNNNN_<name>.py defines VERSION (NNNN),
+DESCRIPTION and upgrade(engine). Migrations run in version order at
+bootstrap (models.init_db) for every version above the database's
+PRAGMA user_version, which is bumped after each one succeeds. Migrations
+must be safe to re-run: a crash in the middle leaves the version
+unchanged and the migration runs again on the next start.
+"""
+import importlib
+import pkgutil
+import time
+
+from sqlalchemy import text
+
+# Version of databases created by create_all before migrations existed
+BASELINE_VERSION = 1
+
+_migrations = None
+
+
+def load_migrations() -> list:
+    global _migrations
+    if _migrations is None:
+        modules = [importlib.import_module(f"{__name__}.{name}")
+                   for _, name, _ in pkgutil.iter_modules(__path__) if name.startswith("m")]
+        _migrations = sorted(modules, key=lambda module: module.VERSION)
+        versions = [module.VERSION for module in _migrations]
+        if len(set(versions)) != len(versions):
+            raise RuntimeError(f"Duplicate migration versions: {versions}")
+    return _migrations
+
+
+def latest_version() -> int:
+    migrations = load_migrations()
+    return migrations[-1].VERSION if migrations else BASELINE_VERSION
+
+
+def get_version(conn) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_version(conn, version: int) -> None:
+    conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def run_migrations(engine) -> None:
+    with engine.connect() as conn:
+        current = get_version(conn) or BASELINE_VERSION
+    for migration in load_migrations():
+        if migration.VERSION <= current:
+            continue
+        started = time.perf_counter()
+        print(f"Applying migration {migration.VERSION}: {migration.DESCRIPTION}")
+        migration.upgrade(engine)
+        with engine.begin() as conn:
+            set_version(conn, migration.VERSION)
+        print(f"Migration {migration.VERSION} done in {time.perf_counter() - started:.1f}s")
+
+
+# Helpers for migrations
+
+def column_exists(conn, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.execute(text(f"PRAGMA table_info({table})")))
+
+
+# Add a column unless it is already there (ADD COLUMN is a quick schema-only change in SQLite)
+def add_column(conn, table: str, column: str, ddl: str) -> None:
+    if not column_exists(conn, table, column):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+# Run a statement over a table in short transactions of batch_size rows (by id), so a live
+# bot only ever waits for one small batch instead of a lock over the whole table.
+# The statement must restrict itself to `id > :low AND id <= :high`.
+def in_batches(engine, table: str, statement: str, batch_size: int = 5000, pause: float = 0.01) -> int:
+    with engine.connect() as conn:
+        max_id = conn.execute(text(f"SELECT MAX(id) FROM {table}")).scalar() or 0
+    affected = 0
+    for low in range(0, max_id, batch_size):
+        with engine.begin() as conn:
+            result = conn.execute(text(statement), {"low": low, "high": low + batch_size})
+            affected += max(result.rowcount, 0)
+        if pause:
+            time.sleep(pause)
+    return affected
+
+
+# Run an UPDATE over a table in batches (see in_batches). `assignment` and `condition` are
+# SQL fragments; the condition should exclude rows that are already done so the backfill
+# can resume after an interruption.
+def backfill(engine, table: str, assignment: str, condition: str = "1", batch_size: int = 5000,
+             pause: float = 0.01) -> int:
+    return in_batches(
+        engine, table,
+        f"UPDATE {table} SET {assignment} WHERE id > :low AND id <= :high AND ({condition})",
+        batch_size=batch_size, pause=pause,
+    )
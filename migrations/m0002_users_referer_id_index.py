@@ -0,0 +1,9 @@
+from sqlalchemy import text
+
+VERSION = 2
+DESCRIPTION = "Index users.referer_id for referral counts"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_referer_id ON users (referer_id)"))
@@ -0,0 +1,22 @@
+from migrations import backfill
+from sqlalchemy import text
+
+VERSION = 3
+DESCRIPTION = "Store users.created_at as normalized timestamps and index it"
+
+# SQLite keeps timestamps as text; normalizing every value to the format User.created_at
+# now declares makes them parse as datetimes and compare correctly in range queries
+NORMALIZED = "strftime('%Y-%m-%d %H:%M:%S', created_at)"
+
+
+def upgrade(engine) -> None:
+    backfill(
+        engine, "users",
+        assignment=f"created_at = {NORMALIZED}",
+        condition=f"created_at IS NOT NULL AND {NORMALIZED} IS NOT NULL AND created_at != {NORMALIZED}",
+    )
+    # Values SQLite cannot read as a date would fail to load as a datetime at all
+    backfill(engine, "users", assignment="created_at = NULL",
+             condition=f"created_at IS NOT NULL AND {NORMALIZED} IS NULL")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_created_at ON users (created_at)"))
@@ -0,0 +1,81 @@
+import json
+import sqlite3
+
+from migrations import column_exists, in_batches
+from sqlalchemy import text
+
+VERSION = 4
+DESCRIPTION = "Move referrals from the users.referrals JSON column into a referrals table"
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS referrals (
+    id INTEGER NOT NULL PRIMARY KEY,
+    referrer_id INTEGER NOT NULL REFERENCES users (id),
+    referee_id INTEGER NOT NULL UNIQUE REFERENCES users (id),
+    created_at DATETIME,
+    credited FLOAT
+)
+"""
+
+
+# Entries of the old JSON lists are user IDs, telegram IDs or objects holding either
+def _referee_ids(conn, referrer_id: int, entries) -> list:
+    ids = []
+    for entry in entries if isinstance(entries, list) else []:
+        if isinstance(entry, dict):
+            entry = entry.get("id") or entry.get("user_id") or entry.get("telegram_id")
+        if not isinstance(entry, int):
+            continue
+        referee_id = conn.execute(
+            text("SELECT id FROM users WHERE telegram_id = :value OR id = :value ORDER BY telegram_id = :value DESC"),
+            {"value": entry},
+        ).scalar()
+        if referee_id and referee_id != referrer_id:
+            ids.append(referee_id)
+    return ids
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text(CREATE_TABLE))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_referrals_referrer_id_created_at "
+                          "ON referrals (referrer_id, created_at)"))
+
+    # users.referer_id is the authoritative link; the bonus paid for these was never recorded
+    in_batches(engine, "users", """
+        INSERT OR IGNORE INTO referrals (referrer_id, referee_id, created_at)
+        SELECT referer_id, id, created_at FROM users
+        WHERE id > :low AND id <= :high AND referer_id IS NOT NULL AND referer_id != id
+    """)
+
+    with engine.connect() as conn:
+        has_json = column_exists(conn, "users", "referrals")
+    if not has_json:
+        return
+
+    # Pick up anything that only ever made it into the JSON lists
+    with engine.connect() as conn:
+        max_id = conn.execute(text("SELECT MAX(id) FROM users")).scalar() or 0
+    for low in range(0, max_id, 5000):
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text("SELECT id, referrals FROM users WHERE id > :low AND id <= :high "
+                     "AND referrals IS NOT NULL AND referrals NOT IN ('', '[]', 'null')"),
+                {"low": low, "high": low + 5000},
+            ).all()
+            for referrer_id, raw in rows:
+                try:
+                    entries = json.loads(raw)
+                except ValueError:
+                    continue
+                for referee_id in _referee_ids(conn, referrer_id, entries):
+                    conn.execute(
+                        text("INSERT OR IGNORE INTO referrals (referrer_id, referee_id, created_at) "
+                             "SELECT :referrer_id, id, created_at FROM users WHERE id = :referee_id"),
+                        {"referrer_id": referrer_id, "referee_id": referee_id},
+                    )
+
+    # DROP COLUMN needs SQLite 3.35; on older versions the column is just no longer read
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE users DROP COLUMN referrals"))
@@ -0,0 +1,48 @@
+import hashlib
+import os
+
+from sqlalchemy import text
+
+from config import MEDIA_DIR
+
+VERSION = 5
+DESCRIPTION = "Move command images into the content-addressed media store"
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS media_files (
+    id INTEGER NOT NULL PRIMARY KEY,
+    sha256 VARCHAR NOT NULL UNIQUE,
+    size INTEGER,
+    file_id VARCHAR,
+    created_at DATETIME
+)
+"""
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text(CREATE_TABLE))
+
+    # Images saved under random names become MEDIA_DIR/<sha256>.jpg; copies of the same
+    # picture collapse into one file. Unused leftovers are removed later by media.collect_garbage.
+    with engine.begin() as conn:
+        rows = conn.execute(text("SELECT id, image_url FROM commands WHERE image_url IS NOT NULL")).all()
+        for command_id, image_url in rows:
+            if not os.path.isfile(image_url):
+                continue
+            with open(image_url, "rb") as image_file:
+                data = image_file.read()
+            digest = hashlib.sha256(data).hexdigest()
+            path = os.path.join(MEDIA_DIR, f"{digest}.jpg")
+            if os.path.normpath(image_url) != os.path.normpath(path):
+                os.makedirs(MEDIA_DIR, exist_ok=True)
+                if not os.path.exists(path):
+                    with open(path, "wb") as image_file:
+                        image_file.write(data)
+                conn.execute(text("UPDATE commands SET image_url = :path WHERE id = :id"),
+                             {"path": path, "id": command_id})
+            conn.execute(
+                text("INSERT OR IGNORE INTO media_files (sha256, size, created_at) "
+                     "VALUES (:sha256, :size, CURRENT_TIMESTAMP)"),
+                {"sha256": digest, "size": len(data)},
+            )
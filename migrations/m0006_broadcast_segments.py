@@ -0,0 +1,21 @@
+from migrations import add_column
+from sqlalchemy import text
+
+VERSION = 6
+DESCRIPTION = "Add last_seen_at, an earnings index and chat memberships for broadcast segments"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        add_column(conn, "users", "last_seen_at", "DATETIME")
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_last_seen_at ON users (last_seen_at)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_earnings ON users (earnings)"))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS chat_members (
+                chat_id VARCHAR NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                is_member BOOLEAN NOT NULL,
+                checked_at DATETIME,
+                PRIMARY KEY (chat_id, telegram_id)
+            )
+        """))
@@ -0,0 +1,26 @@
+from sqlalchemy import text
+
+VERSION = 7
+DESCRIPTION = "Add scheduled_broadcasts"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS scheduled_broadcasts (
+                id INTEGER NOT NULL PRIMARY KEY,
+                created_by INTEGER,
+                message VARCHAR,
+                photo_path VARCHAR,
+                links JSON,
+                segment JSON,
+                send_at DATETIME,
+                recurrence VARCHAR,
+                estimated_seconds FLOAT,
+                status VARCHAR,
+                last_run_at DATETIME,
+                created_at DATETIME
+            )
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_scheduled_broadcasts_send_at ON scheduled_broadcasts (send_at)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_scheduled_broadcasts_status ON scheduled_broadcasts (status)"))
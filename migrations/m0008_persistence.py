@@ -0,0 +1,24 @@
+from sqlalchemy import text
+
+VERSION = 8
+DESCRIPTION = "Add tables for conversation and user_data persistence"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS persistence_data (
+                kind VARCHAR NOT NULL,
+                id INTEGER NOT NULL,
+                data VARCHAR NOT NULL,
+                PRIMARY KEY (kind, id)
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS persistence_conversations (
+                name VARCHAR NOT NULL,
+                "key" VARCHAR NOT NULL,
+                state VARCHAR NOT NULL,
+                PRIMARY KEY (name, "key")
+            )
+        """))
@@ -0,0 +1,46 @@
+from migrations import add_column, in_batches, backfill
+from sqlalchemy import text
+
+from config import EARNINGS_MINOR_UNITS
+
+VERSION = 9
+DESCRIPTION = "Add the earnings ledger, balance snapshots and users.balance"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS ledger_entries (
+                id INTEGER NOT NULL PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                amount INTEGER NOT NULL,
+                reason VARCHAR NOT NULL,
+                reference VARCHAR,
+                created_at DATETIME
+            )
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ledger_entries_user_id_id ON ledger_entries (user_id, id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ledger_entries_user_id_created_at "
+                          "ON ledger_entries (user_id, created_at)"))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS balance_snapshots (
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                entry_id INTEGER NOT NULL,
+                balance INTEGER NOT NULL,
+                created_at DATETIME,
+                PRIMARY KEY (user_id, entry_id)
+            )
+        """))
+        add_column(conn, "users", "balance", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_balance ON users (balance)"))
+
+    # Today's float earnings become each user's opening entry; skipped for users that have one
+    in_batches(engine, "users", f"""
+        INSERT INTO ledger_entries (user_id, amount, reason, created_at)
+        SELECT id, CAST(ROUND(earnings * {EARNINGS_MINOR_UNITS}) AS INTEGER), 'opening_balance', CURRENT_TIMESTAMP
+        FROM users
+        WHERE id > :low AND id <= :high AND CAST(ROUND(earnings * {EARNINGS_MINOR_UNITS}) AS INTEGER) != 0
+        AND NOT EXISTS (SELECT 1 FROM ledger_entries WHERE user_id = users.id AND reason = 'opening_balance')
+    """)
+    backfill(engine, "users", "balance = (SELECT COALESCE(SUM(amount), 0) FROM ledger_entries "
+                              "WHERE user_id = users.id)")
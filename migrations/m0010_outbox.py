@@ -0,0 +1,27 @@
+from sqlalchemy import text
+
+VERSION = 10
+DESCRIPTION = "Add the outbox of messages to send"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER NOT NULL PRIMARY KEY,
+                "key" VARCHAR UNIQUE,
+                chat_id INTEGER NOT NULL,
+                kind VARCHAR NOT NULL,
+                payload JSON NOT NULL,
+                status VARCHAR NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                send_after DATETIME NOT NULL,
+                sent_at DATETIME,
+                last_error VARCHAR,
+                created_at DATETIME
+            )
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox (send_after) "
+                          "WHERE status = 'pending'"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_outbox_pending_chat ON outbox (chat_id) "
+                          "WHERE status = 'pending'"))
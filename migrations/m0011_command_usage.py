@@ -0,0 +1,17 @@
+from sqlalchemy import text
+
+VERSION = 11
+DESCRIPTION = "Add hourly prompt usage rollups"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS command_usage (
+                prompt VARCHAR NOT NULL,
+                hour DATETIME NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (prompt, hour)
+            )
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_command_usage_hour ON command_usage (hour)"))
@@ -0,0 +1,36 @@
+from sqlalchemy import text
+
+VERSION = 12
+DESCRIPTION = "Add the users_fts full-text index for /find_user"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                username, first_name, last_name, referral_id, content='users', content_rowid='id', tokenize='trigram')
+        """))
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+                INSERT INTO users_fts (rowid, username, first_name, last_name, referral_id)
+                VALUES (new.id, new.username, new.first_name, new.last_name, new.referral_id);
+            END
+        """))
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+                INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, referral_id)
+                VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.referral_id);
+            END
+        """))
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name, last_name, referral_id ON users
+            WHEN old.username IS NOT new.username OR old.first_name IS NOT new.first_name
+                OR old.last_name IS NOT new.last_name OR old.referral_id IS NOT new.referral_id BEGIN
+                INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, referral_id)
+                VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.referral_id);
+                INSERT INTO users_fts (rowid, username, first_name, last_name, referral_id)
+                VALUES (new.id, new.username, new.first_name, new.last_name, new.referral_id);
+            END
+        """))
+        # Index the existing users; safe to re-run, it rebuilds the index from users
+        conn.execute(text("INSERT INTO users_fts (users_fts) VALUES ('rebuild')"))
@@ -0,0 +1,32 @@
+from migrations import add_column
+from sqlalchemy import text
+
+VERSION = 13
+DESCRIPTION = "Add daily growth rollups and users.unreachable_at"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS daily_growth (
+                day VARCHAR NOT NULL PRIMARY KEY,
+                signups INTEGER NOT NULL DEFAULT 0,
+                referred_signups INTEGER NOT NULL DEFAULT 0,
+                credited INTEGER NOT NULL DEFAULT 0,
+                debited INTEGER NOT NULL DEFAULT 0,
+                users_total INTEGER,
+                unreachable_total INTEGER,
+                liabilities INTEGER
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS daily_referrers (
+                day VARCHAR NOT NULL,
+                referrer_id INTEGER NOT NULL REFERENCES users (id),
+                signups INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, referrer_id)
+            )
+        """))
+        add_column(conn, "users", "unreachable_at", "DATETIME")
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_unreachable_at ON users (unreachable_at)"))
+    # The days before this migration are filled in by growth.rollup on the first start
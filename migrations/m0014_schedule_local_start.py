@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+
+from config import SCHEDULE_TIMEZONE
+from migrations import add_column
+
+VERSION = 14
+DESCRIPTION = "Add scheduled_broadcasts.local_start, the wall-clock time recurrences step from"
+
+
+def upgrade(engine) -> None:
+    with engine.begin() as conn:
+        add_column(conn, "scheduled_broadcasts", "local_start", "VARCHAR")
+        # Existing recurring broadcasts continue from their next send time
+        rows = conn.execute(text(
+            "SELECT id, send_at FROM scheduled_broadcasts WHERE recurrence IS NOT NULL AND local_start IS NULL"
+        )).all()
+        for row in rows:
+            send_at = datetime.fromisoformat(str(row.send_at)).replace(tzinfo=timezone.utc)
+            local = send_at.astimezone(ZoneInfo(SCHEDULE_TIMEZONE)).strftime("%Y-%m-%d %H:%M")
+            conn.execute(text("UPDATE scheduled_broadcasts SET local_start = :local WHERE id = :id"),
+                         {"local": local, "id": row.id})
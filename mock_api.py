@@ -0,0 +1,235 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from email.parser import BytesParser
+from urllib.parse import parse_qsl
+
+import httpx
+
+from fake_telegram import FakeBotAPI
+
+# Methods that count against Telegram's flood limits
+LIMITED_METHODS = ("sendMessage", "sendPhoto", "sendDocument", "forwardMessage", "editMessageText", "copyMessage")
+# Methods that may get an injected error
+FAILING_METHODS = LIMITED_METHODS + ("getChatMember",)
+INJECTED_ERRORS = [
+    (400, "Bad Request: chat not found"),
+    (403, "Forbidden: bot was blocked by the user"),
+    (502, "Bad Gateway"),
+]
+INT_PARAMS = ("chat_id", "from_chat_id", "user_id", "message_id", "offset", "limit", "timeout")
+
+
+# Decode the form fields PTB sends: strings as is, everything else JSON encoded
+def _decode_params(pairs) -> dict:
+    params = {}
+    for key, value in pairs:
+        if key in INT_PARAMS and value.lstrip('-').isdigit():
+            params[key] = int(value)
+        elif value[:1] in ('[', '{') or value in ('true', 'false'):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        else:
+            params[key] = value
+    return params
+
+
+def parse_body(content_type: str, body: bytes) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        pairs = []
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                pairs.append((name, f"upload://{part.get_filename()}"))
+            else:
+                pairs.append((name, part.get_payload(decode=True).decode()))
+        return _decode_params(pairs)
+    return _decode_params(parse_qsl(body.decode(), keep_blank_values=True))
+
+
+# Token bucket used for the global and per chat flood limits
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Take one token; returns 0 on success or the seconds to wait otherwise
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# Stand-in for the Telegram Bot API over HTTP, for end to end load tests.
+# Serves getUpdates (or pushes to a webhook) from pushed updates, answers the
+# other methods through FakeBotAPI and simulates latency, errors and 429s.
+class MockBotAPIServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 flood_control: bool = True, api: FakeBotAPI = None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.flood_control = flood_control
+        self.api = api or FakeBotAPI()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.webhook_url = None
+        self.stats = Counter()
+        self.response_latencies = []  # Seconds from update delivery to the first reply in that chat
+        self._pending = deque()
+        self._new_updates = asyncio.Event()
+        self._next_update_id = 1
+        self._last_delivered_id = 0
+        self._awaiting_reply = {}
+        self._server = None
+        self._client = None
+        self._writers = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self._client = httpx.AsyncClient()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def stop(self) -> None:
+        self._server.close()
+        # Release long polls and idle keep-alive connections so their handlers can finish
+        self._new_updates.set()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        await self._client.aclose()
+
+    # Queue an update for getUpdates, or deliver it straight to the webhook if one is set
+    async def push_update(self, update: dict) -> None:
+        update = dict(update, update_id=self._next_update_id)
+        self._next_update_id += 1
+        self.stats['updates_pushed'] += 1
+        if self.webhook_url:
+            self._mark_delivered(update)
+            try:
+                await self._client.post(self.webhook_url, json=update)
+            except httpx.HTTPError:
+                self.stats['webhook_errors'] += 1
+        else:
+            self._pending.append(update)
+            self._new_updates.set()
+
+    def _mark_delivered(self, update: dict) -> None:
+        self.stats['updates_delivered'] += 1
+        message = update.get('message') or (update.get('callback_query') or {}).get('message')
+        if message:
+            self._awaiting_reply.setdefault(message['chat']['id'], time.monotonic())
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = params.get('offset', 0)
+        while self._pending and self._pending[0]['update_id'] < offset:
+            self._pending.popleft()
+        if not self._pending and params.get('timeout'):
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), params['timeout'])
+            except asyncio.TimeoutError:
+                pass
+        updates = list(self._pending)[:params.get('limit', 100)]
+        # Updates are returned again until confirmed by offset; only the first delivery counts
+        for update in updates:
+            if update['update_id'] > self._last_delivered_id:
+                self._mark_delivered(update)
+                self._last_delivered_id = update['update_id']
+        return updates
+
+    def _flood_wait(self, params: dict) -> float:
+        chat_id = params.get('chat_id')
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket.take() or self.global_bucket.take()
+
+    # Returns (HTTP status, response JSON) for one Bot API call
+    async def call(self, method: str, params: dict):
+        self.stats[f'calls.{method}'] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+        if method == "setWebhook":
+            self.webhook_url = params.get('url') or None
+            return 200, {"ok": True, "result": True}
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            if params.get('drop_pending_updates'):
+                self._pending.clear()
+            return 200, {"ok": True, "result": True}
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if method in LIMITED_METHODS and self.flood_control:
+            wait = self._flood_wait(params)
+            if wait:
+                self.stats['429'] += 1
+                retry_after = max(1, round(wait))
+                return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}
+        if method in FAILING_METHODS and random.random() < self.error_rate:
+            code, description = random.choice(INJECTED_ERRORS)
+            self.stats['injected_errors'] += 1
+            return code, {"ok": False, "error_code": code, "description": description}
+        if method in LIMITED_METHODS and params.get('chat_id') in self._awaiting_reply:
+            self.response_latencies.append(time.monotonic() - self._awaiting_reply.pop(params['chat_id']))
+        return 200, {"ok": True, "result": self.api.handle(method, params)}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                path = request_line.split()[1].decode().split('?')[0]
+
+                if path.startswith('/file/'):
+                    status, payload, content_type = 200, b"\xff\xd8\xff\xd9", "image/jpeg"
+                else:
+                    method = path.rsplit('/', 1)[-1]
+                    status, result = await self.call(method, parse_body(headers.get('content-type', ''), body))
+                    payload, content_type = json.dumps(result).encode(), "application/json"
+
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: keep-alive\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
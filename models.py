@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, JSON, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+import contextvars
+
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, JSON, ForeignKey, DateTime, Index, text, inspect, event, DDL
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, Session
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.sql import func
 
@@ -8,7 +10,33 @@ from config import DATABASE_URL
 
 Base = declarative_base()
 engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Database of the bot being served. It is `engine` unless tenants.py hosts several bots
+# in this process, in which case each bot's tasks run with its own engine set here.
+_current_engine = contextvars.ContextVar('current_engine', default=engine)
+
+
+def current_engine():
+    return _current_engine.get()
+
+
+def use_engine(bind) -> None:
+    _current_engine.set(bind)
+
+
+# Session bound to the current bot's database when it is created
+class TenantSession(Session):
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(bind=bind or _current_engine.get(), **kwargs)
+
+
+SessionLocal = sessionmaker(class_=TenantSession, autocommit=False, autoflush=False)
+
+# Timestamps without microseconds, matching what CURRENT_TIMESTAMP writes on SQLite
+Timestamp = DateTime().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
 
 class Command(Base):
     __tablename__ = "commands"
@@ -30,14 +58,149 @@ class User(Base):
     first_name = Column(String)
     last_name = Column(String, nullable=True)
     referral_id = Column(String, unique=True, index=True)
-    referer_id = Column(Integer, ForeignKey('users.id'))
+    referer_id = Column(Integer, ForeignKey('users.id'), index=True)
     referer = relationship('User', back_populates='downlines')
-    created_at = Column(String, default=func.now())
-    earnings = Column(Float, default=0.0)
+    created_at = Column(Timestamp, default=func.now(), index=True)
+    last_seen_at = Column(Timestamp, nullable=True, index=True)  # Written behind by activity.ActivityTracker
+    earnings = Column(Float, default=0.0, index=True)  # balance in whole units, kept for exports and older tools
+    balance = Column(Integer, default=0, nullable=False, index=True)  # Sum of the user's ledger entries, see ledger.py
+    unreachable_at = Column(Timestamp, nullable=True, index=True)  # Last failed send (blocked the bot, deleted); cleared when seen
     downline_earnings = Column(Float, default=0.0)
     downlines = relationship('User', back_populates='referer', remote_side=[id])
     total_earnings = Column(Float, default=0.0)
-    referrals = Column(JSON, default=[])
+    # Loaded only when asked for, e.g. user.referrals.count(), so reading a user stays cheap
+    referrals = relationship('Referral', foreign_keys='Referral.referrer_id', lazy='dynamic')
+
+
+class Referral(Base):
+    __tablename__ = "referrals"
+    id = Column(Integer, primary_key=True)
+    referrer_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    referee_id = Column(Integer, ForeignKey('users.id'), nullable=False, unique=True)  # A user is referred once
+    created_at = Column(Timestamp, default=func.now())
+    credited = Column(Float, nullable=True)  # Bonus paid to the referrer; NULL for referrals made before it was recorded
+
+    __table_args__ = (Index('ix_referrals_referrer_id_created_at', 'referrer_id', 'created_at'),)
+
+# Append-only record of every change to a user's balance; users.balance caches its sum
+class LedgerEntry(Base):
+    __tablename__ = "ledger_entries"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    amount = Column(Integer, nullable=False)  # In 1/EARNINGS_MINOR_UNITS, negative for debits
+    reason = Column(String, nullable=False)  # e.g. referral_bonus, deduction, opening_balance
+    reference = Column(String, nullable=True)  # What caused it, e.g. "referee:<user id>" or "admin:<telegram id>"
+    created_at = Column(Timestamp, default=func.now())
+
+    __table_args__ = (
+        Index('ix_ledger_entries_user_id_id', 'user_id', 'id'),
+        Index('ix_ledger_entries_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+# A user's balance after a ledger entry, so historic balances only sum the entries since
+class BalanceSnapshot(Base):
+    __tablename__ = "balance_snapshots"
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    entry_id = Column(Integer, primary_key=True)  # Last ledger entry included
+    balance = Column(Integer, nullable=False)
+    created_at = Column(Timestamp, default=func.now())
+
+# Last known membership of a user in a required chat, as seen by check_membership
+class ChatMember(Base):
+    __tablename__ = "chat_members"
+    chat_id = Column(String, primary_key=True)
+    telegram_id = Column(Integer, primary_key=True)
+    is_member = Column(Boolean, nullable=False)
+    checked_at = Column(Timestamp, default=func.now(), onupdate=func.now())
+
+class MediaFile(Base):
+    __tablename__ = "media_files"
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String, unique=True, nullable=False)  # Stored as MEDIA_DIR/<sha256>.jpg
+    size = Column(Integer)
+    file_id = Column(String, nullable=True)  # Telegram file_id, sent instead of uploading the file again
+    created_at = Column(Timestamp, default=func.now())
+
+class ScheduledBroadcast(Base):
+    __tablename__ = "scheduled_broadcasts"
+    id = Column(Integer, primary_key=True)
+    created_by = Column(Integer)  # Telegram ID of the admin who gets the progress messages
+    message = Column(String)
+    photo_path = Column(String, nullable=True)
+    links = Column(JSON, nullable=True)
+    segment = Column(JSON, nullable=True)
+    send_at = Column(Timestamp, index=True)  # UTC
+    recurrence = Column(String, nullable=True)  # None, "daily" or "weekly"
+    local_start = Column(String, nullable=True)  # "YYYY-MM-DD HH:MM" in SCHEDULE_TIMEZONE; recurrences step from it
+    estimated_seconds = Column(Float, default=0.0)
+    status = Column(String, default="pending", index=True)  # pending, running, done or cancelled
+    last_run_at = Column(Timestamp, nullable=True)
+    created_at = Column(Timestamp, default=func.now())
+
+# user_data and chat_data of persistence.SQLitePersistence, one JSON document per user or chat
+class PersistedData(Base):
+    __tablename__ = "persistence_data"
+    kind = Column(String, primary_key=True)  # "user" or "chat"
+    id = Column(Integer, primary_key=True)
+    data = Column(String, nullable=False)
+
+
+# ConversationHandler states of persistence.SQLitePersistence
+class PersistedConversation(Base):
+    __tablename__ = "persistence_conversations"
+    name = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)  # JSON list of the conversation key
+    state = Column(String, nullable=False)  # JSON
+
+# Growth figures of one UTC day for /dashboard, see growth.py. The counters are added to as
+# things happen; the totals are written by the nightly rollup once the day is over.
+class DailyGrowth(Base):
+    __tablename__ = "daily_growth"
+    day = Column(String, primary_key=True)  # YYYY-MM-DD
+    signups = Column(Integer, nullable=False, default=0)
+    referred_signups = Column(Integer, nullable=False, default=0)
+    credited = Column(Integer, nullable=False, default=0)  # Ledger credits, minor units
+    debited = Column(Integer, nullable=False, default=0)  # Ledger debits as a positive amount
+    users_total = Column(Integer, nullable=True)  # At the end of the day
+    unreachable_total = Column(Integer, nullable=True)
+    liabilities = Column(Integer, nullable=True)  # Sum of all balances at the end of the day
+
+# Signups per referrer and UTC day, for the top referral sources on /dashboard
+class DailyReferrer(Base):
+    __tablename__ = "daily_referrers"
+    day = Column(String, primary_key=True)
+    referrer_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    signups = Column(Integer, nullable=False, default=0)
+
+# Hourly rollups of how often each prompt was used, written by usage.UsageCounter
+class CommandUsage(Base):
+    __tablename__ = "command_usage"
+    prompt = Column(String, primary_key=True)  # Command.command, or usage.UNKNOWN
+    hour = Column(Timestamp, primary_key=True)  # UTC, start of the hour
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index('ix_command_usage_hour', 'hour'),)
+
+# Messages waiting to be sent by outbox.OutboxWorker, written in the same transaction as the change
+# they announce. `key` makes enqueueing idempotent; the partial index only covers pending rows.
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True, nullable=True)  # Idempotency key, e.g. "referral:<referee id>"
+    chat_id = Column(Integer, nullable=False)
+    kind = Column(String, nullable=False)  # "text" or "referral" (coalesced into one digest per chat)
+    payload = Column(JSON, nullable=False)
+    status = Column(String, default="pending", nullable=False)  # pending, sent or failed
+    attempts = Column(Integer, default=0, nullable=False)
+    send_after = Column(Timestamp, nullable=False)  # UTC
+    sent_at = Column(Timestamp, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(Timestamp, default=func.now())
+
+    __table_args__ = (
+        Index('ix_outbox_pending', 'send_after', sqlite_where=text("status = 'pending'")),
+        Index('ix_outbox_pending_chat', 'chat_id', sqlite_where=text("status = 'pending'")),
+    )
 
 class Admin(Base):
     __tablename__ = "admins"
@@ -53,4 +216,64 @@ class Settings(Base):
     strict_join = Column(Boolean, default=False)  # Strict join boolean
     broadcast_chat = Column(String, nullable=True)
 
-Base.metadata.create_all(bind=engine)
+# URLs of the databases whose schema is up to date
+_schema_ready = set()
+
+
+# Full-text index of users for /find_user, kept in sync by triggers. The trigram tokenizer
+# matches any part of a name of 3 or more characters. Created with the users table on new
+# SQLite databases; migration 0012 adds it to older ones.
+USER_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, first_name, last_name, referral_id, content='users', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, first_name, last_name, referral_id)
+        VALUES (new.id, new.username, new.first_name, new.last_name, new.referral_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, referral_id)
+        VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.referral_id);
+    END""",
+    # Only when a searched column really changes, not on every write of last_seen_at or the balance
+    """CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name, last_name, referral_id ON users
+    WHEN old.username IS NOT new.username OR old.first_name IS NOT new.first_name
+        OR old.last_name IS NOT new.last_name OR old.referral_id IS NOT new.referral_id BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, referral_id)
+        VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.referral_id);
+        INSERT INTO users_fts (rowid, username, first_name, last_name, referral_id)
+        VALUES (new.id, new.username, new.first_name, new.last_name, new.referral_id);
+    END""",
+]
+for statement in USER_SEARCH_DDL:
+    event.listen(User.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+
+# Create, migrate and verify the schema of the current bot's database. Called once at startup
+# instead of at import time; when PRAGMA user_version already equals the latest migration the
+# database is left alone.
+def init_db() -> None:
+    engine = current_engine()
+    if str(engine.url) in _schema_ready:
+        return
+    if engine.dialect.name != "sqlite":
+        Base.metadata.create_all(bind=engine)
+        _schema_ready.add(str(engine.url))
+        return
+
+    from migrations import latest_version, get_version, set_version, run_migrations
+
+    with engine.connect() as conn:
+        version = get_version(conn)
+    if version != latest_version():
+        with engine.connect() as conn:
+            # WAL lets the bot keep reading while migrations or other processes write
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+        with engine.begin() as conn:
+            if not inspect(conn).has_table("users"):
+                # A new database gets the current schema straight from the models
+                Base.metadata.create_all(bind=conn)
+                set_version(conn, latest_version())
+        run_migrations(engine)
+        # Tables added since the database was created that no migration had to touch
+        Base.metadata.create_all(bind=engine)
+    _schema_ready.add(str(engine.url))
@@ -0,0 +1,7 @@
+import ledger
+
+
+def referral_digest(referrals: int, credited: int) -> str:
+    if referrals == 1:
+        return "You have received a referral bonus!" + (f" +{ledger.format_amount(credited)}" if credited else "")
+    return f"🎉 +{referrals} referrals" + (f", +{ledger.format_amount(credited)} earned" if credited else "")
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from sqlalchemy import bindparam, delete, select, text, update as sql_update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from config import OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION_DAYS, REFERRAL_DIGEST_SECONDS
+from models import engine as default_engine, OutboxMessage, User
+from notifications import referral_digest
+from schedules import utc_now
+
+logger = logging.getLogger(__name__)
+
+# Kinds of outbox messages
+REFERRAL = "referral"  # payload {"credited"}; all pending ones of a chat are sent as one digest
+
+# Pause between messages, under Telegram's ~30 messages per second
+SEND_INTERVAL = 0.05
+# Delay before the first retry of a failed send, doubled for every further attempt
+RETRY_SECONDS = 5
+# How often sent and failed messages past OUTBOX_RETENTION_DAYS are deleted
+PRUNE_SECONDS = 3600
+
+
+# Queue a message in the caller's transaction (the caller commits), so it is sent if and only if
+# the change it announces is saved. A message whose key is already in the outbox is ignored.
+def enqueue(db, chat_id: int, kind: str, payload: dict, key: str = None, delay: float = 0) -> None:
+    now = utc_now()
+    db.execute(
+        sqlite_insert(OutboxMessage)
+        .values(key=key, chat_id=chat_id, kind=kind, payload=payload, status="pending", attempts=0,
+                send_after=now + timedelta(seconds=delay), created_at=now)
+        .on_conflict_do_nothing(index_elements=["key"])
+    )
+
+
+# Referral bonuses wait REFERRAL_DIGEST_SECONDS, and everything a referrer earned by then is one message
+def referral_bonus(db, chat_id: int, credited: int, key: str) -> None:
+    enqueue(db, chat_id, REFERRAL, {"credited": credited}, key, delay=REFERRAL_DIGEST_SECONDS)
+
+
+# Sends the outbox in batches from a background task. A message is marked sent right after
+# Telegram accepts it, so a crash repeats at most the one message being sent.
+class OutboxWorker:
+    def __init__(self, poll_interval: float, bind=None):
+        self.poll_interval = poll_interval
+        self.bind = bind or default_engine
+        self._task = None
+        self._stopping = None
+        self._pruned_at = 0.0
+
+    # Must be called from the event loop
+    def start(self, bot) -> None:
+        self._stopping = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+
+    # Waits for the message being sent; unsent messages stay in the outbox for the next start
+    async def stop(self) -> None:
+        if self._task:
+            self._stopping.set()
+            await self._task
+
+    # Sleep, returning early when stopping
+    async def _wait(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self, bot) -> None:
+        while not self._stopping.is_set():
+            handled = 0
+            try:
+                if time.monotonic() - self._pruned_at > PRUNE_SECONDS:
+                    await asyncio.to_thread(self._prune)
+                    self._pruned_at = time.monotonic()
+                handled = await self.drain(bot)
+            except Exception:
+                logger.exception("Error sending outbox messages")
+            # A full batch means more are probably due
+            if handled < OUTBOX_BATCH_SIZE:
+                await self._wait(self.poll_interval)
+
+    # Send one batch of due messages; returns the number of outbox rows read
+    async def drain(self, bot) -> int:
+        rows, messages = await asyncio.to_thread(self._due)
+        for ids, chat_id, message in messages:
+            if self._stopping and self._stopping.is_set():
+                break
+            try:
+                await bot.send_message(chat_id, message)
+            except RetryAfter as e:
+                # Not an attempt of this message; it is sent in a later batch
+                await self._wait(e.retry_after)
+                continue
+            except (Forbidden, BadRequest) as e:
+                # Blocked the bot, deleted account, ... Retrying won't help
+                logger.warning("Outbox message to %s not sent: %s", chat_id, e)
+                await asyncio.to_thread(self._failed, ids, str(e), isinstance(e, Forbidden) and chat_id)
+            except (NetworkError, TelegramError) as e:
+                await asyncio.to_thread(self._retry, ids, str(e))
+            else:
+                await asyncio.to_thread(self._sent, ids)
+            await asyncio.sleep(SEND_INTERVAL)
+        return rows
+
+    # Due messages as (outbox ids, chat_id, text), with every pending referral of a chat, due
+    # or not, merged into that chat's digest
+    def _due(self):
+        columns = (OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.kind, OutboxMessage.payload)
+        with self.bind.connect() as conn:
+            due = conn.execute(
+                select(*columns)
+                .where(OutboxMessage.status == "pending", OutboxMessage.send_after <= utc_now())
+                .order_by(OutboxMessage.send_after).limit(OUTBOX_BATCH_SIZE)
+            ).all()
+            chats = {row.chat_id for row in due if row.kind == REFERRAL}
+            referrals = conn.execute(
+                select(*columns).where(OutboxMessage.status == "pending", OutboxMessage.kind == REFERRAL,
+                                       OutboxMessage.chat_id.in_(chats))
+            ).all() if chats else []
+
+        digests = {}  # chat_id -> [ids, credited]
+        for row in referrals:
+            digest = digests.setdefault(row.chat_id, [[], 0])
+            digest[0].append(row.id)
+            digest[1] += row.payload.get("credited") or 0
+        messages = []
+        for row in due:
+            if row.chat_id in digests:
+                ids, credited = digests.pop(row.chat_id)
+                messages.append((ids, row.chat_id, referral_digest(len(ids), credited)))
+        return len(due), messages
+
+    def _sent(self, ids: list) -> None:
+        with self.bind.begin() as conn:
+            conn.execute(sql_update(OutboxMessage)
+                         .where(OutboxMessage.id.in_(ids), OutboxMessage.status == "pending")
+                         .values(status="sent", sent_at=utc_now(), attempts=OutboxMessage.attempts + 1))
+
+    # `unreachable` is the chat that blocked the bot, if that's why it failed
+    def _failed(self, ids: list, error: str, unreachable: int = None) -> None:
+        with self.bind.begin() as conn:
+            conn.execute(sql_update(OutboxMessage).where(OutboxMessage.id.in_(ids))
+                         .values(status="failed", last_error=error, attempts=OutboxMessage.attempts + 1))
+            if unreachable:
+                conn.execute(sql_update(User).where(User.telegram_id == unreachable).values(unreachable_at=utc_now()))
+
+    # Try again after RETRY_SECONDS * 2^attempts, until OUTBOX_MAX_ATTEMPTS
+    def _retry(self, ids: list, error: str) -> None:
+        with self.bind.begin() as conn:
+            conn.execute(text("""
+                UPDATE outbox SET
+                    attempts = attempts + 1,
+                    last_error = :error,
+                    status = CASE WHEN attempts + 1 >= :max_attempts THEN 'failed' ELSE 'pending' END,
+                    send_after = datetime(:now, '+' || (:retry << attempts) || ' seconds')
+                WHERE id IN :ids
+            """).bindparams(bindparam("ids", expanding=True)),
+                {"error": error, "max_attempts": OUTBOX_MAX_ATTEMPTS, "retry": RETRY_SECONDS,
+                 "now": utc_now().strftime("%Y-%m-%d %H:%M:%S"), "ids": ids})
+
+    def _prune(self) -> None:
+        with self.bind.begin() as conn:
+            conn.execute(delete(OutboxMessage).where(
+                OutboxMessage.status != "pending",
+                OutboxMessage.created_at < utc_now() - timedelta(days=OUTBOX_RETENTION_DAYS)))
@@ -0,0 +1,210 @@
+import csv
+import hashlib
+import io
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import text
+
+import ledger
+from config import EARNINGS_MINOR_UNITS
+from models import SessionLocal, current_engine
+
+# Columns of a payout file; other columns are ignored
+FIELDS = ["telegram_id", "amount", "note"]
+REQUIRED_FIELDS = ["telegram_id", "amount"]
+# Columns of the result file sent back
+RESULT_FIELDS = ["row", "telegram_id", "amount", "note", "status", "balance"]
+
+
+# Rows of a CSV or XLSX document with a header row, as dicts of lower-cased column names.
+# Empty rows are skipped; each dict keeps its row number in the file under "row".
+def read_document(data: bytes, filename: str = "") -> list:
+    if filename.lower().endswith(".xlsx") or data[:2] == b"PK":
+        # openpyxl is only loaded when a spreadsheet is uploaded
+        from openpyxl import load_workbook
+        try:
+            workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        except Exception as e:
+            raise ValueError(f"The spreadsheet could not be read: {e}")
+        try:
+            lines = [list(values) for values in workbook.active.iter_rows(values_only=True)]
+        finally:
+            workbook.close()
+    else:
+        try:
+            lines = list(csv.reader(io.StringIO(data.decode("utf-8-sig"))))
+        except (UnicodeDecodeError, csv.Error) as e:
+            raise ValueError(f"The file must be a UTF-8 CSV or an XLSX spreadsheet ({e})")
+    if not lines:
+        raise ValueError("The file is empty.")
+
+    header = [str(name or "").strip().lower() for name in lines[0]]
+    missing = [name for name in REQUIRED_FIELDS if name not in header]
+    if missing:
+        raise ValueError(f"The first row must name the columns {', '.join(FIELDS)} (missing: {', '.join(missing)})")
+    rows = []
+    for number, values in enumerate(lines[1:], start=2):
+        if all(value is None or str(value).strip() == "" for value in values):
+            continue
+        row = {name: value for name, value in zip(header, values) if name in FIELDS}
+        row["row"] = number
+        rows.append(row)
+    return rows
+
+
+def _telegram_id(value) -> int:
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        number = None
+    if number is None or number != number.to_integral_value() or number <= 0:
+        raise ValueError(f"telegram_id must be a Telegram user ID, not '{value}'")
+    return int(number)
+
+
+# Amount in whole units -> minor units; negative amounts are paid out, positive ones credited
+def _amount(value) -> int:
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"amount must be a number, not '{value}'")
+    if not amount.is_finite():
+        raise ValueError(f"amount must be a number, not '{value}'")
+    minor = amount * EARNINGS_MINOR_UNITS
+    if minor != minor.to_integral_value():
+        raise ValueError(f"amount {value} is more precise than {ledger.format_amount(1)}")
+    if minor == 0:
+        raise ValueError("amount is 0")
+    return int(minor)
+
+
+# Check each row on its own (no database) and return (payouts, errors). A user may only
+# appear once per file.
+def parse(rows: list):
+    payouts, errors, seen = [], {}, {}
+    for row in rows:
+        try:
+            telegram_id = _telegram_id(row.get("telegram_id"))
+            amount = _amount(row.get("amount"))
+            if telegram_id in seen:
+                raise ValueError(f"telegram_id {telegram_id} is already on row {seen[telegram_id]}")
+            seen[telegram_id] = row["row"]
+            note = str(row.get("note") or "").strip()
+            payouts.append({"row": row["row"], "telegram_id": telegram_id, "amount": amount, "note": note})
+        except ValueError as e:
+            errors[row["row"]] = str(e)
+    return payouts, errors
+
+
+# Look up the user and balance of every payout with one join against a temporary table of the
+# file, instead of a query per row. Returns {row: (user id, balance)} for rows whose user exists.
+def _lookup(conn, payouts: list) -> dict:
+    conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS payout_rows (row INTEGER PRIMARY KEY, telegram_id INTEGER NOT NULL)"))
+    try:
+        conn.execute(text("INSERT INTO payout_rows (row, telegram_id) VALUES (:row, :telegram_id)"),
+                     [{"row": payout["row"], "telegram_id": payout["telegram_id"]} for payout in payouts])
+        found = conn.execute(text("SELECT p.row, u.id, u.balance FROM payout_rows p "
+                                  "JOIN users u ON u.telegram_id = p.telegram_id")).all()
+    finally:
+        conn.execute(text("DROP TABLE IF EXISTS temp.payout_rows"))
+    return {row: (user_id, balance or 0) for row, user_id, balance in found}
+
+
+# Errors of payouts whose user doesn't exist or whose balance would drop below 0
+def _check(payouts: list, users: dict) -> dict:
+    errors = {}
+    for payout in payouts:
+        if payout["row"] not in users:
+            errors[payout["row"]] = "no user with this telegram_id"
+            continue
+        balance = users[payout["row"]][1]
+        if payout["amount"] < 0 and balance + payout["amount"] < 0:
+            errors[payout["row"]] = (f"balance {ledger.format_amount(balance)} is less than the payout "
+                                     f"of {ledger.format_amount(-payout['amount'])}")
+    return errors
+
+
+def summarize(payouts: list) -> dict:
+    credits = sum(payout["amount"] for payout in payouts if payout["amount"] > 0)
+    debits = -sum(payout["amount"] for payout in payouts if payout["amount"] < 0)
+    return {"rows": len(payouts), "credits": credits, "debits": debits, "net": credits - debits}
+
+
+# Ledger references of a file start with its digest, so the same file is never applied twice
+def file_reference(data: bytes) -> str:
+    return f"payout:{hashlib.sha256(data).hexdigest()[:16]}"
+
+
+def _applied(conn, reference: str) -> bool:
+    return conn.execute(
+        text("SELECT 1 FROM ledger_entries WHERE reason IN (:payout, :adjustment) AND reference LIKE :prefix LIMIT 1"),
+        {"payout": ledger.PAYOUT, "adjustment": ledger.ADJUSTMENT, "prefix": f"{reference}:%"},
+    ).first() is not None
+
+
+# Check the parsed payouts against the users table without changing anything, for the
+# preview. Returns errors by row. Blocking.
+def validate(payouts: list, reference: str) -> dict:
+    with current_engine().connect() as conn:
+        if _applied(conn, reference):
+            return {0: "this file was already applied"}
+        return _check(payouts, _lookup(conn, payouts))
+
+
+# Check the payouts again and apply all of them in one transaction, or none if any row fails.
+# Returns (errors by row, new balances by row). Blocking, run it with asyncio.to_thread.
+def apply(payouts: list, reference: str):
+    db = SessionLocal()
+    try:
+        conn = db.connection()
+        # Take SQLite's write lock first, so balances can't change between the check and the update
+        conn.execute(text("UPDATE users SET balance = balance WHERE 0"))
+        if _applied(conn, reference):
+            db.rollback()
+            return {0: "this file was already applied"}, {}
+        users = _lookup(conn, payouts)
+        errors = _check(payouts, users)
+        if errors:
+            db.rollback()
+            return errors, {}
+        ledger.post_many(db, [{
+            "user_id": users[payout["row"]][0],
+            "amount": payout["amount"],
+            "reason": ledger.ADJUSTMENT if payout["amount"] > 0 else ledger.PAYOUT,
+            "reference": f"{reference}:{payout['row']}" + (f" {payout['note']}" if payout["note"] else ""),
+        } for payout in payouts])
+        db.commit()
+        return {}, {payout["row"]: users[payout["row"]][1] + payout["amount"] for payout in payouts}
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+# CSV with every row of the file and what happened to it
+def result_file(rows: list, payouts: list, errors: dict, balances: dict) -> bytes:
+    amounts = {payout["row"]: payout for payout in payouts}
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=RESULT_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        number = row["row"]
+        payout = amounts.get(number)
+        if number in errors:
+            status = f"error: {errors[number]}"
+        elif balances:
+            status = "applied"
+        elif errors:
+            status = "not applied"
+        else:
+            status = "ok"
+        writer.writerow({
+            "row": number,
+            "telegram_id": payout["telegram_id"] if payout else row.get("telegram_id"),
+            "amount": ledger.format_amount(payout["amount"]) if payout else row.get("amount"),
+            "note": payout["note"] if payout else row.get("note"),
+            "status": status,
+            "balance": ledger.format_amount(balances[number]) if number in balances else "",
+        })
+    return output.getvalue().encode("utf-8-sig")
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import time
+
+from sqlalchemy import and_, bindparam, delete, insert, select
+from telegram.ext import BasePersistence, PersistenceInput
+
+import conversations
+from models import current_engine, PersistedData, PersistedConversation
+
+logger = logging.getLogger(__name__)
+
+
+# Encode user_data/chat_data as JSON. Values that can't be stored as JSON are kept in memory
+# only, so one odd value never stops a conversation from being saved.
+def _encode(data: dict):
+    if not data:
+        return None
+    stored = {}
+    for key, value in data.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            logger.warning("Not persisting %r: %s is not JSON serializable", key, type(value).__name__)
+            continue
+        stored[str(key)] = value
+    return json.dumps(stored, sort_keys=True, ensure_ascii=False) if stored else None
+
+
+# Persistence for ConversationHandler states and user_data/chat_data in the bot's own database.
+# PTB hands over changed entries every update_interval seconds; only entries whose JSON differs
+# from what was last written are saved, all in one transaction. bot_data is not persisted, it
+# holds runtime objects such as the metrics server. Conversation timeouts don't survive a
+# restart, so conversations whose user was idle longer than `conversation_timeout` aren't restored.
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval: float = 60, bind=None, conversation_timeout: float = None):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.bind = bind or current_engine()
+        self.conversation_timeout = conversation_timeout
+        self._user_data = {}  # As loaded, for the conversation timeouts
+        self._written = {}  # ("user"|"chat", id) or ("conversation", name, key) -> JSON last written
+        self._dirty = {}  # same keys -> JSON to write, None to delete
+        self._flush_task = None
+
+    # Loading, called once by Application.initialize
+
+    def _load_data(self, kind: str) -> dict:
+        with self.bind.connect() as conn:
+            rows = conn.execute(select(PersistedData.id, PersistedData.data).where(PersistedData.kind == kind)).all()
+        result = {}
+        for row_id, data in rows:
+            self._written[(kind, row_id)] = data
+            result[row_id] = json.loads(data)
+        return result
+
+    async def get_user_data(self) -> dict:
+        self._user_data = await asyncio.to_thread(self._load_data, "user")
+        return self._user_data
+
+    async def get_chat_data(self) -> dict:
+        return await asyncio.to_thread(self._load_data, "chat")
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    def _load_conversations(self, name: str) -> dict:
+        with self.bind.connect() as conn:
+            rows = conn.execute(select(PersistedConversation.key, PersistedConversation.state)
+                                .where(PersistedConversation.name == name)).all()
+        result = {}
+        for key, state in rows:
+            self._written[("conversation", name, key)] = state
+            result[tuple(json.loads(key))] = json.loads(state)
+        return result
+
+    async def get_conversations(self, name: str) -> dict:
+        states = await asyncio.to_thread(self._load_conversations, name)
+        if self.conversation_timeout:
+            cutoff = time.time() - self.conversation_timeout
+            for key in [key for key in states
+                        if (self._user_data.get(key[-1]) or {}).get(conversations.STEP_AT, 0) < cutoff]:
+                del states[key]
+                await self.update_conversation(name, key, None)
+        return states
+
+    # Updates, called by Application.update_persistence for what changed since the last run
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        await self._mark(("conversation", name, json.dumps(list(key))), state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._mark(("user", user_id), _encode(data))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._mark(("chat", chat_id), _encode(data))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._mark(("user", user_id), None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._mark(("chat", chat_id), None)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    # user_data and chat_data live in memory; there is nothing newer in the database
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task:
+            await self._flush_task
+        await self._write_dirty()
+
+    # Writing
+
+    async def _mark(self, key: tuple, value) -> None:
+        if self._written.get(key) == value and key not in self._dirty:
+            return
+        self._dirty[key] = value
+        # PTB runs all updates of one run concurrently; they share one flush and one transaction
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._coalesced_flush())
+        await asyncio.shield(self._flush_task)
+
+    async def _coalesced_flush(self) -> None:
+        try:
+            await asyncio.sleep(0)
+        finally:
+            self._flush_task = None
+        await self._write_dirty()
+
+    async def _write_dirty(self) -> None:
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self._write, dirty)
+        except Exception:
+            # Keep the entries for the next run unless they changed again meanwhile
+            for key, value in dirty.items():
+                self._dirty.setdefault(key, value)
+            raise
+        for key, value in dirty.items():
+            if value is None:
+                self._written.pop(key, None)
+            else:
+                self._written[key] = value
+
+    def _write(self, dirty: dict) -> None:
+        data = [(key[0], key[1], value) for key, value in dirty.items() if key[0] != "conversation"]
+        conversations = [(key[1], key[2], value) for key, value in dirty.items() if key[0] == "conversation"]
+        with self.bind.begin() as conn:
+            if data:
+                conn.execute(
+                    delete(PersistedData).where(and_(PersistedData.kind == bindparam("b_kind"),
+                                                     PersistedData.id == bindparam("b_id"))),
+                    [{"b_kind": kind, "b_id": row_id} for kind, row_id, _ in data],
+                )
+                rows = [{"kind": kind, "id": row_id, "data": value} for kind, row_id, value in data if value is not None]
+                if rows:
+                    conn.execute(insert(PersistedData), rows)
+            if conversations:
+                conn.execute(
+                    delete(PersistedConversation).where(and_(PersistedConversation.name == bindparam("b_name"),
+                                                             PersistedConversation.key == bindparam("b_key"))),
+                    [{"b_name": name, "b_key": key} for name, key, _ in conversations],
+                )
+                rows = [{"name": name, "key": key, "state": value} for name, key, value in conversations if value is not None]
+                if rows:
+                    conn.execute(insert(PersistedConversation), rows)
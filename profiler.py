@@ -0,0 +1,121 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_running = False
+
+
+def is_running() -> bool:
+    return _running
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# Samples the stack of one thread at a fixed interval and counts collapsed stacks
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+    # Collapsed stack format, one "frame;frame;frame count" per line, as read by flamegraph.pl and speedscope
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+
+# Profile everything running on the event loop thread for the given number of seconds.
+# Returns (short top list, full pstats report, collapsed stacks).
+async def profile_loop(seconds: float, top: int = 15):
+    global _running
+    _running = True
+    profile = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident())
+    try:
+        sampler.start()
+        profile.enable()
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+        sampler.stop()
+        _running = False
+
+    report = io.StringIO()
+    stats = pstats.Stats(profile, stream=report).sort_stats("cumulative")
+    stats.print_stats(60)
+
+    summary = f"🔬 Top {top} functions by cumulative time ({seconds:g}s window):\n\n"
+    entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    for (filename, line, name), (_, calls, _, cumulative, _) in entries:
+        summary += f"{cumulative:.3f}s  {calls} calls  {name} ({os.path.basename(filename)}:{line})\n"
+    return summary, report.getvalue(), sampler.collapsed()
+
+
+# Logs the stack of whatever blocks the event loop for longer than the threshold
+class LoopWatchdog:
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.stalls = 0
+        self._last_beat = time.monotonic()
+        self._heartbeat_task = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    # Must be called from the event loop thread
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self) -> None:
+        stalled_since = None
+        while not self._stop_event.wait(self.threshold / 4):
+            lag = time.monotonic() - self._last_beat
+            if lag > self.threshold and stalled_since is None:
+                stalled_since = self._last_beat
+                self.stalls += 1
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)[-12:]) if frame else "unknown\n"
+                logger.warning("Event loop blocked for %.3fs, currently in:\n%s", lag, stack)
+            elif lag <= self.threshold and stalled_since is not None:
+                logger.warning("Event loop resumed after blocking for about %.3fs", self._last_beat - stalled_since)
+                stalled_since = None
@@ -0,0 +1,173 @@
+"""Replay captured traffic against the fake Bot API and compare code versions.
+
+Record traffic with CAPTURE_FILE in config.py, then replay it on each code
+version and compare the results:
+
+    python replay.py run captures/traffic.jsonl.gz --database my_bot.db --out before.jsonl.gz
+    git checkout my-branch
+    python replay.py run captures/traffic.jsonl.gz --database my_bot.db --out after.jsonl.gz
+    python replay.py compare before.jsonl.gz after.jsonl.gz
+
+--database replays against a copy of a database snapshot whose user and
+admin IDs are pseudonymized with the same secret as the capture, so
+captured users and admins line up with their rows.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import config
+from bench import percentile
+
+# Parameters that depend on fake message numbering rather than on the bot's behaviour
+IGNORED_PARAMS = ("message_id",)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay captured updates and compare runs.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Replay a capture and record latency and outputs")
+    run_parser.add_argument("capture", help="Capture file written by CAPTURE_FILE")
+    run_parser.add_argument("--out", required=True, help="Where to write the results (.jsonl.gz)")
+    run_parser.add_argument("--database", help="SQLite database snapshot to replay against (a copy is used)")
+    run_parser.add_argument("--secret", default=config.SECRET_KEY, help="Secret the capture was pseudonymized with")
+    run_parser.add_argument("--pace", choices=["fast", "original"], default="fast")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="Speed-up factor for --pace original")
+    run_parser.add_argument("--latency", type=float, default=0.0, help="Simulated Bot API latency in seconds")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--show", type=int, default=10, help="Differing updates to print")
+    return parser.parse_args()
+
+
+# Map the telegram IDs of a database copy to the pseudonyms used in the capture
+def pseudonymize_database(models, secret: str) -> None:
+    from sqlalchemy import bindparam, select, update
+    from capture import pseudo_id
+
+    with models.engine.begin() as conn:
+        for table in (models.User.__table__, models.Admin.__table__):
+            ids = [row[0] for row in conn.execute(select(table.c.telegram_id).where(table.c.telegram_id > 0))]
+            if not ids:
+                continue
+            # Negate first so no intermediate value collides with the unique index
+            conn.execute(update(table).where(table.c.telegram_id > 0).values(telegram_id=-table.c.telegram_id))
+            conn.execute(
+                update(table).where(table.c.telegram_id == bindparam('old_id')).values(telegram_id=bindparam('new_id')),
+                [{"old_id": -telegram_id, "new_id": pseudo_id(telegram_id, secret)} for telegram_id in ids],
+            )
+
+
+def normalize_call(method: str, params: dict) -> list:
+    return [method, {key: value for key, value in sorted(params.items()) if key not in IGNORED_PARAMS}]
+
+
+async def replay(args, app) -> None:
+    from telegram import Update
+    from telegram.ext import Application
+    from capture import read_capture
+    from fake_telegram import FakeBotAPI, FakeRequest, FAKE_BOT_ID
+
+    api = FakeBotAPI(latency=args.latency)
+    application = (
+        Application.builder()
+        .application_class(app.BotApplication)
+        .token(f"{FAKE_BOT_ID}:replay")
+        .request(FakeRequest(api))
+        .get_updates_request(FakeRequest(api))
+        .updater(None)
+        .build()
+    )
+    app.add_handlers(application)
+    await application.initialize()
+
+    latencies = []
+    previous = None
+    replay_started = time.monotonic()
+    with gzip.open(args.out, "wt", encoding="utf-8") as out:
+        for captured_at, data in read_capture(args.capture):
+            if args.pace == "original" and previous is not None:
+                await asyncio.sleep(max(0.0, (captured_at - previous) / args.speed))
+            previous = captured_at
+
+            update = Update.de_json(data, application.bot)
+            first_call = len(api.calls)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latency = time.perf_counter() - started
+            latencies.append(latency)
+
+            calls = [normalize_call(method, params) for method, params in api.calls[first_call:]]
+            out.write(json.dumps({"update_id": data["update_id"], "latency": latency, "calls": calls},
+                                 ensure_ascii=False, default=str) + "\n")
+
+    await application.shutdown()
+    elapsed = time.monotonic() - replay_started
+    print(f"Replayed {len(latencies)} updates in {elapsed:.1f}s ({len(latencies) / elapsed:.1f}/s), "
+          f"p50 {percentile(latencies, 0.5) * 1000:.2f}ms, p99 {percentile(latencies, 0.99) * 1000:.2f}ms, "
+          f"{len(api.calls)} API calls")
+
+
+def load_results(path: str) -> list:
+    with gzip.open(path, "rt", encoding="utf-8") as results:
+        return [json.loads(line) for line in results if line.strip()]
+
+
+def compare(args) -> None:
+    before = load_results(args.before)
+    after = load_results(args.after)
+    if [r["update_id"] for r in before] != [r["update_id"] for r in after]:
+        print("⚠️ The result files were not produced from the same capture")
+
+    for label, results in (("before", before), ("after", after)):
+        latencies = [r["latency"] for r in results]
+        calls = sum(len(r["calls"]) for r in results)
+        print(f"{label:<7} updates {len(results):>7}  p50 {percentile(latencies, 0.5) * 1000:8.2f}ms  "
+              f"p99 {percentile(latencies, 0.99) * 1000:8.2f}ms  total {sum(latencies):8.2f}s  API calls {calls}")
+
+    differing = [(b, a) for b, a in zip(before, after) if b["calls"] != a["calls"]]
+    print(f"\n{len(differing)} of {min(len(before), len(after))} updates produced different outputs")
+    for b, a in differing[:args.show]:
+        print(f"\nupdate {b['update_id']}:\n  before: {json.dumps(b['calls'], ensure_ascii=False)}"
+              f"\n  after:  {json.dumps(a['calls'], ensure_ascii=False)}")
+
+
+def main() -> None:
+    args = parse_args()
+    if args.action == "compare":
+        compare(args)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bot_replay_")
+    database = os.path.join(workdir, "replay.db")
+    if args.database:
+        shutil.copyfile(args.database, database)
+    # Run against the copy and the fake Bot API only, and never re-capture the replay
+    config.DATABASE_URL = f"sqlite:///{database}"
+    config.BROADCAST_DELAY = 0
+    config.CAPTURE_FILE = None
+    import models
+    import app
+    models.init_db()
+
+    if args.database:
+        pseudonymize_database(models, args.secret)
+    # Referral codes are random; seed them so runs of the same capture are comparable
+    random.seed(0)
+    try:
+        asyncio.run(replay(args, app))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from config import SCHEDULE_TIMEZONE, BROADCAST_DELAY
+from models import SessionLocal, ScheduledBroadcast
+
+RECURRENCES = {"daily": timedelta(days=1), "weekly": timedelta(weeks=1)}
+# Scheduled sends are kept at least this far apart
+SLOT_GAP = timedelta(minutes=5)
+
+SCHEDULE_HELP = "/schedule <YYYY-MM-DD HH:MM | HH:MM> [daily|weekly]"
+# How ScheduledBroadcast.local_start is written
+LOCAL_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def local_zone() -> ZoneInfo:
+    return ZoneInfo(SCHEDULE_TIMEZONE)
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+
+def to_local(send_at: datetime) -> str:
+    return send_at.replace(tzinfo=timezone.utc).astimezone(local_zone()).strftime(LOCAL_FORMAT)
+
+
+# Naive wall-clock time in SCHEDULE_TIMEZONE -> naive UTC
+def to_utc(local: datetime) -> datetime:
+    return local.replace(tzinfo=local_zone()).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# The first of start, start + step, start + 2 * step, ... (wall-clock times in SCHEDULE_TIMEZONE)
+# that is sent after `after` (naive UTC). Stepping the wall-clock time keeps the local hour
+# across daylight saving changes.
+def _step_past(start: datetime, step: timedelta, after: datetime) -> datetime:
+    local_after = after.replace(tzinfo=timezone.utc).astimezone(local_zone()).replace(tzinfo=None)
+    if start < local_after:
+        start += step * ((local_after - start) // step)
+    while to_utc(start) <= after:
+        start += step
+    return start
+
+
+# Parse /schedule arguments into (first send time in naive UTC, recurrence, local start for
+# ScheduledBroadcast.local_start). A bare HH:MM means its next occurrence, and a recurring
+# broadcast that starts in the past starts at its next run. Times are in SCHEDULE_TIMEZONE.
+def parse_schedule(args: list, now: datetime = None):
+    args = list(args)
+    recurrence = None
+    if args and args[-1].lower() in RECURRENCES:
+        recurrence = args.pop().lower()
+    if args and args[0].lower() in RECURRENCES and recurrence is None:
+        recurrence = args.pop(0).lower()
+
+    local_now = (now or utc_now()).replace(tzinfo=timezone.utc).astimezone(local_zone())
+    try:
+        if len(args) == 2:
+            local = datetime.strptime(" ".join(args), "%Y-%m-%d %H:%M").replace(tzinfo=local_zone())
+        elif len(args) == 1:
+            clock = datetime.strptime(args[0], "%H:%M")
+            local = local_now.replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+            if local <= local_now:
+                local += timedelta(days=1)
+        else:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"Usage: {SCHEDULE_HELP}")
+    local = local.replace(tzinfo=None)
+    if recurrence:
+        local = _step_past(local, RECURRENCES[recurrence], now or utc_now())
+    send_at = to_utc(local)
+    if send_at <= (now or utc_now()):
+        raise ValueError("That time has already passed.")
+    return send_at, recurrence, local.strftime(LOCAL_FORMAT)
+
+
+def estimate_seconds(audience: int) -> float:
+    return audience * (BROADCAST_DELAY + 0.05)
+
+
+# Move a send time forward until it doesn't overlap another pending scheduled broadcast
+# (including SLOT_GAP on both sides), so large sends never run on top of each other
+def find_slot(db, send_at: datetime, seconds: float, exclude_id: int = None) -> datetime:
+    pending = db.query(ScheduledBroadcast).filter(ScheduledBroadcast.status == "pending")
+    if exclude_id:
+        pending = pending.filter(ScheduledBroadcast.id != exclude_id)
+    busy = sorted((item.send_at, item.send_at + timedelta(seconds=item.estimated_seconds or 0)) for item in pending)
+    duration = timedelta(seconds=seconds)
+    for start, end in busy:
+        if send_at < end + SLOT_GAP and start < send_at + duration + SLOT_GAP:
+            send_at = end + SLOT_GAP
+    return send_at
+
+
+# The next send time (naive UTC) of a recurring broadcast after `after`. Runs are counted from
+# its local start, not from send_at, which find_slot may have moved.
+def next_run(item: ScheduledBroadcast, after: datetime) -> datetime:
+    if item.local_start:
+        start = datetime.strptime(item.local_start, LOCAL_FORMAT)
+    else:
+        start = datetime.strptime(to_local(item.send_at), LOCAL_FORMAT)
+    return to_utc(_step_past(start, RECURRENCES[item.recurrence], after))
+
+
+def pending_broadcasts():
+    db = SessionLocal()
+    try:
+        return db.query(ScheduledBroadcast).filter(ScheduledBroadcast.status == "pending") \
+            .order_by(ScheduledBroadcast.send_at).all()
+    finally:
+        db.close()
+
+
+def describe(item: ScheduledBroadcast) -> str:
+    repeat = f", {item.recurrence}" if item.recurrence else ""
+    preview = item.message if len(item.message) <= 40 else item.message[:40] + "…"
+    return f"#{item.id} {to_local(item.send_at)}{repeat}: {preview}"
@@ -0,0 +1,79 @@
+from sqlalchemy import text
+
+from models import current_engine
+
+# Users listed per page of /find_user
+PAGE_SIZE = 10
+# The trigram index can't match shorter words
+MIN_WORD_LENGTH = 3
+# Telegram user IDs are shorter than this many digits
+MAX_ID_DIGITS = 16
+
+
+# FTS5 query matching users whose username, names or referral code contain every word of
+# `query`, e.g. 'joh smi' -> '"joh" AND "smi"'. None when no word is long enough.
+def match_expression(query: str):
+    words = [word for word in query.replace("@", " ").split() if len(word) >= MIN_WORD_LENGTH]
+    if not words:
+        return None
+    return " AND ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+# The telegram_id ranges holding the IDs that start with `digits`, one per possible ID length,
+# e.g. '12' -> [12, 13), [120, 130), [1200, 1300), ...
+def id_prefix_ranges(digits: str) -> list:
+    if digits.startswith("0") or len(digits) > MAX_ID_DIGITS:
+        return []
+    number = int(digits)
+    return [(number * 10 ** k, (number + 1) * 10 ** k) for k in range(MAX_ID_DIGITS - len(digits) + 1)]
+
+
+# One page of the users matching `query`, newest first, with an exact Telegram ID match on top.
+# A number also finds the users whose Telegram ID starts with it.
+# Returns (rows, more) where rows have telegram_id, username, first_name, last_name,
+# referral_id, balance and referrals. Raises ValueError for queries nothing can match. Blocking.
+def find_users(query: str, page: int = 0):
+    query = query.strip()
+    match = match_expression(query)
+    number = int(query) if query.isdigit() else None
+    if match is None and number is None:
+        raise ValueError(f"Search for at least {MIN_WORD_LENGTH} characters of a name, or a Telegram ID.")
+
+    candidates, ranges = [], {}
+    if number is not None:
+        candidates.append("SELECT id FROM users WHERE telegram_id = :number")
+        # Each range is read from the telegram_id index, only as far as needed up to this page
+        for index, (low, high) in enumerate(id_prefix_ranges(query)):
+            ranges.update({f"low{index}": low, f"high{index}": high})
+            candidates.append(f"SELECT id FROM (SELECT id FROM users WHERE telegram_id >= :low{index} "
+                              f"AND telegram_id < :high{index} ORDER BY id DESC LIMIT :needed)")
+    if match is not None:
+        # Only the rows needed up to this page are read from the index
+        candidates.append("SELECT id FROM (SELECT rowid AS id FROM users_fts WHERE users_fts MATCH :match "
+                          "ORDER BY rowid DESC LIMIT :needed)")
+    statement = text(f"""
+        SELECT u.telegram_id, u.username, u.first_name, u.last_name, u.referral_id, u.balance,
+               (SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = u.id) AS referrals
+        FROM users u
+        WHERE u.id IN ({" UNION ".join(candidates)})
+        ORDER BY u.telegram_id = :number DESC, u.id DESC
+        LIMIT :limit OFFSET :offset
+    """)
+    with current_engine().connect() as conn:
+        rows = conn.execute(statement, {
+            "number": number, "match": match, "needed": (page + 1) * PAGE_SIZE + 1,
+            "limit": PAGE_SIZE + 1, "offset": page * PAGE_SIZE, **ranges,
+        }).all()
+    return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+
+
+# A user with their balance, referral counts and activity, for the detail view. Blocking.
+def user_details(telegram_id: int):
+    with current_engine().connect() as conn:
+        return conn.execute(text("""
+            SELECT u.telegram_id, u.username, u.first_name, u.last_name, u.referral_id, u.balance,
+                   u.created_at, u.last_seen_at, referrer.telegram_id AS referrer,
+                   (SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = u.id) AS referrals
+            FROM users u LEFT JOIN users referrer ON referrer.id = u.referer_id
+            WHERE u.telegram_id = :telegram_id
+        """), {"telegram_id": telegram_id}).first()
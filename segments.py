@@ -0,0 +1,198 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, or_, exists, func, select, update as sql_update, insert as sql_insert
+
+import ledger
+import tenants
+from models import current_engine, SessionLocal, User, Referral, ChatMember, Settings
+
+# Counting stops after this many matches and switches to sampling
+COUNT_LIMIT = 20_000
+SAMPLE_WINDOWS = 50
+SAMPLE_ROWS = 50_000
+
+SEGMENT_HELP = (
+    "joined_after YYYY-MM-DD\n"
+    "joined_before YYYY-MM-DD\n"
+    "has_referrals\n"
+    "earnings_above <amount>\n"
+    "referred_by <telegram id | @username | referral code>\n"
+    "active_within <days>\n"
+    "not_in <required chat name>"
+)
+
+# Last membership written per (chat_id, telegram_id) is kept per bot (Tenant.memberships),
+# cleared when it grows past the limit
+MEMBERSHIP_CACHE_SIZE = 100_000
+
+
+def _parse_date(value: str) -> str:
+    datetime.strptime(value, "%Y-%m-%d")
+    return value
+
+
+def _parse_number(value: str) -> float:
+    return float(value)
+
+
+def _parse_days(value: str) -> int:
+    days = int(value)
+    if days <= 0:
+        raise ValueError
+    return days
+
+
+# Filter name -> (parser for its argument or None for flags, what the argument should look like)
+FILTERS = {
+    "joined_after": (_parse_date, "a date like 2024-06-01"),
+    "joined_before": (_parse_date, "a date like 2024-06-01"),
+    "has_referrals": (None, ""),
+    "earnings_above": (_parse_number, "a number"),
+    "referred_by": (str, "a telegram ID, @username or referral code"),
+    "active_within": (_parse_days, "a number of days"),
+    "not_in": (str, "the name of a required chat"),
+}
+
+
+# Parse filters, one per line ("earnings_above 10"), into a JSON-friendly dict
+def parse_segment(text: str) -> dict:
+    segment = {}
+    for line in text.strip().splitlines():
+        if not line.strip():
+            continue
+        name, _, argument = line.strip().partition(" ")
+        name, argument = name.lower(), argument.strip()
+        if name not in FILTERS:
+            raise ValueError(f"Unknown filter '{name}'. Available filters:\n{SEGMENT_HELP}")
+        parser, expected = FILTERS[name]
+        if parser is None:
+            segment[name] = True
+            continue
+        try:
+            segment[name] = parser(argument)
+        except ValueError:
+            raise ValueError(f"'{name}' needs {expected}")
+        if segment[name] == "":
+            raise ValueError(f"'{name}' needs {expected}")
+    return segment
+
+
+def describe_segment(segment: dict) -> str:
+    if not segment:
+        return "all users"
+    return ", ".join(name if value is True else f"{name} {value}" for name, value in segment.items())
+
+
+def _referrer_id(db, value: str):
+    value = value.strip()
+    if value.startswith("@"):
+        return db.query(User.id).filter(User.username == value[1:]).scalar()
+    if value.isdigit():
+        referrer_id = db.query(User.id).filter(User.telegram_id == int(value)).scalar()
+        if referrer_id:
+            return referrer_id
+    return db.query(User.id).filter(User.referral_id == value).scalar()
+
+
+def _required_chat_id(db, name: str):
+    settings = db.query(Settings).first()
+    chats = json.loads(settings.chats_to_join) if settings and settings.chats_to_join else []
+    for chat in chats:
+        if chat['name'] == name.lower() or str(chat['id']) == name:
+            return str(chat['id'])
+    return None
+
+
+# Compile a segment into SQL conditions on users; each one is served by an index
+def segment_conditions(db, segment: dict) -> list:
+    conditions = []
+    if "joined_after" in segment:
+        conditions.append(User.created_at >= datetime.strptime(segment["joined_after"], "%Y-%m-%d"))
+    if "joined_before" in segment:
+        conditions.append(User.created_at < datetime.strptime(segment["joined_before"], "%Y-%m-%d"))
+    if segment.get("has_referrals"):
+        conditions.append(exists().where(Referral.referrer_id == User.id))
+    if "earnings_above" in segment:
+        conditions.append(User.balance > ledger.to_minor(segment["earnings_above"]))
+    if "referred_by" in segment:
+        referrer_id = _referrer_id(db, segment["referred_by"])
+        if referrer_id is None:
+            raise ValueError(f"No user found for '{segment['referred_by']}'")
+        conditions.append(User.referer_id == referrer_id)
+    if "active_within" in segment:
+        since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=segment["active_within"])
+        conditions.append(User.last_seen_at >= since)
+    if "not_in" in segment:
+        chat_id = _required_chat_id(db, segment["not_in"])
+        if chat_id is None:
+            raise ValueError(f"'{segment['not_in']}' is not one of the required chats")
+        # Users whose membership was never checked count as not in the chat
+        conditions.append(~exists().where(and_(
+            ChatMember.chat_id == chat_id, ChatMember.telegram_id == User.telegram_id, ChatMember.is_member,
+        )))
+    return conditions
+
+
+# Fast audience estimate. Exact when fewer than COUNT_LIMIT users match; otherwise counted in
+# SAMPLE_WINDOWS id ranges spread over the table and scaled up. Returns (count, exact).
+def estimate_audience(segment: dict):
+    db = SessionLocal()
+    try:
+        conditions = segment_conditions(db, segment)
+        matches = select(User.id).where(*conditions).limit(COUNT_LIMIT).subquery()
+        found = db.execute(select(func.count()).select_from(matches)).scalar()
+        if found < COUNT_LIMIT:
+            return found, True
+
+        max_id = db.query(func.max(User.id)).scalar()
+        width = max(1, SAMPLE_ROWS // SAMPLE_WINDOWS)
+        step = max(width, max_id // SAMPLE_WINDOWS)
+        ranges = [User.id.between(low + 1, low + width) for low in range(0, max_id, step)]
+        sampled = sum(min(width, max_id - low) for low in range(0, max_id, step))
+        found = db.execute(select(func.count()).where(or_(*ranges), *conditions)).scalar()
+        return int(found * max_id / sampled), False
+    finally:
+        db.close()
+
+
+# Yield (telegram_id, first_name) of the users in a segment, reading batch_size rows at a
+# time by id, so memory and time are proportional to the segment rather than the table
+def stream_audience(segment: dict, batch_size: int = 1000):
+    db = SessionLocal()
+    try:
+        conditions = segment_conditions(db, segment)
+        last_id = 0
+        while True:
+            rows = db.execute(
+                select(User.id, User.telegram_id, User.first_name)
+                .where(User.id > last_id, *conditions)
+                .order_by(User.id)
+                .limit(batch_size)
+            ).all()
+            # Don't keep a read transaction open while the batch is being sent
+            db.rollback()
+            if not rows:
+                return
+            for _, telegram_id, first_name in rows:
+                yield telegram_id, first_name
+            last_id = rows[-1][0]
+    finally:
+        db.close()
+
+
+# Remember the outcome of a membership check for the not_in filter; only changes are written
+def record_membership(chat_id, telegram_id: int, is_member: bool) -> None:
+    known = tenants.current().memberships
+    key = (str(chat_id), telegram_id)
+    if known.get(key) == is_member:
+        return
+    if len(known) >= MEMBERSHIP_CACHE_SIZE:
+        known.clear()
+    known[key] = is_member
+    match = and_(ChatMember.chat_id == str(chat_id), ChatMember.telegram_id == telegram_id)
+    with current_engine().begin() as conn:
+        updated = conn.execute(sql_update(ChatMember).where(match).values(is_member=is_member)).rowcount
+        if not updated:
+            conn.execute(sql_insert(ChatMember).values(chat_id=str(chat_id), telegram_id=telegram_id,
+                                                       is_member=is_member))
@@ -0,0 +1,86 @@
+import asyncio
+import contextvars
+import json
+import os
+
+from sqlalchemy import create_engine
+
+import models
+from activity import ActivityTracker
+from config import BOT_TOKEN, MEDIA_DIR, ACTIVITY_FLUSH_SECONDS, OUTBOX_POLL_SECONDS, USAGE_FLUSH_SECONDS
+from metrics import InstrumentedRequest
+from outbox import OutboxWorker
+from usage import UsageCounter
+
+# Connections of the shared Bot API pool per hosted bot
+CONNECTIONS_PER_TENANT = 4
+
+
+# One bot hosted by this process: its token, database, image store and the state that
+# belongs to that bot alone. Code, the event loop, the HTTP pool and metrics are shared.
+class Tenant:
+    def __init__(self, name: str, token: str, database_url: str = None, media_dir: str = None, engine=None):
+        self.name = name
+        self.token = token
+        self.engine = engine or create_engine(database_url)
+        self.media_dir = media_dir or os.path.join(MEDIA_DIR, name)
+        self.file_ids = {}  # sha256 -> Telegram file_id; file_ids are only valid for the bot that got them
+        self.memberships = {}  # (chat_id, telegram_id) -> last membership written
+        self.help_pages = {}  # "help" and "admin_help" -> rendered pages, see menu.help_pages
+        self.activity = ActivityTracker(ACTIVITY_FLUSH_SECONDS, self.engine)
+        self.outbox = OutboxWorker(OUTBOX_POLL_SECONDS, self.engine)
+        self.usage = UsageCounter(USAGE_FLUSH_SECONDS, self.engine)
+        self.broadcast_lock = asyncio.Lock()  # Scheduled broadcasts of this bot run one at a time
+
+
+# The bot configured in config.py, used when no TENANTS_FILE is set
+DEFAULT = Tenant("default", BOT_TOKEN, media_dir=MEDIA_DIR, engine=models.engine)
+
+_current = contextvars.ContextVar('current_tenant', default=DEFAULT)
+
+
+def current() -> Tenant:
+    return _current.get()
+
+
+# Serve `tenant` in the current context. Tasks created afterwards (the application's update,
+# job and persistence tasks) inherit it, so call this first thing in a task of its own.
+def activate(tenant: Tenant) -> None:
+    _current.set(tenant)
+    models.use_engine(tenant.engine)
+
+
+# Read the tenants file: a JSON list of {"name", "token", "database", "media_dir" (optional)}
+def load_tenants(path: str) -> list:
+    with open(path, encoding="utf-8") as tenants_file:
+        entries = json.load(tenants_file)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must contain a list of tenants")
+    tenants, names, tokens = [], set(), set()
+    for number, entry in enumerate(entries, start=1):
+        missing = [key for key in ("name", "token", "database") if not entry.get(key)]
+        if missing:
+            raise ValueError(f"Tenant {number} in {path} is missing {', '.join(missing)}")
+        if entry["name"] in names or entry["token"] in tokens:
+            raise ValueError(f"Tenant '{entry['name']}' in {path} repeats the name or token of another tenant")
+        names.add(entry["name"])
+        tokens.add(entry["token"])
+        tenants.append(Tenant(entry["name"], entry["token"], entry["database"], entry.get("media_dir")))
+    return tenants
+
+
+# Bot API request shared by every hosted bot, so they use one connection pool. Each bot
+# initializes and shuts down its request; the pool is closed when the last bot is done.
+class SharedRequest(InstrumentedRequest):
+    def __init__(self, tenant_count: int):
+        super().__init__(connection_pool_size=CONNECTIONS_PER_TENANT * tenant_count)
+        self._users = 0
+
+    async def initialize(self) -> None:
+        self._users += 1
+        await super().initialize()
+
+    async def shutdown(self) -> None:
+        self._users -= 1
+        if self._users <= 0:
+            await super().shutdown()
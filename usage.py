@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import engine as default_engine, SessionLocal, Command, CommandUsage
+
+logger = logging.getLogger(__name__)
+
+# Counted for messages that match no prompt, so menu changes that break old buttons show up
+UNKNOWN = "(unknown)"
+# Prompts listed by /command_stats
+TOP_PROMPTS = 30
+# Longest period /command_stats covers, well inside the range of datetime
+MAX_DAYS = 3650
+
+
+def _hour(hour_number: int) -> datetime:
+    return datetime.fromtimestamp(hour_number * 3600, timezone.utc).replace(tzinfo=None)
+
+
+# Counts how often each prompt is used per hour in memory and adds the counts to the
+# command_usage rollups in one batch every few seconds, so counting costs a dict increment
+class UsageCounter:
+    def __init__(self, flush_interval: float, bind=None):
+        self.flush_interval = flush_interval
+        self.bind = bind or default_engine
+        self._counts = {}  # (prompt, hours since the epoch) -> uses
+        self._task = None
+
+    def count(self, prompt: str) -> None:
+        key = (prompt, int(time.time()) // 3600)
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    # Must be called from the event loop
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error writing command usage")
+
+    async def flush(self) -> None:
+        if not self._counts:
+            return
+        counts, self._counts = self._counts, {}
+        try:
+            await asyncio.to_thread(self._write, counts)
+        except Exception:
+            # Added to the next flush
+            for key, uses in counts.items():
+                self._counts[key] = self._counts.get(key, 0) + uses
+            raise
+
+    def _write(self, counts: dict) -> None:
+        statement = sqlite_insert(CommandUsage)
+        statement = statement.on_conflict_do_update(
+            index_elements=["prompt", "hour"], set_={"count": CommandUsage.count + statement.excluded.count})
+        with self.bind.begin() as conn:
+            conn.execute(statement, [{"prompt": prompt, "hour": _hour(hour), "count": uses}
+                                     for (prompt, hour), uses in counts.items()])
+
+
+# Uses per prompt over the last `days` days, most used first, as (prompt, uses, last used hour),
+# and the prompts of the commands table that weren't used at all. Blocking.
+def command_stats(days: int):
+    days = min(days, MAX_DAYS)
+    since = datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    db = SessionLocal()
+    try:
+        used = db.execute(
+            select(CommandUsage.prompt, func.sum(CommandUsage.count), func.max(CommandUsage.hour))
+            .where(CommandUsage.hour >= since)
+            .group_by(CommandUsage.prompt)
+            .order_by(func.sum(CommandUsage.count).desc())
+        ).all()
+        names = {prompt for prompt, _, _ in used}
+        unused = [command for command, in db.execute(select(Command.command).order_by(Command.command))
+                  if command not in names]
+    finally:
+        db.close()
+    return [tuple(row) for row in used], unused